@@ -130,6 +130,26 @@ data_set_type_MICROSCOPY_IMG_THUMBNAIL.setDeletionDisallowed(False)
 if 'setDataSetKind' in dir(data_set_type_MICROSCOPY_IMG_THUMBNAIL):
     data_set_type_MICROSCOPY_IMG_THUMBNAIL.setDataSetKind('PHYSICAL')
 
+# MICROSCOPY_IMG_PYRAMID
+data_set_type_MICROSCOPY_IMG_PYRAMID = tr.getOrCreateNewDataSetType('MICROSCOPY_IMG_PYRAMID')
+data_set_type_MICROSCOPY_IMG_PYRAMID.setDescription(
+    'Chunked multiscale pyramid of a large series. Generated from raw images.')
+data_set_type_MICROSCOPY_IMG_PYRAMID.setMainDataSetPattern(None)
+data_set_type_MICROSCOPY_IMG_PYRAMID.setMainDataSetPath(None)
+data_set_type_MICROSCOPY_IMG_PYRAMID.setDeletionDisallowed(False)
+if 'setDataSetKind' in dir(data_set_type_MICROSCOPY_IMG_PYRAMID):
+    data_set_type_MICROSCOPY_IMG_PYRAMID.setDataSetKind('PHYSICAL')
+
+# MICROSCOPY_IMG_THUMBNAIL_SHEET
+data_set_type_MICROSCOPY_IMG_THUMBNAIL_SHEET = tr.getOrCreateNewDataSetType('MICROSCOPY_IMG_THUMBNAIL_SHEET')
+data_set_type_MICROSCOPY_IMG_THUMBNAIL_SHEET.setDescription(
+    'Thumbnails of the samples of a microscopy experiment composed into sprite sheets.')
+data_set_type_MICROSCOPY_IMG_THUMBNAIL_SHEET.setMainDataSetPattern(None)
+data_set_type_MICROSCOPY_IMG_THUMBNAIL_SHEET.setMainDataSetPath(None)
+data_set_type_MICROSCOPY_IMG_THUMBNAIL_SHEET.setDeletionDisallowed(False)
+if 'setDataSetKind' in dir(data_set_type_MICROSCOPY_IMG_THUMBNAIL_SHEET):
+    data_set_type_MICROSCOPY_IMG_THUMBNAIL_SHEET.setDataSetKind('PHYSICAL')
+
 # ==============================================================================
 #
 # PROPERTY TYPES
@@ -212,6 +232,27 @@ prop_type_MICROSCOPY_IMG_CONTAINER_METADATA.setLabel('Series metadata')
 prop_type_MICROSCOPY_IMG_CONTAINER_METADATA.setManagedInternally(False)
 prop_type_MICROSCOPY_IMG_CONTAINER_METADATA.setInternalNamespace(False)
 
+# MICROSCOPY_IMG_CHANNEL_STATISTICS
+prop_type_MICROSCOPY_IMG_CHANNEL_STATISTICS = tr.getOrCreateNewPropertyType('MICROSCOPY_IMG_CHANNEL_STATISTICS',
+                                                                            DataType.XML)
+prop_type_MICROSCOPY_IMG_CHANNEL_STATISTICS.setLabel('Channel intensity statistics (thumbnail planes)')
+prop_type_MICROSCOPY_IMG_CHANNEL_STATISTICS.setManagedInternally(False)
+prop_type_MICROSCOPY_IMG_CHANNEL_STATISTICS.setInternalNamespace(False)
+
+# MICROSCOPY_IMG_THUMBNAIL_PLANES
+prop_type_MICROSCOPY_IMG_THUMBNAIL_PLANES = tr.getOrCreateNewPropertyType('MICROSCOPY_IMG_THUMBNAIL_PLANES',
+                                                                          DataType.VARCHAR)
+prop_type_MICROSCOPY_IMG_THUMBNAIL_PLANES.setLabel('Planes in sampled thumbnail')
+prop_type_MICROSCOPY_IMG_THUMBNAIL_PLANES.setManagedInternally(False)
+prop_type_MICROSCOPY_IMG_THUMBNAIL_PLANES.setInternalNamespace(False)
+
+# MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX
+prop_type_MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX = tr.getOrCreateNewPropertyType('MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX',
+                                                                               DataType.MULTILINE_VARCHAR)
+prop_type_MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX.setLabel('Thumbnail sheet index')
+prop_type_MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX.setManagedInternally(False)
+prop_type_MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX.setInternalNamespace(False)
+
 # MICROSCOPY_SAMPLE_DESCRIPTION
 prop_type_MICROSCOPY_SAMPLE_DESCRIPTION = tr.getOrCreateNewPropertyType('MICROSCOPY_SAMPLE_DESCRIPTION',
                                                                         DataType.MULTILINE_VARCHAR)
@@ -342,6 +383,22 @@ assignment_DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_CONTAINER_METADATA.s
 assignment_DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_CONTAINER_METADATA.setManaged(True)
 assignment_DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_CONTAINER_METADATA.setShownEdit(False)
 
+# DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_CHANNEL_STATISTICS
+assignment_DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_CHANNEL_STATISTICS = tr.assignPropertyType(
+    data_set_type_MICROSCOPY_IMG_CONTAINER, prop_type_MICROSCOPY_IMG_CHANNEL_STATISTICS)
+assignment_DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_CHANNEL_STATISTICS.setMandatory(False)
+assignment_DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_CHANNEL_STATISTICS.setSection(None)
+assignment_DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_CHANNEL_STATISTICS.setPositionInForms(4)
+assignment_DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_CHANNEL_STATISTICS.setShownEdit(False)
+
+# DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_THUMBNAIL_PLANES
+assignment_DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_THUMBNAIL_PLANES = tr.assignPropertyType(
+    data_set_type_MICROSCOPY_IMG_CONTAINER, prop_type_MICROSCOPY_IMG_THUMBNAIL_PLANES)
+assignment_DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_THUMBNAIL_PLANES.setMandatory(False)
+assignment_DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_THUMBNAIL_PLANES.setSection(None)
+assignment_DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_THUMBNAIL_PLANES.setPositionInForms(5)
+assignment_DATA_SET_MICROSCOPY_IMG_CONTAINER_MICROSCOPY_IMG_THUMBNAIL_PLANES.setShownEdit(False)
+
 # DATA_SET_MICROSCOPY_IMG_CONTAINER_NAME
 assignment_DATA_SET_MICROSCOPY_IMG_CONTAINER_NAME = tr.assignPropertyType(data_set_type_MICROSCOPY_IMG_CONTAINER,
                                                                           prop_type_NAME)
@@ -358,6 +415,14 @@ assignment_DATA_SET_MICROSCOPY_IMG_OVERVIEW_RESOLUTION.setSection(None)
 assignment_DATA_SET_MICROSCOPY_IMG_OVERVIEW_RESOLUTION.setPositionInForms(2)
 assignment_DATA_SET_MICROSCOPY_IMG_OVERVIEW_RESOLUTION.setShownEdit(False)
 
+# DATA_SET_MICROSCOPY_IMG_THUMBNAIL_SHEET_MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX
+assignment_DATA_SET_MICROSCOPY_IMG_THUMBNAIL_SHEET_MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX = tr.assignPropertyType(
+    data_set_type_MICROSCOPY_IMG_THUMBNAIL_SHEET, prop_type_MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX)
+assignment_DATA_SET_MICROSCOPY_IMG_THUMBNAIL_SHEET_MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX.setMandatory(False)
+assignment_DATA_SET_MICROSCOPY_IMG_THUMBNAIL_SHEET_MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX.setSection(None)
+assignment_DATA_SET_MICROSCOPY_IMG_THUMBNAIL_SHEET_MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX.setPositionInForms(1)
+assignment_DATA_SET_MICROSCOPY_IMG_THUMBNAIL_SHEET_MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX.setShownEdit(False)
+
 # SAMPLE_MICROSCOPY_SAMPLE_TYPE_NAME
 assignment_SAMPLE_MICROSCOPY_SAMPLE_TYPE_NAME = tr.assignPropertyType(samp_type_MICROSCOPY_SAMPLE_TYPE, prop_type_NAME)
 assignment_SAMPLE_MICROSCOPY_SAMPLE_TYPE_NAME.setMandatory(False)
@@ -262,6 +262,39 @@ define(["openbis",
 
             if (r_Completed === 0) {
 
+                // Is the export still waiting in the queue?
+                if (row.length > 12 && row[12].value > 0) {
+                    DATAVIEWER.displayStatus(
+                        "Your request is queued (position " + row[12].value +
+                        "). It will start as soon as the running exports are done...",
+                        "info");
+                } else if (row.length > 18 && row[14].value > 0) {
+                    // Report the progress (the files are found as they are
+                    // exported: the estimated size is the better total until then)
+                    let nBytesTotal = row[16].value;
+                    if (row.length > 19 && row[19].value > nBytesTotal) {
+                        nBytesTotal = row[19].value;
+                    }
+                    let status = "Please wait while processing your request: " +
+                        row[13].value + " of " + row[14].value + " files (" +
+                        Math.round(row[15].value / 1048576) + " of " +
+                        Math.round(nBytesTotal / 1048576) + " MB, " +
+                        Math.round(row[17].value / 1048576) + " MB/s)";
+                    if (row[18].value >= 0) {
+                        status += ", about " + Math.ceil(row[18].value / 60) + " min left";
+                    }
+                    DATAVIEWER.displayStatus(status + "...", "info");
+                } else if (row.length > 19 && row[19].value > 0) {
+                    DATAVIEWER.displayStatus(
+                        "Please wait while processing your request (about " +
+                        Math.round(row[19].value / 1048576) + " MB). This might take a while...",
+                        "info");
+                } else if (row.length > 12) {
+                    DATAVIEWER.displayStatus(
+                        "Please wait while processing your request. This might take a while...",
+                        "info");
+                }
+
                 // Call the plug-in
                 setTimeout(function () {
 
@@ -22,6 +22,10 @@ define([], function () {
 
         // Current index of the first thumbnail to display
         this.indexOfFirstThumbnail = 0;
+
+        // Tiles of the thumbnail sheets of the experiment: map sample permId -> tile
+        // (null until retrieved)
+        this.thumbnailSheetTiles = null;
     };
 
     /**
@@ -74,6 +78,9 @@ define([], function () {
                 let newThumbRow = $("<div />", {class: "row"});
                 sampleView_div.append(newThumbRow);
 
+                // Samples displayed in current page
+                let pageSamples = [];
+
                 // Display samples with a link to their corresponding webapp.
                 // Later we will reorganize the layout (when the thumbnails
                 // are ready to be retrieved from openBIS).
@@ -159,10 +166,13 @@ define([], function () {
                     newThumbCol.append(thumbnailView);
                     newThumbRow.append(newThumbCol);
 
-                    // Now retrieve the link to the thumbnail image asynchronously and update the <img>
-                    DATAVIEWER.displayThumbnailForSample(sample, "image_" + sample.code);
+                    // The thumbnail images are retrieved asynchronously below
+                    pageSamples.push(sample);
                 }
 
+                // Now retrieve the thumbnail images asynchronously and update the <img>'s
+                DATAVIEWER.displayThumbnailsForSamples(pageSamples);
+
                 // Display the export action
                 this.displayActions(DATAMODEL.microscopyExperimentSample);
             }
@@ -386,6 +396,233 @@ define([], function () {
             return formattedDatasetSize;
         },
 
+        /**
+         * Display the thumbnails of the given samples.
+         *
+         * Thumbnails that are in the thumbnail sheets of the experiment (composed by the
+         * MicroscopyThumbnailSheetDropbox when thumbnails are generated) are cut from the
+         * sheets, so that a page only needs one image request per sheet. The others are
+         * retrieved one by one with displayThumbnailForSample().
+         * @param samples: array of MICROSCOPY_SAMPLE_TYPE samples.
+         */
+        displayThumbnailsForSamples: function (samples) {
+
+            // Alias
+            const dataViewerObj = this;
+
+            this.retrieveThumbnailSheetTiles(function (tiles) {
+
+                for (let i = 0; i < samples.length; i++) {
+                    let sample = samples[i];
+                    let tile = tiles[sample.permId.permId];
+                    if (tile !== undefined) {
+                        dataViewerObj.displayThumbnailFromSheet(tile, "image_" + sample.code);
+                    } else {
+                        dataViewerObj.displayThumbnailForSample(sample, "image_" + sample.code);
+                    }
+                }
+            });
+        },
+
+        /**
+         * Retrieve the tiles of the thumbnail sheets (MICROSCOPY_IMG_THUMBNAIL_SHEET datasets)
+         * of the experiment and pass them to the callback as a map sample permId -> tile.
+         *
+         * The tiles are retrieved once (two requests) and cached. If a sample is in more than
+         * one dataset, the most recent one (highest "sequence" in the index) is used.
+         * @param callback: function called with the map of tiles.
+         */
+        retrieveThumbnailSheetTiles: function (callback) {
+
+            if (this.thumbnailSheetTiles !== null) {
+                callback(this.thumbnailSheetTiles);
+                return;
+            }
+
+            // Alias
+            const dataViewerObj = this;
+
+            // Cache the tiles and pass them on
+            let done = function (tiles) {
+                dataViewerObj.thumbnailSheetTiles = tiles;
+                callback(tiles);
+            };
+
+            require([
+                    "as/dto/dataset/search/DataSetSearchCriteria",
+                    "as/dto/dataset/fetchoptions/DataSetFetchOptions",
+                    "dss/dto/datasetfile/search/DataSetFileSearchCriteria",
+                    "dss/dto/datasetfile/fetchoptions/DataSetFileFetchOptions",
+                ],
+
+                function (
+                    DataSetSearchCriteria,
+                    DataSetFetchOptions,
+                    DataSetFileSearchCriteria,
+                    DataSetFileFetchOptions) {
+
+                    let dataSetCriteria = new DataSetSearchCriteria();
+                    dataSetCriteria.withType().withCode().thatEquals("MICROSCOPY_IMG_THUMBNAIL_SHEET");
+                    dataSetCriteria.withSample().withPermId().thatEquals(
+                        DATAMODEL.microscopyExperimentSample.permId.permId);
+
+                    let dataSetFetchOptions = new DataSetFetchOptions();
+                    dataSetFetchOptions.withProperties();
+
+                    // Query the server
+                    DATAMODEL.openbisV3.searchDataSets(dataSetCriteria, dataSetFetchOptions).done(function (result) {
+
+                        // Parse the indexes
+                        let indexedDataSets = [];
+                        result.getObjects().forEach(function (dataSet) {
+                            let index;
+                            try {
+                                index = JSON.parse(dataSet.properties["MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX"]);
+                            } catch (e) {
+                                return;
+                            }
+                            if (!index || !index.tiles || !index.sheets) {
+                                return;
+                            }
+                            indexedDataSets.push({dataSet: dataSet, index: index});
+                        });
+
+                        // Process the most recent datasets last: the dropbox numbers them in the
+                        // "sequence" of the index (dataset codes do not sort numerically)
+                        indexedDataSets.sort(function (a, b) {
+                            let sequenceA = a.index.sequence || 0;
+                            let sequenceB = b.index.sequence || 0;
+                            if (sequenceA !== sequenceB) {
+                                return sequenceA - sequenceB;
+                            }
+                            return a.dataSet.code < b.dataSet.code ? -1 : (a.dataSet.code > b.dataSet.code ? 1 : 0);
+                        });
+                        let tiles = {};
+                        indexedDataSets.forEach(function (entry) {
+                            let dataSet = entry.dataSet;
+                            let index = entry.index;
+                            for (let permId in index.tiles) {
+                                let tile = index.tiles[permId];
+                                let sheet = index.sheets[tile.sheet];
+                                if (sheet === undefined) {
+                                    continue;
+                                }
+                                tiles[permId] = {
+                                    dataSetPermId: dataSet.permId.permId,
+                                    sheet: tile.sheet,
+                                    x: tile.x,
+                                    y: tile.y,
+                                    width: tile.width,
+                                    height: tile.height,
+                                    sheetWidth: sheet.width,
+                                    sheetHeight: sheet.height,
+                                    url: null
+                                };
+                            }
+                        });
+
+                        // Only the sheets of the datasets that still hold a tile are needed (the
+                        // datasets superseded by more recent ones are kept, see the dropbox)
+                        let dataSetPermIds = {};
+                        for (let permId in tiles) {
+                            dataSetPermIds[tiles[permId].dataSetPermId] = true;
+                        }
+                        let dataSets = indexedDataSets.map(function (entry) {
+                            return entry.dataSet;
+                        }).filter(function (dataSet) {
+                            return dataSetPermIds[dataSet.permId.permId] === true;
+                        });
+
+                        if (dataSets.length === 0) {
+                            done(tiles);
+                            return;
+                        }
+
+                        // Retrieve the download URLs of the sheets
+                        let criteria = new DataSetFileSearchCriteria();
+                        let fileDataSetCriteria = criteria.withDataSet().withOrOperator();
+                        dataSets.forEach(function (dataSet) {
+                            fileDataSetCriteria.withPermId().thatEquals(dataSet.permId.permId);
+                        });
+
+                        let fetchOptions = new DataSetFileFetchOptions();
+
+                        DATAMODEL.openbisV3.getDataStoreFacade().searchFiles(criteria, fetchOptions).done(function (result) {
+
+                            let urls = {};
+                            result.getObjects().forEach(function (f) {
+                                if (f.isDirectory()) {
+                                    return;
+                                }
+                                let path = f.getPath();
+                                let name = path.substring(path.lastIndexOf("/") + 1);
+                                let url = f.getDataStore().getDownloadUrl() + "/datastore_server/" +
+                                    f.permId.dataSetId.permId + "/" + path + "?sessionID=" +
+                                    DATAMODEL.openbisV3.getWebAppContext().sessionId;
+                                let eUrl = encodeURI(url);
+                                eUrl = eUrl.replace('+', '%2B');
+                                urls[f.permId.dataSetId.permId + "/" + name] = eUrl;
+                            });
+
+                            // Drop the tiles whose sheet could not be found
+                            for (let permId in tiles) {
+                                let url = urls[tiles[permId].dataSetPermId + "/" + tiles[permId].sheet];
+                                if (url === undefined) {
+                                    delete tiles[permId];
+                                } else {
+                                    tiles[permId].url = url;
+                                }
+                            }
+
+                            done(tiles);
+
+                        }).fail(function () {
+                            done({});
+                        });
+
+                    }).fail(function () {
+                        done({});
+                    });
+                });
+        },
+
+        /**
+         * Display a thumbnail cut from a thumbnail sheet.
+         *
+         * The image element gets a transparent place holder with the size of the tile (so
+         * that it keeps its aspect ratio when it is scaled) and the sheet as background,
+         * scaled and positioned so that only the tile is visible.
+         * @param tile: tile as returned by retrieveThumbnailSheetTiles().
+         * @param img_id: id of the image element.
+         */
+        displayThumbnailFromSheet: function (tile, img_id) {
+
+            // Thumbnail
+            let imD = $("#" + img_id);
+
+            // Make sure to reset the display attribute
+            imD.css("display", "inline");
+
+            // Place holder with the size of the tile
+            let placeholder = "data:image/svg+xml;charset=utf-8," + encodeURIComponent(
+                "<svg xmlns=\"http://www.w3.org/2000/svg\" width=\"" + tile.width +
+                "\" height=\"" + tile.height + "\"/>");
+
+            // Background size and position in percent of the image element
+            let sizeX = 100.0 * tile.sheetWidth / tile.width;
+            let sizeY = 100.0 * tile.sheetHeight / tile.height;
+            let posX = (tile.sheetWidth > tile.width) ? 100.0 * tile.x / (tile.sheetWidth - tile.width) : 0;
+            let posY = (tile.sheetHeight > tile.height) ? 100.0 * tile.y / (tile.sheetHeight - tile.height) : 0;
+
+            imD.attr("src", placeholder);
+            imD.css({
+                "background-image": "url(\"" + tile.url + "\")",
+                "background-repeat": "no-repeat",
+                "background-size": sizeX + "% " + sizeY + "%",
+                "background-position": posX + "% " + posY + "%"
+            });
+        },
+
         displayThumbnailForSample: function (sample, img_id) {
 
             require([
@@ -434,11 +671,12 @@ define([], function () {
                         // All MICROSCOPY_IMG_CONTAINER datasets (i.e. a file series) contain a MICROSCOPY_IMG_OVERVIEW
                         // and a MICROSCOPY_IMG dataset; one of the series will also contain a MICROSCOPY_IMG_THUMBNAIL,
                         // which is what we are looking for here.
-                        // Even though the MICROSCOPY_IMG_THUMBNAIL is always created for series 0, we cannot guarantee
-                        // here that series zero will be returned as the first. We quickly scan through the returned
-                        // results for the MICROSCOPY_IMG_CONTAINER that has three contained datasets.
-                        // From there we can then quickly retrieve the MICROSCOPY_IMG_THUMBNAIL.
-                        external_loop:
+                        // The MICROSCOPY_IMG_THUMBNAIL is always created for series 0 (and optionally for the
+                        // other series as well), but we cannot guarantee here that series zero will be returned
+                        // as the first. We scan through the returned results for the MICROSCOPY_IMG_CONTAINERs
+                        // that contain a MICROSCOPY_IMG_THUMBNAIL and keep the one with the lowest code: series 0
+                        // is registered first.
+                        let containerCode = null;
                         for (let i = 0; i < result.objects.length; i++) {
                             let currentDataSet = result.objects[i];
                             if (null == currentDataSet.components) {
@@ -446,8 +684,11 @@ define([], function () {
                             }
                             for (let j = 0; j < currentDataSet.components.length; j++) {
                                 if (currentDataSet.components[j].type.code === "MICROSCOPY_IMG_THUMBNAIL") {
-                                    dataSet = currentDataSet.components[j];
-                                    break external_loop;
+                                    if (containerCode === null || currentDataSet.code < containerCode) {
+                                        dataSet = currentDataSet.components[j];
+                                        containerCode = currentDataSet.code;
+                                    }
+                                    break;
                                 }
                             }
                         }
@@ -498,29 +739,71 @@ define([], function () {
                             // Extract the files
                             let datasetFiles = result.getObjects();
 
-                            // Find the only fcs file and add its name and URL to the DynaTree
-                            datasetFiles.forEach(function (f) {
-
-                                if (!f.isDirectory()) {
-
-                                    if (f.getPath() == "thumbnail.png") {
-                                        // Build the download URL
-                                        let url = f.getDataStore().getDownloadUrl() + "/datastore_server/" +
-                                            f.permId.dataSetId.permId + "/" + f.getPath() + "?sessionID=" +
-                                            DATAMODEL.openbisV3.getWebAppContext().sessionId;
-
-                                        // Replace the image
-                                        let eUrl = encodeURI(url);
-                                        eUrl = eUrl.replace('+', '%2B');
-                                        imD.attr("src", eUrl);
-                                    }
-                                }
-                            });
+                            // Pick the smallest thumbnail that is at least as large as the displayed image
+                            let f = DATAVIEWER.selectThumbnailFile(datasetFiles, imD);
+                            if (f !== null) {
+                                // Build the download URL
+                                let url = f.getDataStore().getDownloadUrl() + "/datastore_server/" +
+                                    f.permId.dataSetId.permId + "/" + f.getPath() + "?sessionID=" +
+                                    DATAMODEL.openbisV3.getWebAppContext().sessionId;
+
+                                // Replace the image
+                                let eUrl = encodeURI(url);
+                                eUrl = eUrl.replace('+', '%2B');
+                                imD.attr("src", eUrl);
+                            }
                         });
                     });
                 });
         },
 
+        /**
+         * Select the thumbnail file to display in an image element.
+         *
+         * The MICROSCOPY_IMG_THUMBNAIL dataset contains thumbnail.png (256 pixels)
+         * and optionally thumbnail_{size}.png files at other sizes (e.g. 64 and 512
+         * pixels). The smallest thumbnail that is at least as large as the container
+         * of the image element (in device pixels) is returned; if none is large enough, the
+         * largest one is returned.
+         * @param datasetFiles: array of DataSetFile objects.
+         * @param imD: jQuery image element that will display the thumbnail.
+         * @return DataSetFile object, or null if there are no thumbnails.
+         */
+        selectThumbnailFile: function (datasetFiles, imD) {
+
+            // Size needed by the image: the image is responsive and fills its container
+            // (which holds a place holder at this point). Fall back to 256 if the container
+            // is not laid out yet.
+            let requiredSize = imD.parent().width() * (window.devicePixelRatio || 1);
+            if (!(requiredSize > 0)) {
+                requiredSize = 256;
+            }
+
+            let bestFile = null;
+            let bestSize = 0;
+            datasetFiles.forEach(function (f) {
+
+                if (f.isDirectory()) {
+                    return;
+                }
+
+                let match = /^thumbnail(_(\d+))?\.png$/.exec(f.getPath());
+                if (match === null) {
+                    return;
+                }
+                let size = (match[2] === undefined) ? 256 : parseInt(match[2]);
+
+                if (bestFile === null ||
+                    (bestSize < requiredSize && size > bestSize) ||
+                    (size >= requiredSize && size < bestSize)) {
+                    bestFile = f;
+                    bestSize = size;
+                }
+            });
+
+            return bestFile;
+        },
+
         /**
          * Build and display the code to trigger the server-side aggregation
          * plugin 'copy_datasets_to_userdir'
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+import re
+import random
+from ch.systemsx.cisd.openbis.dss.etl.dto.api import ChannelColorRGB
+from ch.systemsx.cisd.openbis.dss.etl.dto.api import Channel
+
+
+class ChannelFactory:
+    """Creates and caches the openBIS Channel objects for all series of
+    a microscopy file (or composite folder).
+
+    openBIS asks each dataset configuration for its channels once per
+    channel code, but a file with many series is registered through one
+    configuration object per series. A single ChannelFactory is shared by
+    all these configuration objects, so that every channel code is parsed
+    and every channel is built only once per file."""
+
+    _DEBUG = False
+
+    # Channel code pattern: SERIES-(\d+)_CHANNEL-(\d+)
+    _channelCodePattern = re.compile(r"^SERIES-(\d+)_CHANNEL-(\d+)$")
+
+    def __init__(self, logger):
+        """Constructor.
+
+        @param logger: logger object
+        """
+
+        # Store the logger
+        self._logger = logger
+
+        # Map channel code -> (seriesIndx, channelIndx)
+        self._indices = {}
+
+        # Map channel code -> Channel
+        self._channels = {}
+
+        # Map (R, G, B) -> ChannelColorRGB (channels with the same color
+        # share the same color object)
+        self._colors = {}
+
+        # Map (color string, scale) -> (R, G, B)
+        self._parsedColors = {}
+
+    def createChannel(self, channelCode, datasetConfig):
+        """Return the Channel for the given channel code. The name and the
+        color of the channel are queried from the passed dataset configuration
+        (via its _getChannelName() and _getChannelColor() methods) the first
+        time the channel code is requested and are cached afterwards.
+
+        @param channelCode Code of the channel as generated by extractImagesMetadata().
+        @param datasetConfig The dataset configuration requesting the channel.
+
+        Returns a ch.systemsx.cisd.openbis.dss.etl.dto.api.Channel
+        """
+
+        # Cache hit?
+        channel = self._channels.get(channelCode)
+        if channel is not None:
+            return channel
+
+        # Get the indices of series and channel from the channel code
+        (seriesIndx, channelIndx) = self.getSeriesAndChannelNumbers(channelCode)
+
+        # Get the channel name
+        name = datasetConfig._getChannelName(seriesIndx, channelIndx)
+
+        # Get the channel color (RGB)
+        colorRGB = datasetConfig._getChannelColor(seriesIndx, channelIndx)
+
+        if self._DEBUG:
+            self._logger.info("CHANNELFACTORY::createChannel(): " +
+                              "channel (s = " + str(seriesIndx) + ", c = " +
+                              str(channelIndx) + ") has code " + channelCode +
+                              ", color (" + str(colorRGB) + " and name " + name)
+
+        # Create the channel with given name and color (the code is set to
+        # be the same as the channel name) and cache it.
+        channel = Channel(channelCode, name, colorRGB)
+        self._channels[channelCode] = channel
+
+        return channel
+
+    def getSeriesAndChannelNumbers(self, channelCode):
+        """Extract series and channel number from channel code in
+        the form SERIES-(\d+)_CHANNEL-(\d+) to a tuple
+        (seriesIndx, channelIndx).
+
+        @param channelCode Code of the channel as generated by extractImagesMetadata().
+
+        Returns seriesIndx, channelIndx
+        """
+
+        indices = self._indices.get(channelCode)
+        if indices is not None:
+            return indices
+
+        m = self._channelCodePattern.match(channelCode)
+        if m is None:
+            err = "CHANNELFACTORY::getSeriesAndChannelNumbers(): " + \
+            "Could not extract series and channel number from channel " + \
+            "code " + str(channelCode) + "!"
+            self._logger.error(err)
+            raise Exception(err)
+
+        # Now assign the indices
+        indices = (int(m.group(1)), int(m.group(2)))
+        self._indices[channelCode] = indices
+
+        if self._DEBUG:
+            self._logger.info("Current channel code " + channelCode + \
+                              " corresponds to series = " + str(indices[0]) + \
+                              " and channel = " + str(indices[1]))
+
+        # Return them
+        return indices
+
+    def parseColor(self, color, scale=1.0):
+        """Parse a color string in the form "R,G,B[,A]" as stored in the
+        channelColor{N} series metadata attribute into a (R, G, B) tuple
+        of ints. Components are multiplied by scale (use 255.0 for colors
+        stored in the 0 .. 1 range).
+
+        @param color Color string.
+        @param scale Scaling factor for the color components.
+
+        Returns (R, G, B)
+        """
+
+        key = (color, scale)
+        components = self._parsedColors.get(key)
+        if components is None:
+            parts = color.split(",")
+            components = (int(scale * float(parts[0])),
+                          int(scale * float(parts[1])),
+                          int(scale * float(parts[2])))
+            self._parsedColors[key] = components
+
+        return components
+
+    def getColor(self, R, G, B):
+        """Return the (cached) ChannelColorRGB object for the given components.
+
+        Returns a ch.systemsx.cisd.openbis.dss.etl.dto.api.ChannelColorRGB
+        """
+
+        key = (R, G, B)
+        colorRGB = self._colors.get(key)
+        if colorRGB is None:
+            colorRGB = ChannelColorRGB(R, G, B)
+            self._colors[key] = colorRGB
+
+        return colorRGB
+
+    @staticmethod
+    def fallbackColor(channelIndx):
+        """Return a (R, G, B) tuple for a channel without color information
+        and with no predefined default color.
+
+        The color is derived from the channel index, so that it is the same
+        for all series and for every registration of the same data.
+        """
+
+        rnd = random.Random(channelIndx)
+        return (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255))
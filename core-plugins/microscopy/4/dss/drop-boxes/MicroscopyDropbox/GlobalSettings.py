@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+Created on Apr 27, 2016
+
+@author: Aaron Ponti
+"""
+
+
+class GlobalSettings(object):
+    '''
+    Store global settings to be used in the dropbox.
+    '''
+
+    # Registration layout for composite files (folders: Leica TIFF series,
+    # Generic TIFF series, YouScope experiments and Visitron ND).
+    #
+    # False: one MICROSCOPY_IMG dataset is created per series; the first one
+    #        owns the folder and all others point to it. openBIS scans all
+    #        images in the folder once per series.
+    #
+    # True:  all series are registered into a single MICROSCOPY_IMG dataset
+    #        in one pass (the folder is scanned only once). The series are
+    #        still distinguishable by their series number in the image
+    #        metadata, but the viewer will only list one dataset per folder.
+    #
+    # Set to False to keep the per-series dataset layout.
+    RegisterAllCompositeSeriesInOneDataset = False
+
+    # Pre-flight validation of Leica and Generic TIFF series. Before
+    # registration, the headers of all TIFF files in the folder are read
+    # (without bio-formats) and their size, pixel type and number of planes
+    # are checked against sizeX, sizeY, sizeZ, sizeC and sizeT in the series
+    # metadata.
+    #
+    # "off":  no validation.
+    # "warn": log all inconsistencies and continue the registration.
+    # "fail": log all inconsistencies and abort the registration.
+    TIFFSeriesGeometryValidation = "warn"
+
+    # Thumbnail policies per file type: "Microscopy File" (single files) or one
+    # of the composite file types ("Leica TIFF Series", "Generic TIFF Series",
+    # "YouScope Experiment", "Visitron ND"). The "default" entry applies to all
+    # types; the entries of a file type override it key by key.
+    #
+    # "defer":     True (default) to leave thumbnail generation to the
+    #              microscopy_thumbnails_creation maintenance task; False to
+    #              create the thumbnails at registration time.
+    #
+    # The following keys only apply to thumbnails created at registration
+    # time ("defer": False). Deferred thumbnails are configured in the
+    # maintenance task (generate_thumbnails.py: _ALL_SERIES,
+    # _SAMPLING_MAX_PLANES and _ADDITIONAL_THUMBNAIL_SIZES), for all file
+    # types.
+    #
+    # "series":    series that get thumbnails: "first" (default), "all" or
+    #              "none".
+    # "maxPlanes": maximum number of planes per channel read for the
+    #              representative thumbnail (0 to read all planes, default).
+    # "sizes":     thumbnail sizes in pixels; the first one is used for the
+    #              representative thumbnail (default [256]).
+    #
+    # Example: create the thumbnails of small single files at registration:
+    #
+    #    "Microscopy File": {"defer": False, "sizes": [256, 64]}
+    ThumbnailPolicies = {
+        "default": {
+            "defer": True
+        }
+    }
+
+    # Datasets larger than this size (in bytes) always defer thumbnail
+    # generation to the maintenance task, whatever their policy says.
+    ThumbnailInlineMaxDatasetSize = 512 * 1024 * 1024
@@ -7,8 +7,9 @@ Created on Feb 20, 2014
 """
 
 import re
-import random
 from MicroscopyCompositeDatasetConfig import MicroscopyCompositeDatasetConfig
+from ChannelFactory import ChannelFactory
+from TIFFHeaderScanner import TIFFHeaderScanner
 from ch.systemsx.cisd.openbis.dss.etl.dto.api import ChannelColor
 from ch.systemsx.cisd.openbis.dss.etl.dto.api import ImageIdentifier
 from ch.systemsx.cisd.openbis.dss.etl.dto.api import ImageMetadata
@@ -39,6 +40,9 @@ class LeicaTIFFSeriesCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
     # Logger
     _logger = None
 
+    # Channel factory (shared by the configurations of all series in the folder)
+    _channelFactory = None
+
     # Dataset base name
     _basename = ""
 
@@ -56,7 +60,7 @@ class LeicaTIFFSeriesCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
                           "_ch(\d.*?)" + \
                           "\.tif{1,2}$", re.IGNORECASE)
 
-    def __init__(self, allSeriesMetadata, seriesIndices, logger, seriesNum=0):
+    def __init__(self, allSeriesMetadata, seriesIndices, logger, seriesNum=0, channelFactory=None):
         """Constructor.
 
         @param allSeriesMetadata: list of metadata attributes generated either
@@ -70,12 +74,23 @@ class LeicaTIFFSeriesCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
         @param seriesNum:         Int Number of the series to register. All
                                   other series in the file will be ignored.
                                   seriesNum MUST BE CONTAINED in seriesIndices.
+                                  Set to -1 to register all series to the
+                                  same dataset.
         @param logger:            logger object
+        @param channelFactory:    (optional) ChannelFactory shared by the
+                                  configuration objects of all series in
+                                  the folder. If omitted, a private one is
+                                  created.
         """
 
         # Store the logger
         self._logger = logger
 
+        # Store the channel factory
+        if channelFactory is None:
+            channelFactory = ChannelFactory(logger)
+        self._channelFactory = channelFactory
+
         # Store the series metadata
         self._allSeriesMetadata = allSeriesMetadata
 
@@ -87,7 +102,8 @@ class LeicaTIFFSeriesCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
         # Store the series number: make sure that it belongs to seriesIndices
         self._seriesNum = int(seriesNum)
         try:
-            self._seriesIndices.index(self._seriesNum)
+            if self._seriesNum != -1:
+                self._seriesIndices.index(self._seriesNum)
         except:
             raise("seriesNum (" + str(self._seriesNum) + ") MUST be contained " + \
                   "in seriesIndices " + str(self._seriesIndices) + "!")
@@ -115,24 +131,9 @@ class LeicaTIFFSeriesCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
         @param channelCode Code of the channel as generated by extractImagesMetadata().
         """
 
-        # Get the indices of series and channel from the channel code
-        (seriesIndx, channelIndx) = self._getSeriesAndChannelNumbers(channelCode)
-
-        # Get the channel name
-        name = self._getChannelName(seriesIndx, channelIndx)
-
-        # Get the channel color (RGB)
-        colorRGB = self._getChannelColor(seriesIndx, channelIndx)
-
-        if self._DEBUG:
-            self._logger.info("LEICATIFFSERIESCOMPOSITEDATASETCONFIG::createChannel(): " +
-                              "channel (s = " + str(seriesIndx) + ", c = " +
-                              str(channelIndx) + ") has code " + channelCode +
-                              ", color (" + str(colorRGB) + " and name " + name)
-
-        # Return the channel with given name and color (the code is set to
-        # be the same as the channel name).
-        return Channel(channelCode, name, colorRGB)
+        # Return the (cached) channel with given name and color (the code
+        # is set to be the same as the channel name).
+        return self._channelFactory.createChannel(channelCode, self)
 
 
     def extractImagesMetadata(self, imagePath, imageIdentifiers):
@@ -175,7 +176,7 @@ class LeicaTIFFSeriesCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
             series = int(m.group(4))
 
         # Make sure to process only the relevant series
-        if series != self._seriesNum:
+        if self._seriesNum != -1 and series != self._seriesNum:
             return []
 
         # The time index is also not always specified.
@@ -254,10 +255,7 @@ class LeicaTIFFSeriesCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
         color = metadata[key]
 
         if color is not None:
-            color = color.split(",")
-            R = int(255 * float(color[0]))
-            G = int(255 * float(color[1]))
-            B = int(255 * float(color[2]))
+            (R, G, B) = self._channelFactory.parseColor(color, 255.0)
         else:
             if channelIndx == 0:
                 R = 255
@@ -272,9 +270,7 @@ class LeicaTIFFSeriesCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
                 G = 0
                 B = 255
             else:
-                R = random.randint(0, 255)
-                G = random.randint(0, 255)
-                B = random.randint(0, 255)
+                (R, G, B) = ChannelFactory.fallbackColor(channelIndx)
 
         # Work around an issue if all color components are 0
         if R == G == B == 0:
@@ -283,8 +279,8 @@ class LeicaTIFFSeriesCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
             B = 255
             self._logger.info("Color changed from (0, 0, 0) to (255, 255, 255)")
 
-        # Create the ChannelColorRGB object
-        colorRGB = ChannelColorRGB(R, G, B)
+        # Get the (shared) ChannelColorRGB object
+        colorRGB = self._channelFactory.getColor(R, G, B)
 
         # Return it
         return colorRGB
@@ -298,23 +294,36 @@ class LeicaTIFFSeriesCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
         @param channelCode Code of the channel as generated by extractImagesMetadata().
         """
 
-        # Get the indices of series and channel from the channel code
-        p = re.compile("SERIES-(\d+)_CHANNEL-(\d+)")
-        m = p.match(channelCode)
-        if m is None or len(m.groups()) != 2:
-            err = "LEICATIFFSERIESCOMPOSITEDATASETCONFIG::_getSeriesAndChannelNumbers(): " + \
-            "Could not extract series and channel number!"
-            self._logger.error(err)
-            raise Exception(err)
+        # The channel code pattern is compiled (and the result cached) once
+        # for all series by the channel factory
+        return self._channelFactory.getSeriesAndChannelNumbers(channelCode)
 
-        # Now assign the indices
-        seriesIndx = int(m.group(1))
-        channelIndx = int(m.group(2))
+    def validateGeometry(self, fullFolder):
+        """Check size, pixel type and number of planes of all TIFF files in
+        the folder against the metadata of their series by reading the
+        TIFF headers only.
 
-        if self._DEBUG:
-            self._logger.info("Current channel code " + channelCode + \
-                              "corresponds to series = " + str(seriesIndx) + \
-                              " and channel = " + str(channelIndx))
+        @param fullFolder Full path to the composite folder.
+
+        Returns a list of error messages (empty if the folder is consistent).
+        """
 
-        # Return them
-        return seriesIndx, channelIndx
+        scanner = TIFFHeaderScanner(self._logger)
+        return scanner.validateFolder(fullFolder,
+                                      self._seriesNumFromFileName,
+                                      self._allSeriesMetadata,
+                                      self._seriesIndices)
+
+    def _seriesNumFromFileName(self, fileName):
+        """Return the series number encoded in the file name (0 if the file
+        name does not contain it), or -1 if the file name is not recognized.
+        """
+
+        m = self._pattern.match(fileName)
+        if m is None:
+            return -1
+
+        # See extractImagesMetadata()
+        if m.group(2) is None:
+            return 0
+        return int(m.group(4))
@@ -5,11 +5,43 @@
 """
 
 import os
+import re
 import logging
 
 from Processor import Processor
 
 
+def parsePropertiesFile(dbPath):
+    """Parse the plugin.properties file for the custom dropbox settings.
+
+    Only the settings with prefix "original-data-storage-" are returned
+    (all other entries are consumed by openBIS).
+
+    @param dbPath, path to the dropbox folder
+    """
+
+    filename = os.path.join(dbPath, "plugin.properties")
+
+    properties = {}
+    try:
+        fp = open(filename, "r")
+    except:
+        return properties
+
+    try:
+        for line in fp:
+            line = re.sub('[ \'\"\r\n]', '', line)
+            if line.startswith("#"):
+                continue
+            parts = line.split("=")
+            if len(parts) == 2 and parts[0].startswith("original-data-storage-"):
+                properties[parts[0]] = parts[1]
+    finally:
+        fp.close()
+
+    return properties
+
+
 def process(transaction):
     """Dropbox entry point.
 
@@ -35,8 +67,11 @@ def process(transaction):
                         format='%(asctime)-15s %(levelname)s: %(message)s')
     logger = logging.getLogger("Microscopy")
 
+    # Read the custom settings
+    properties = parsePropertiesFile(dbPath)
+
     # Create a Processor
-    processor = Processor(transaction, logger)
+    processor = Processor(transaction, logger, properties)
 
     # Run
     processor.run()
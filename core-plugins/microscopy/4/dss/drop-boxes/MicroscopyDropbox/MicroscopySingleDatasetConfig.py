@@ -6,7 +6,7 @@ Created on Feb 20, 2014
 @author: Aaron Ponti
 """
 
-import re
+from ChannelFactory import ChannelFactory
 from ch.systemsx.cisd.openbis.dss.etl.dto.api import SimpleImageDataConfig
 from ch.systemsx.cisd.openbis.dss.etl.dto.api import SimpleImageContainerDataConfig
 from ch.systemsx.cisd.openbis.dss.etl.dto.api.impl import MaximumIntensityProjectionGenerationAlgorithm
@@ -37,7 +37,10 @@ class MicroscopySingleDatasetConfig(SimpleImageContainerDataConfig):
     # Logger
     _logger = None
 
-    def __init__(self, allSeriesMetadata, logger, seriesNum=0):
+    # Channel factory (shared by the configurations of all series in the file)
+    _channelFactory = None
+
+    def __init__(self, allSeriesMetadata, logger, seriesNum=0, channelFactory=None):
         """Constructor.
 
         @param allSeriesMetadata: list of metadata attributes generated either
@@ -50,11 +53,20 @@ class MicroscopySingleDatasetConfig(SimpleImageContainerDataConfig):
                                   Set to -1 to register all series to the
                                   same dataset.
         @param logger:            logger object
+        @param channelFactory:    (optional) ChannelFactory shared by the
+                                  configuration objects of all series in
+                                  the file. If omitted, a private one is
+                                  created.
         """
 
         # Store the logger
         self._logger = logger
 
+        # Store the channel factory
+        if channelFactory is None:
+            channelFactory = ChannelFactory(logger)
+        self._channelFactory = channelFactory
+
         # Store the series metadata
         self._allSeriesMetadata = allSeriesMetadata
 
@@ -93,22 +105,9 @@ class MicroscopySingleDatasetConfig(SimpleImageContainerDataConfig):
         if self._seriesNum != -1 and seriesIndx != self._seriesNum:
             return
 
-        # Get the channel name
-        name = self._getChannelName(seriesIndx, channelIndx)
-
-        # Get the channel color (RGB)
-        colorRGB = self._getChannelColor(seriesIndx, channelIndx)
-
-        # Log
-        if self._DEBUG:
-            self._logger.info("MICROSCOPYSINGLEDATASETCONFIG::createChannel(): " +
-                              "channel (s = " + str(seriesIndx) + ", c = " +
-                              str(channelIndx) + ") has code " + channelCode +
-                              ", color (" + str(colorRGB) + " and name " + name)
-
-        # Return the channel with given name and color (the code is set to
-        # be the same as the channel name).
-        return Channel(channelCode, name, colorRGB)
+        # Return the (cached) channel with given name and color (the code
+        # is set to be the same as the channel name).
+        return self._channelFactory.createChannel(channelCode, self)
 
     def extractImagesMetadata(self, imagePath, imageIdentifiers):
         """Overrides extractImagesMetadata method making sure to store
@@ -220,12 +219,9 @@ class MicroscopySingleDatasetConfig(SimpleImageContainerDataConfig):
             raise(err)
 
         # Try extracting the color for current channel
-        colorComponents = color.split(",")
-        assert(len(colorComponents) == 4)
+        assert(len(color.split(",")) == 4)
         try:
-            R = int(float(colorComponents[0]))
-            G = int(float(colorComponents[1]))
-            B = int(float(colorComponents[2]))
+            (R, G, B) = self._channelFactory.parseColor(color)
         except:
             err = "MICROSCOPYSINGLEDATASETCONFIG::_getChannelColor(): " + \
             "Could not extract color with index " + str(channelIndx)
@@ -243,8 +239,8 @@ class MicroscopySingleDatasetConfig(SimpleImageContainerDataConfig):
             B = 255
             self._logger.info("Color changed from (0, 0, 0) to (255, 255, 255)")
 
-        # Create the ChannelColorRGB object
-        colorRGB = ChannelColorRGB(R, G, B)
+        # Get the (shared) ChannelColorRGB object
+        colorRGB = self._channelFactory.getColor(R, G, B)
 
         return colorRGB
 
@@ -256,19 +252,6 @@ class MicroscopySingleDatasetConfig(SimpleImageContainerDataConfig):
         @param channelCode Code of the channel as generated by extractImagesMetadata().
         """
 
-        # Get the indices of series and channel from the channel code
-        p = re.compile("SERIES-(\d+)_CHANNEL-(\d+)")
-        m = p.match(channelCode)
-        if m is None or len(m.groups()) != 2:
-            err = "MICROSCOPYSINGLEDATASETCONFIG::_getSeriesAndChannelNumbers(): " + \
-            "Could not extract series and channel number!"
-            self._logger.error(err)
-            raise Exception(err)
-
-        # Now assign the indices
-        seriesIndx = int(m.group(1))
-        channelIndx = int(m.group(2))
-
-        # Return them
-        return seriesIndx, channelIndx
-
+        # The channel code pattern is compiled (and the result cached) once
+        # for all series by the channel factory
+        return self._channelFactory.getSeriesAndChannelNumbers(channelCode)
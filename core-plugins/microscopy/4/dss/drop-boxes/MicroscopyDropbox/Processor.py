@@ -13,7 +13,11 @@ import os
 import re
 import xml.etree.ElementTree as ET
 from datetime import datetime
+from ch.systemsx.cisd.openbis.dss.etl.dto.api import OriginalDataStorageFormat
 from BioFormatsProcessor import BioFormatsProcessor
+from ChannelFactory import ChannelFactory
+from GlobalSettings import GlobalSettings
+from ThumbnailPolicy import ThumbnailPolicy
 from MicroscopySingleDatasetConfig import MicroscopySingleDatasetConfig
 from GenericTIFFSeriesCompositeDatasetConfig import GenericTIFFSeriesCompositeDatasetConfig
 from LeicaTIFFSeriesCompositeDatasetConfig import LeicaTIFFSeriesCompositeDatasetConfig
@@ -29,7 +33,7 @@ class Processor:
     __version__ = 2
 
     # Constructor
-    def __init__(self, transaction, logger):
+    def __init__(self, transaction, logger, properties=None):
 
         # Store arguments
         self._transaction = transaction
@@ -38,6 +42,11 @@ class Processor:
         # Set up logging
         self._logger = logger
 
+        # Custom dropbox settings (from plugin.properties)
+        if properties is None:
+            properties = {}
+        self._properties = properties
+
         # The user name
         self._username = ""
 
@@ -456,13 +465,23 @@ class Processor:
         # Set the parent MICROSCOPY_EXPERIMENT sample
         sample.setParentSampleIdentifiers([openBISSample.getSampleIdentifier()])
 
+        # The channels of all series in the file are created by the same factory
+        channelFactory = ChannelFactory(self._logger)
+
+        # Thumbnail policy for the file
+        thumbnailPolicy = ThumbnailPolicy.forFileType("Microscopy File",
+                                                      datasetSize,
+                                                      self._logger)
+
         # Register all series in the file
         image_data_set = None
         for i in range(num_series):
 
             # Create a configuration object
             singleDatasetConfig = MicroscopySingleDatasetConfig(allSeriesMetadata,
-                                                                self._logger, i)
+                                                                self._logger, i,
+                                                                channelFactory)
+            thumbnailPolicy.applyTo(singleDatasetConfig, i)
 
             # Extract the metadata associated to this series and convert it to
             # XML to store it in the MICROSCOPY_IMG_CONTAINER_METADATA property
@@ -609,11 +628,49 @@ class Processor:
 
         # For YouScope experiments, process the images.csv file and register the
         # accessory files in the root of the experiment
+        csvTable = None
         if compositeFileType == "YouScope Experiment":
             # Build image file table
             csvTable = YouScopeExperimentCompositeDatasetConfig.buildImagesCSVTable(fullFolder + "/images.csv",
                                                                                     self._logger)
 
+        # The channels of all series in the folder are created by the same factory
+        channelFactory = ChannelFactory(self._logger)
+
+        # Storage format for the original data of the folder
+        originalDataStorageFormat = self._getOriginalDataStorageFormat(compositeFileType,
+                                                                       fullFolder)
+
+        # Thumbnail policy for the folder
+        thumbnailPolicy = ThumbnailPolicy.forFileType(compositeFileType,
+                                                      datasetSize,
+                                                      self._logger)
+
+        # Check the geometry of the TIFF series against the files on disk
+        if compositeFileType == "Leica TIFF Series" or \
+                compositeFileType == "Generic TIFF Series":
+            self._validateTIFFSeriesGeometry(compositeFileType,
+                                             allSeriesMetadata,
+                                             seriesIndices,
+                                             channelFactory,
+                                             fullFolder)
+
+        # Register all series to the same dataset in a single pass?
+        if GlobalSettings.RegisterAllCompositeSeriesInOneDataset:
+            self._registerAllCompositeSeriesInOneDataset(compositeFileType,
+                                                         csvTable,
+                                                         allSeriesMetadata,
+                                                         seriesIndices,
+                                                         channelFactory,
+                                                         fullFolder,
+                                                         relativeFolder,
+                                                         name,
+                                                         openBISSample,
+                                                         sample,
+                                                         originalDataStorageFormat,
+                                                         thumbnailPolicy)
+            return
+
         # Register all series in the file
         image_data_set = None
         for i in range(num_series):
@@ -625,41 +682,14 @@ class Processor:
                               "Processing series " + str(seriesNum) + " of " + str(num_series))
 
             # Create a configuration object
-            if compositeFileType == "Leica TIFF Series":
-
-                compositeDatasetConfig = LeicaTIFFSeriesCompositeDatasetConfig(allSeriesMetadata,
-                                                                               seriesIndices,
-                                                                               self._logger,
-                                                                               seriesNum)
-
-            elif compositeFileType == "Generic TIFF Series":
-
-                compositeDatasetConfig = GenericTIFFSeriesCompositeDatasetConfig(allSeriesMetadata,
-                                                                                 seriesIndices,
-                                                                                 self._logger,
-                                                                                 seriesNum)
-
-            elif compositeFileType == "YouScope Experiment":
-
-                compositeDatasetConfig = YouScopeExperimentCompositeDatasetConfig(csvTable,
-                                                                                  allSeriesMetadata,
-                                                                                  seriesIndices,
-                                                                                  self._logger,
-                                                                                  seriesNum)
-
-            elif compositeFileType == "Visitron ND":
-
-                compositeDatasetConfig = VisitronNDCompositeDatasetConfig(allSeriesMetadata,
-                                                                          seriesIndices,
-                                                                          self._logger,
-                                                                          seriesNum)
-
-            else:
-
-                msg = "PROCESSOR::processMicroscopyCompositeFile(): " + \
-                      "Invalid composite file type found: " + compositeFileType
-                self._logger.error(msg)
-                raise Exception(msg)
+            compositeDatasetConfig = self._createCompositeDatasetConfig(compositeFileType,
+                                                                        csvTable,
+                                                                        allSeriesMetadata,
+                                                                        seriesIndices,
+                                                                        seriesNum,
+                                                                        channelFactory,
+                                                                        originalDataStorageFormat,
+                                                                        thumbnailPolicy)
 
             # Extract the metadata associated to this series and convert it to
             # XML to store it in the MICROSCOPY_IMG_CONTAINER_METADATA property
@@ -732,6 +762,236 @@ class Processor:
             dataset.establishSampleLinkForContainedDataSets()
             dataset.setSample(sample)
 
+    def _createCompositeDatasetConfig(self, compositeFileType, csvTable,
+                                      allSeriesMetadata, seriesIndices,
+                                      seriesNum, channelFactory,
+                                      originalDataStorageFormat=None,
+                                      thumbnailPolicy=None):
+        """Create the dataset configuration object for given composite file type.
+
+        @param compositeFileType One of "Leica TIFF Series", "Generic TIFF Series",
+               "YouScope Experiment", or "Visitron ND".
+        @param csvTable Table built by YouScopeExperimentCompositeDatasetConfig.buildImagesCSVTable()
+               (only used for YouScope experiments; None otherwise).
+        @param allSeriesMetadata List of metadata attributes for all series.
+        @param seriesIndices List of series indices.
+        @param seriesNum Number of the series to register, or -1 for all series.
+        @param channelFactory ChannelFactory shared by all configuration objects
+               of the composite file.
+        @param originalDataStorageFormat (optional) OriginalDataStorageFormat
+               for the original data; if None, the default of the configuration
+               object (UNCHANGED) is kept.
+        @param thumbnailPolicy (optional) ThumbnailPolicy to apply to the
+               configuration object.
+        @return MicroscopyCompositeDatasetConfig object
+        """
+
+        if compositeFileType == "Leica TIFF Series":
+
+            compositeDatasetConfig = LeicaTIFFSeriesCompositeDatasetConfig(allSeriesMetadata,
+                                                                           seriesIndices,
+                                                                           self._logger,
+                                                                           seriesNum,
+                                                                           channelFactory)
+
+        elif compositeFileType == "Generic TIFF Series":
+
+            compositeDatasetConfig = GenericTIFFSeriesCompositeDatasetConfig(allSeriesMetadata,
+                                                                             seriesIndices,
+                                                                             self._logger,
+                                                                             seriesNum,
+                                                                             channelFactory)
+
+        elif compositeFileType == "YouScope Experiment":
+
+            compositeDatasetConfig = YouScopeExperimentCompositeDatasetConfig(csvTable,
+                                                                              allSeriesMetadata,
+                                                                              seriesIndices,
+                                                                              self._logger,
+                                                                              seriesNum,
+                                                                              channelFactory)
+
+        elif compositeFileType == "Visitron ND":
+
+            compositeDatasetConfig = VisitronNDCompositeDatasetConfig(allSeriesMetadata,
+                                                                      seriesIndices,
+                                                                      self._logger,
+                                                                      seriesNum,
+                                                                      channelFactory)
+
+        else:
+
+            msg = "PROCESSOR::processMicroscopyCompositeFile(): " + \
+                  "Invalid composite file type found: " + compositeFileType
+            self._logger.error(msg)
+            raise Exception(msg)
+
+        if originalDataStorageFormat is not None:
+            compositeDatasetConfig.setOriginalDataStorageFormat(originalDataStorageFormat)
+
+        if thumbnailPolicy is not None:
+            thumbnailPolicy.applyTo(compositeDatasetConfig, int(seriesNum),
+                                    int(seriesIndices[0]))
+
+        return compositeDatasetConfig
+
+    def _getOriginalDataStorageFormat(self, compositeFileType, fullFolder):
+        """Return the OriginalDataStorageFormat for the composite file (folder)
+        as configured in plugin.properties:
+
+            original-data-storage-format.<type> = UNCHANGED | HDF5 | HDF5_COMPRESSED
+            original-data-storage-min-files.<type> = <number of files>
+
+        where <type> is the composite file type in lower case and with dashes
+        instead of spaces (e.g. youscope-experiment). The format is only applied
+        if the folder contains at least the given number of files.
+
+        @param compositeFileType Type of the composite file.
+        @param fullFolder Full path to the composite file (folder).
+        @return OriginalDataStorageFormat
+        """
+
+        key = compositeFileType.lower().replace(" ", "-")
+
+        # Requested format
+        formatName = self._properties.get("original-data-storage-format." + key,
+                                          "UNCHANGED").upper()
+        if formatName == "UNCHANGED":
+            return OriginalDataStorageFormat.UNCHANGED
+
+        if formatName == "HDF5":
+            storageFormat = OriginalDataStorageFormat.HDF5
+        elif formatName == "HDF5_COMPRESSED":
+            storageFormat = OriginalDataStorageFormat.HDF5_COMPRESSED
+        else:
+            self._logger.error("PROCESSOR::_getOriginalDataStorageFormat(): " +
+                               "Unknown original data storage format " +
+                               formatName + " for " + compositeFileType +
+                               ": falling back to UNCHANGED.")
+            return OriginalDataStorageFormat.UNCHANGED
+
+        # Minimum number of files
+        try:
+            minNumFiles = int(self._properties.get("original-data-storage-min-files." + key, "0"))
+        except ValueError:
+            minNumFiles = 0
+
+        # Count the files (we can stop as soon as the threshold is reached)
+        numFiles = 0
+        for root, folders, files in os.walk(fullFolder):
+            numFiles += len(files)
+            if numFiles >= minNumFiles:
+                break
+
+        if numFiles < minNumFiles:
+            self._logger.info("PROCESSOR::_getOriginalDataStorageFormat(): " +
+                              "Folder " + fullFolder + " contains fewer than " +
+                              str(minNumFiles) + " files: storing it UNCHANGED.")
+            return OriginalDataStorageFormat.UNCHANGED
+
+        self._logger.info("PROCESSOR::_getOriginalDataStorageFormat(): " +
+                          "Storing folder " + fullFolder + " as " + formatName + ".")
+
+        return storageFormat
+
+    def _validateTIFFSeriesGeometry(self, compositeFileType, allSeriesMetadata,
+                                    seriesIndices, channelFactory, fullFolder):
+        """Check size, pixel type and number of planes of the files of a
+        Leica or Generic TIFF series against the series metadata.
+
+        @see GlobalSettings.TIFFSeriesGeometryValidation
+        """
+
+        mode = GlobalSettings.TIFFSeriesGeometryValidation
+        if mode == "off":
+            return
+
+        # Create a configuration object for all series
+        compositeDatasetConfig = self._createCompositeDatasetConfig(compositeFileType,
+                                                                    None,
+                                                                    allSeriesMetadata,
+                                                                    seriesIndices,
+                                                                    -1,
+                                                                    channelFactory)
+
+        # Validate
+        errors = compositeDatasetConfig.validateGeometry(fullFolder)
+        if len(errors) == 0:
+            self._logger.info("PROCESSOR::processMicroscopyCompositeFile(): " +
+                              "Geometry of the files in " + fullFolder +
+                              " matches the series metadata.")
+            return
+
+        for error in errors:
+            self._logger.error("PROCESSOR::processMicroscopyCompositeFile(): " + error)
+
+        if mode == "fail":
+            msg = "PROCESSOR::processMicroscopyCompositeFile(): " + \
+                  "Geometry of the files in " + fullFolder + " does not " + \
+                  "match the series metadata (" + str(len(errors)) + " errors)."
+            self._logger.error(msg)
+            raise Exception(msg)
+
+    def _registerAllCompositeSeriesInOneDataset(self, compositeFileType, csvTable,
+                                                allSeriesMetadata, seriesIndices,
+                                                channelFactory, fullFolder,
+                                                relativeFolder, name,
+                                                openBISSample, sample,
+                                                originalDataStorageFormat=None,
+                                                thumbnailPolicy=None):
+        """Register all series of a composite file (folder) into a single
+        image dataset. openBIS scans the images in the folder only once and
+        the image metadata for all series is extracted in the same pass.
+
+        @see GlobalSettings.RegisterAllCompositeSeriesInOneDataset
+        """
+
+        # Log
+        self._logger.info("PROCESSOR::processCompositeMicroscopyFile(): " +
+                          "Creating new image dataset for folder " +
+                          str(fullFolder) + " and all " +
+                          str(len(allSeriesMetadata)) + " series.")
+
+        # Create a configuration object for all series
+        compositeDatasetConfig = self._createCompositeDatasetConfig(compositeFileType,
+                                                                    csvTable,
+                                                                    allSeriesMetadata,
+                                                                    seriesIndices,
+                                                                    -1,
+                                                                    channelFactory,
+                                                                    originalDataStorageFormat,
+                                                                    thumbnailPolicy)
+
+        # Create a dataset
+        dataset = self._transaction.createNewImageDataSet(compositeDatasetConfig,
+                                                          java.io.File(fullFolder))
+
+        # Store the metadata of the first series in the MICROSCOPY_IMG_CONTAINER_METADATA
+        # property (the viewer reads the geometry from it)
+        dataset.setPropertyValue("MICROSCOPY_IMG_CONTAINER_METADATA",
+                                 self.dictToXML(allSeriesMetadata[0]))
+
+        # The dataset contains all series: use the composite file name
+        dataset.setPropertyValue("$NAME", name)
+
+        # Register the accessory files for YouScope experiments
+        if compositeFileType == "YouScope Experiment":
+            YouScopeExperimentCompositeDatasetConfig.registerAccessoryFilesAsDatasets(
+                fullFolder,
+                relativeFolder,
+                self._transaction,
+                openBISSample,
+                sample,
+                dataset,
+                self._logger)
+
+        # Move the folder
+        self._transaction.moveFile(fullFolder, dataset)
+
+        # Set the sample
+        dataset.establishSampleLinkForContainedDataSets()
+        dataset.setSample(sample)
+
     def register(self, tree):
         """Register the Experiment using the parsed properties file.
 
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+import os
+import struct
+
+
+class TIFFHeaderScanner:
+    """The TIFFHeaderScanner class reads the geometry (size, pixel type and
+    number of pages) of TIFF and BigTIFF files from their image file
+    directories (IFDs) only, without decoding any pixel data and without
+    going through the bio-formats stack.
+
+    Only the first IFD is parsed; for all following IFDs only the number
+    of entries and the offset of the next IFD are read, so that scanning
+    a file costs a few small seek-and-read operations per page."""
+
+    _DEBUG = False
+
+    # TIFF tags
+    _TAG_IMAGE_WIDTH = 256
+    _TAG_IMAGE_LENGTH = 257
+    _TAG_BITS_PER_SAMPLE = 258
+    _TAG_SAMPLES_PER_PIXEL = 277
+    _TAG_SAMPLE_FORMAT = 339
+
+    # Size in bytes and struct format of the TIFF field types we need to read
+    _FIELD_TYPES = {
+        1: (1, "B"),   # BYTE
+        3: (2, "H"),   # SHORT
+        4: (4, "I"),   # LONG
+        8: (2, "h"),   # SSHORT
+        9: (4, "i"),   # SLONG
+        13: (4, "I"),  # IFD
+        16: (8, "Q"),  # LONG8 (BigTIFF)
+        17: (8, "q"),  # SLONG8 (BigTIFF)
+        18: (8, "Q")   # IFD8 (BigTIFF)
+    }
+
+    # Sample format names (TIFF SampleFormat tag)
+    _SAMPLE_FORMATS = {1: "uint", 2: "int", 3: "float"}
+
+    # Upper limit on the number of pages (protects against IFD loops)
+    _MAX_PAGES = 1000000
+
+    def __init__(self, logger):
+        """Constructor.
+
+        @param logger: logger object
+        """
+
+        # Store the logger
+        self._logger = logger
+
+    def scan(self, filePath):
+        """Scan the header of a TIFF or BigTIFF file.
+
+        @param filePath Full path to the file to scan.
+
+        Returns a dictionary with keys sizeX, sizeY, bitsPerSample,
+        samplesPerPixel, pixelType (e.g. "uint16"), numPages and bigTIFF.
+        Raises an Exception if the file is not a valid TIFF file.
+        """
+
+        f = open(filePath, "rb")
+        try:
+
+            # Byte order
+            header = f.read(16)
+            if len(header) < 8:
+                self._fail(filePath, "file too short")
+            if header[0:2] == "II":
+                bo = "<"
+            elif header[0:2] == "MM":
+                bo = ">"
+            else:
+                self._fail(filePath, "invalid byte order mark")
+
+            # Classic TIFF or BigTIFF
+            magic = struct.unpack(bo + "H", header[2:4])[0]
+            if magic == 42:
+                bigTIFF = False
+                offset = struct.unpack(bo + "I", header[4:8])[0]
+                countFormat, countSize = "H", 2
+                offsetFormat, offsetSize = "I", 4
+                entrySize = 12
+            elif magic == 43:
+                bigTIFF = True
+                if len(header) < 16 or struct.unpack(bo + "H", header[4:6])[0] != 8:
+                    self._fail(filePath, "unsupported BigTIFF offset size")
+                offset = struct.unpack(bo + "Q", header[8:16])[0]
+                countFormat, countSize = "Q", 8
+                offsetFormat, offsetSize = "Q", 8
+                entrySize = 20
+            else:
+                self._fail(filePath, "invalid magic number " + str(magic))
+
+            # Walk the IFD chain
+            tags = None
+            numPages = 0
+            visited = set()
+            while offset != 0:
+
+                if offset in visited or numPages >= self._MAX_PAGES:
+                    self._fail(filePath, "corrupted IFD chain")
+                visited.add(offset)
+
+                f.seek(offset)
+                data = f.read(countSize)
+                if len(data) != countSize:
+                    self._fail(filePath, "truncated IFD at offset " + str(offset))
+                numEntries = struct.unpack(bo + countFormat, data)[0]
+
+                if tags is None:
+
+                    # Parse the entries of the first IFD
+                    entries = f.read(numEntries * entrySize)
+                    if len(entries) != numEntries * entrySize:
+                        self._fail(filePath, "truncated IFD at offset " + str(offset))
+                    tags = self._parseEntries(f, bo, entries, numEntries, bigTIFF)
+
+                else:
+
+                    # Skip the entries of all other IFDs
+                    f.seek(offset + countSize + numEntries * entrySize)
+
+                numPages += 1
+
+                # Offset of the next IFD
+                data = f.read(offsetSize)
+                if len(data) != offsetSize:
+                    self._fail(filePath, "truncated IFD at offset " + str(offset))
+                offset = struct.unpack(bo + offsetFormat, data)[0]
+
+        finally:
+            f.close()
+
+        if tags is None:
+            self._fail(filePath, "no image file directory found")
+
+        if self._TAG_IMAGE_WIDTH not in tags or self._TAG_IMAGE_LENGTH not in tags:
+            self._fail(filePath, "missing image dimensions")
+
+        bitsPerSample = tags.get(self._TAG_BITS_PER_SAMPLE, 1)
+        sampleFormat = tags.get(self._TAG_SAMPLE_FORMAT, 1)
+        pixelType = self._SAMPLE_FORMATS.get(sampleFormat, "unknown") + str(bitsPerSample)
+
+        info = {
+            "sizeX": tags[self._TAG_IMAGE_WIDTH],
+            "sizeY": tags[self._TAG_IMAGE_LENGTH],
+            "bitsPerSample": bitsPerSample,
+            "samplesPerPixel": tags.get(self._TAG_SAMPLES_PER_PIXEL, 1),
+            "pixelType": pixelType,
+            "numPages": numPages,
+            "bigTIFF": bigTIFF
+        }
+
+        if self._DEBUG:
+            self._logger.info("TIFFHEADERSCANNER::scan(): " + filePath +
+                              ": " + str(info))
+
+        return info
+
+    def validateSeries(self, filePaths, seriesMetadata, seriesName=""):
+        """Check that the TIFF files of a series have the same geometry and
+        that this geometry agrees with the series metadata.
+
+        The width and height of all files must match sizeX and sizeY, all
+        files must have the same pixel type, and the total number of pages
+        must match sizeZ * sizeC * sizeT.
+
+        @param filePaths List of full paths to the files of the series.
+        @param seriesMetadata Metadata attributes of the series.
+        @param seriesName (optional) Name of the series for the messages.
+
+        Returns a list of error messages (empty if the series is consistent).
+        """
+
+        errors = []
+
+        if len(filePaths) == 0:
+            errors.append("Series " + seriesName + " does not contain any file.")
+            return errors
+
+        # Scan all files
+        numPages = 0
+        pixelType = None
+        for filePath in filePaths:
+
+            try:
+                info = self.scan(filePath)
+            except Exception, e:
+                errors.append(str(e))
+                continue
+
+            numPages += info["numPages"]
+
+            # Pixel type
+            if pixelType is None:
+                pixelType = info["pixelType"]
+            elif info["pixelType"] != pixelType:
+                errors.append("File " + filePath + " has pixel type " +
+                              info["pixelType"] + " (expected " + pixelType + ").")
+
+            # Size
+            for key in ["sizeX", "sizeY"]:
+                expected = self._getInt(seriesMetadata, key)
+                if expected is not None and info[key] != expected:
+                    errors.append("File " + filePath + " has " + key + " = " +
+                                  str(info[key]) + " (expected " + str(expected) + ").")
+
+        # Number of planes
+        sizeZ = self._getInt(seriesMetadata, "sizeZ")
+        sizeC = self._getInt(seriesMetadata, "sizeC")
+        sizeT = self._getInt(seriesMetadata, "sizeT")
+        if sizeZ is not None and sizeC is not None and sizeT is not None:
+            expectedPages = sizeZ * sizeC * sizeT
+            if numPages != expectedPages:
+                errors.append("Series " + seriesName + " contains " + str(numPages) +
+                              " planes on disk, but sizeZ * sizeC * sizeT = " +
+                              str(sizeZ) + " * " + str(sizeC) + " * " + str(sizeT) +
+                              " = " + str(expectedPages) + ".")
+
+        return errors
+
+    def validateFolder(self, fullFolder, seriesNumFromFileName,
+                       allSeriesMetadata, seriesIndices):
+        """Check the geometry of all TIFF files in a composite folder against
+        the metadata of the series they belong to.
+
+        @param fullFolder Full path to the composite folder.
+        @param seriesNumFromFileName Function that returns the series number
+               encoded in a file name relative to fullFolder (or -1 if the
+               file name cannot be interpreted).
+        @param allSeriesMetadata List of metadata attributes for all series.
+        @param seriesIndices List of series indices (int) in the same order
+               as allSeriesMetadata.
+
+        Returns a list of error messages (empty if the folder is consistent).
+        """
+
+        errors = []
+
+        # Collect the TIFF files per series
+        filesPerSeries = {}
+        for root, folders, files in os.walk(fullFolder):
+            for fileName in files:
+                if not fileName.lower().endswith((".tif", ".tiff")):
+                    continue
+                fullPath = os.path.join(root, fileName)
+                relativePath = fullPath[len(fullFolder):].lstrip(os.sep)
+                series = seriesNumFromFileName(relativePath)
+                if series not in seriesIndices:
+                    errors.append("File " + relativePath + " does not belong " +
+                                  "to any known series.")
+                    continue
+                filesPerSeries.setdefault(series, []).append(fullPath)
+
+        # Validate all series
+        for i in range(len(seriesIndices)):
+            series = seriesIndices[i]
+            errors.extend(self.validateSeries(filesPerSeries.get(series, []),
+                                              allSeriesMetadata[i],
+                                              str(series)))
+
+        return errors
+
+    def _parseEntries(self, f, bo, entries, numEntries, bigTIFF):
+        """Extract the (first) value of the tags of interest from the raw
+        entries of an IFD."""
+
+        wanted = [self._TAG_IMAGE_WIDTH, self._TAG_IMAGE_LENGTH,
+                  self._TAG_BITS_PER_SAMPLE, self._TAG_SAMPLES_PER_PIXEL,
+                  self._TAG_SAMPLE_FORMAT]
+
+        if bigTIFF:
+            entrySize, headerFormat, valueSize, offsetFormat = 20, "HHQ", 8, "Q"
+        else:
+            entrySize, headerFormat, valueSize, offsetFormat = 12, "HHI", 4, "I"
+
+        tags = {}
+        for i in range(numEntries):
+
+            start = i * entrySize
+            tag, fieldType, count = struct.unpack(bo + headerFormat,
+                                                  entries[start:start + entrySize - valueSize])
+            if tag not in wanted or fieldType not in self._FIELD_TYPES or count == 0:
+                continue
+
+            size, fmt = self._FIELD_TYPES[fieldType]
+            value = entries[start + entrySize - valueSize:start + entrySize]
+
+            if size * count > valueSize:
+
+                # The value does not fit in the entry: it is stored at an offset
+                # (we only need the first element, e.g. of BitsPerSample)
+                position = f.tell()
+                f.seek(struct.unpack(bo + offsetFormat, value)[0])
+                value = f.read(size)
+                f.seek(position)
+
+            tags[tag] = struct.unpack(bo + fmt, value[0:size])[0]
+
+        return tags
+
+    def _getInt(self, metadata, key):
+        """Return metadata[key] as int, or None if missing or not a number."""
+
+        try:
+            return int(float(metadata[key]))
+        except:
+            return None
+
+    def _fail(self, filePath, reason):
+        """Log and raise an error for an invalid file."""
+
+        err = "TIFFHEADERSCANNER::scan(): " + \
+            "Invalid TIFF file " + str(filePath) + ": " + reason + "."
+        self._logger.error(err)
+        raise Exception(err)
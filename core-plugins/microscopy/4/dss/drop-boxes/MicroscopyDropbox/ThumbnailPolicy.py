@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+from ch.systemsx.cisd.openbis.dss.etl.dto.api.impl import MaximumIntensityProjectionGenerationAlgorithm
+from GlobalSettings import GlobalSettings
+
+
+class ThumbnailPolicy:
+    """The ThumbnailPolicy class decides if, for which series and at which
+    sizes thumbnails are generated for a dataset, and applies this decision
+    to the dataset configuration objects of all supported file types.
+
+    Thumbnails are either created at registration time by the dropbox, or
+    deferred to the microscopy_thumbnails_creation maintenance task, so that
+    registration is never blocked by thumbnail generation.
+
+    The policies are configured per file type in GlobalSettings.ThumbnailPolicies
+    and are always deferred for datasets larger than
+    GlobalSettings.ThumbnailInlineMaxDatasetSize. The series, maxPlanes and
+    sizes of a policy only apply to thumbnails created at registration time:
+    deferred thumbnails are configured in the maintenance task."""
+
+    _DEBUG = False
+
+    # Series that get thumbnails: "first", "all" or "none"
+    _series = "first"
+
+    # Maximum number of planes per channel read for the representative
+    # thumbnail (0 to read all planes)
+    _maxPlanes = 0
+
+    # Thumbnail sizes (the first one is used for the representative thumbnail)
+    _sizes = [256]
+
+    # Defer thumbnail generation to the maintenance task
+    _defer = True
+
+    # Logger
+    _logger = None
+
+    def __init__(self, logger, series="first", maxPlanes=0, sizes=None, defer=True):
+        """Constructor.
+
+        @param logger: logger object
+        @param series: series that get thumbnails: "first", "all" or "none".
+        @param maxPlanes: maximum number of planes per channel to read for the
+                          representative thumbnail (0 to read all planes).
+        @param sizes: list of thumbnail sizes in pixels, e.g. [256]; the first
+                      one is used for the representative thumbnail.
+        @param defer: if True, thumbnail generation is left to the
+                      microscopy_thumbnails_creation maintenance task.
+        """
+
+        # Store the logger
+        self._logger = logger
+
+        if series not in ["first", "all", "none"]:
+            err = "THUMBNAILPOLICY::__init__(): " + \
+                  "Invalid value for series: " + str(series) + "!"
+            self._logger.error(err)
+            raise Exception(err)
+
+        if sizes is None or len(sizes) == 0:
+            sizes = [256]
+
+        self._series = series
+        self._maxPlanes = int(maxPlanes)
+        self._sizes = map(int, sizes)
+        self._defer = defer
+
+    @staticmethod
+    def forFileType(fileType, datasetSize, logger):
+        """Create the thumbnail policy for given file type and dataset size
+        from the settings in GlobalSettings.
+
+        @param fileType: "Microscopy File" or the composite file type
+                         (e.g. "YouScope Experiment").
+        @param datasetSize: size of the dataset in bytes (None if unknown).
+        @param logger: logger object
+        @return ThumbnailPolicy object
+        """
+
+        # Start from the default settings and override with the file type ones
+        settings = dict(GlobalSettings.ThumbnailPolicies.get("default", {}))
+        settings.update(GlobalSettings.ThumbnailPolicies.get(fileType, {}))
+
+        policy = ThumbnailPolicy(logger,
+                                 settings.get("series", "first"),
+                                 settings.get("maxPlanes", 0),
+                                 settings.get("sizes", [256]),
+                                 settings.get("defer", True))
+
+        # Large datasets never get their thumbnails at registration time
+        if datasetSize is not None:
+            try:
+                if int(datasetSize) > GlobalSettings.ThumbnailInlineMaxDatasetSize:
+                    policy._defer = True
+            except ValueError:
+                pass
+
+        logger.info("THUMBNAILPOLICY::forFileType(): " + fileType + ": " + str(policy))
+
+        return policy
+
+    def generatesThumbnailsForSeries(self, seriesNum, firstSeriesNum=0):
+        """Return True if the series gets thumbnails.
+
+        @param seriesNum: number of the series (-1 for all series).
+        @param firstSeriesNum: number of the first series in the file.
+        """
+
+        if self._series == "none":
+            return False
+
+        if self._series == "all" or seriesNum == -1:
+            return True
+
+        return seriesNum == firstSeriesNum
+
+    def applyTo(self, datasetConfig, seriesNum, firstSeriesNum=0):
+        """Configure thumbnail generation for the dataset configuration object
+        of a series.
+
+        @param datasetConfig: dataset configuration object (SimpleImageContainerDataConfig).
+        @param seriesNum: number of the series (-1 for all series).
+        @param firstSeriesNum: number of the first series in the file.
+        """
+
+        # Thumbnails are never generated by ImageMagick
+        datasetConfig.setUseImageMagicToGenerateThumbnails(False)
+
+        if self._defer or not self.generatesThumbnailsForSeries(seriesNum, firstSeriesNum):
+            datasetConfig.setGenerateThumbnails(False)
+            if self._DEBUG:
+                self._logger.info("THUMBNAILPOLICY::applyTo(): " +
+                                  "No thumbnails generated for series " +
+                                  str(seriesNum) + " at registration.")
+            return
+
+        # Thumbnails at the requested resolutions
+        datasetConfig.setGenerateThumbnails(True)
+        datasetConfig.setGenerateImageRepresentationsUsingImageResolutions(
+            [str(size) + "x" + str(size) for size in self._sizes])
+
+        # Representative thumbnail (MIP) for the first series only
+        if seriesNum == -1 or seriesNum == firstSeriesNum:
+            datasetConfig.setImageGenerationAlgorithm(
+                PlaneLimitedMaximumIntensityProjectionGenerationAlgorithm(
+                    "MICROSCOPY_IMG_THUMBNAIL", self._sizes[0], self._sizes[0],
+                    "thumbnail.png", self._maxPlanes))
+
+        if self._DEBUG:
+            self._logger.info("THUMBNAILPOLICY::applyTo(): " +
+                              "Generating thumbnails at sizes " +
+                              str(self._sizes) + " for series " +
+                              str(seriesNum) + ".")
+
+    def __str__(self):
+        return "series = " + self._series + ", maxPlanes = " + \
+            str(self._maxPlanes) + ", sizes = " + str(self._sizes) + \
+            ", defer = " + str(self._defer)
+
+
+class PlaneLimitedMaximumIntensityProjectionGenerationAlgorithm(MaximumIntensityProjectionGenerationAlgorithm):
+    """
+    MaximumIntensityProjectionGenerationAlgorithm that reads at most maxPlanes
+    planes per channel to create the representative thumbnail.
+    """
+
+    def __init__(self, datasetTypeCode, width, height, filename, maxPlanes=0):
+        """
+        Constructor
+        """
+
+        # Call the parent base constructor
+        MaximumIntensityProjectionGenerationAlgorithm.__init__(self,
+            datasetTypeCode, width, height, filename)
+
+        # Maximum number of planes per channel (0 for all)
+        self.maxPlanes = maxPlanes
+
+        # Number of planes accepted so far per channel
+        self.planesPerChannel = {}
+
+    def generateImages(self, information, thumbnailDatasets, imageProvider):
+        self.planesPerChannel = {}
+        return super(PlaneLimitedMaximumIntensityProjectionGenerationAlgorithm, self).generateImages(information, thumbnailDatasets, imageProvider)
+
+    def imageToBeIgnored(self, image):
+        """
+        Extends the parent imageToBeIgnored method by ignoring all planes of
+        a channel beyond the first maxPlanes ones.
+        """
+
+        if super(PlaneLimitedMaximumIntensityProjectionGenerationAlgorithm, self).imageToBeIgnored(image):
+            return True
+
+        if self.maxPlanes <= 0:
+            return False
+
+        channelCode = image.getChannelCode()
+        numPlanes = self.planesPerChannel.get(channelCode, 0)
+        if numPlanes >= self.maxPlanes:
+            return True
+
+        self.planesPerChannel[channelCode] = numPlanes + 1
+        return False
@@ -7,9 +7,9 @@ Created on Feb 20, 2014
 """
 
 import re
-import random
 import math
 from MicroscopyCompositeDatasetConfig import MicroscopyCompositeDatasetConfig
+from ChannelFactory import ChannelFactory
 from ch.systemsx.cisd.openbis.dss.etl.dto.api.impl import MaximumIntensityProjectionGenerationAlgorithm
 from ch.systemsx.cisd.openbis.dss.etl.dto.api import ChannelColor
 from ch.systemsx.cisd.openbis.dss.etl.dto.api import ImageIdentifier
@@ -50,6 +50,9 @@ class VisitronNDCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
     # Logger
     _logger = None
 
+    # Channel factory (shared by the configurations of all series in the folder)
+    _channelFactory = None
+
     # Metadata folder
     _metadataFolder = ""
 
@@ -65,7 +68,7 @@ class VisitronNDCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
                           '(\.tif{1,2}|\.stk)$',  # File extension
                           re.IGNORECASE | re.UNICODE)
 
-    def __init__(self, allSeriesMetadata, seriesIndices, logger, seriesNum=0):
+    def __init__(self, allSeriesMetadata, seriesIndices, logger, seriesNum=0, channelFactory=None):
         """Constructor.
 
         @param allSeriesMetadata: list of metadata attributes generated either
@@ -79,12 +82,23 @@ class VisitronNDCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
         @param seriesNum:         Int Number of the series to register. All
                                   other series in the file will be ignored.
                                   seriesNum MUST BE CONTAINED in seriesIndices.
+                                  Set to -1 to register all series to the
+                                  same dataset.
         @param logger:            logger object
+        @param channelFactory:    (optional) ChannelFactory shared by the
+                                  configuration objects of all series in
+                                  the folder. If omitted, a private one is
+                                  created.
         """
 
         # Store the logger
         self._logger = logger
 
+        # Store the channel factory
+        if channelFactory is None:
+            channelFactory = ChannelFactory(logger)
+        self._channelFactory = channelFactory
+
         # Inform
         if self._DEBUG:
             self._logger.info("Initializing VISITRONNDCOMPOSITEDATASETCONFIG for series number " + str(seriesNum))
@@ -100,7 +114,8 @@ class VisitronNDCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
         # Store the series number: make sure that it belongs to seriesIndices
         self._seriesNum = int(seriesNum)
         try:
-            self._seriesIndices.index(self._seriesNum)
+            if self._seriesNum != -1:
+                self._seriesIndices.index(self._seriesNum)
         except:
             raise(Exception("seriesNum (" + str(self._seriesNum) + ") MUST be contained " +
                             "in seriesIndices " + str(self._seriesIndices) + "!"))
@@ -114,9 +129,6 @@ class VisitronNDCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
         # Set the image library
         self.setImageLibrary("BioFormats")
 
-        # Disable thumbnail generation by ImageMagick
-        self.setUseImageMagicToGenerateThumbnails(False)
-
         # Set the recognized extensions
         self.setRecognizedImageExtensions(["tif", "tiff", "stk"])
 
@@ -131,24 +143,9 @@ class VisitronNDCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
         @param channelCode Code of the channel as generated by extractImagesMetadata().
         """
 
-        # Get the indices of series and channel from the channel code
-        (seriesIndx, channelIndx) = self._getSeriesAndChannelNumbers(channelCode)
-
-        # Get the channel name
-        name = self._getChannelName(seriesIndx, channelIndx)
-
-        # Get the channel color (RGB)
-        colorRGB = self._getChannelColor(seriesIndx, channelIndx)
-
-        if self._DEBUG:
-            self._logger.info("VISITRONNDCOMPOSITEDATASETCONFIG::createChannel(): " +
-                              "channel (s = " + str(seriesIndx) + ", c = " +
-                              str(channelIndx) + ") has code " + channelCode +
-                              ", color (" + str(colorRGB) + " and name " + name)
-
-        # Return the channel with given name and color (the code is set to
-        # be the same as the channel name).
-        return Channel(channelCode, name, colorRGB)
+        # Return the (cached) channel with given name and color (the code
+        # is set to be the same as the channel name).
+        return self._channelFactory.createChannel(channelCode, self)
 
     def extractImagesMetadata(self, imagePath, imageIdentifiers):
         """Overrides extractImageMetadata method making sure to store
@@ -194,7 +191,7 @@ class VisitronNDCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
             self._logger.info("Found file " + imagePath + " in series " + str(series))
 
         # Make sure to process only the relevant series
-        if series != self._seriesNum:
+        if self._seriesNum != -1 and series != self._seriesNum:
             return []
 
         # Get current metadata
@@ -373,10 +370,7 @@ class VisitronNDCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
 
         if color is not None:
             # The color is already in the 0 .. 255 range
-            color = color.split(",")
-            R = int(float(color[0]))
-            G = int(float(color[1]))
-            B = int(float(color[2]))
+            (R, G, B) = self._channelFactory.parseColor(color)
         else:
             if channelIndx == 0:
                 R = 255
@@ -391,9 +385,7 @@ class VisitronNDCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
                 G = 0
                 B = 255
             else:
-                R = random.randint(0, 255)
-                G = random.randint(0, 255)
-                B = random.randint(0, 255)
+                (R, G, B) = ChannelFactory.fallbackColor(channelIndx)
 
         # Work around an issue if all color components are 0
         if R == G == B == 0:
@@ -402,8 +394,8 @@ class VisitronNDCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
             B = 255
             self._logger.info("Color changed from (0, 0, 0) to (255, 255, 255)")
 
-        # Create the ChannelColorRGB object
-        colorRGB = ChannelColorRGB(R, G, B)
+        # Get the (shared) ChannelColorRGB object
+        colorRGB = self._channelFactory.getColor(R, G, B)
 
         # Return it
         return colorRGB
@@ -416,25 +408,9 @@ class VisitronNDCompositeDatasetConfig(MicroscopyCompositeDatasetConfig):
         @param channelCode Code of the channel as generated by extractImagesMetadata().
         """
 
-        p = re.compile("SERIES-(\d+)_CHANNEL-(\d+)")
-        m = p.match(channelCode)
-        if m is None or len(m.groups()) != 2:
-            err = "YOUSCOPEEXPERMENTCOMPOSITEDATASETCONFIG::_getSeriesAndChannelNumbers(): " + \
-            "Could not extract series and channel number!"
-            self._logger.error(err)
-            raise Exception(err)
-
-        # Now assign the indices
-        seriesIndx = int(m.group(1))
-        channelIndx = int(m.group(2))
-
-        if self._DEBUG:
-            self._logger.info("Current channel code " + channelCode + \
-                              " corresponds to series = " + str(seriesIndx) + \
-                              " and channel = " + str(channelIndx))
-
-        # Return them
-        return seriesIndx, channelIndx
+        # The channel code pattern is compiled (and the result cached) once
+        # for all series by the channel factory
+        return self._channelFactory.getSeriesAndChannelNumbers(channelCode)
 
     def _seriesNumFromFileName(self, fileName):
         """
@@ -7,12 +7,12 @@ Created on Feb 20, 2014
 """
 
 import re
-import random
 import math
 from os import listdir
 from os.path import isfile
 from os.path import join
 from MicroscopyCompositeDatasetConfig import MicroscopyCompositeDatasetConfig
+from ChannelFactory import ChannelFactory
 from ch.systemsx.cisd.openbis.dss.etl.dto.api import ChannelColor
 from ch.systemsx.cisd.openbis.dss.etl.dto.api import ImageIdentifier
 from ch.systemsx.cisd.openbis.dss.etl.dto.api import ImageMetadata
@@ -59,6 +59,9 @@ class YouScopeExperimentCompositeDatasetConfig(MicroscopyCompositeDatasetConfig)
     # Logger
     _logger = None
 
+    # Channel factory (shared by the configurations of all series in the folder)
+    _channelFactory = None
+
     # Dataset base name
     _basename = ""
 
@@ -81,7 +84,7 @@ class YouScopeExperimentCompositeDatasetConfig(MicroscopyCompositeDatasetConfig)
     _pattern_pos_name_fb = re.compile(r'.*\(pos_(?P<pos>\d*)\).*$',
                                       re.IGNORECASE | re.UNICODE)
 
-    def __init__(self, csvTable, allSeriesMetadata, seriesIndices, logger, seriesNum=0):
+    def __init__(self, csvTable, allSeriesMetadata, seriesIndices, logger, seriesNum=0, channelFactory=None):
         """Constructor.
 
         @param csvTable:          (linked hash) map of the rows from the images.csv file as processed
@@ -97,12 +100,23 @@ class YouScopeExperimentCompositeDatasetConfig(MicroscopyCompositeDatasetConfig)
         @param seriesNum:         Int Number of the series to register. All
                                   other series in the file will be ignored.
                                   seriesNum MUST BE CONTAINED in seriesIndices.
+                                  Set to -1 to register all series to the
+                                  same dataset.
         @param logger:            logger object
+        @param channelFactory:    (optional) ChannelFactory shared by the
+                                  configuration objects of all series in
+                                  the folder. If omitted, a private one is
+                                  created.
         """
 
         # Store the logger
         self._logger = logger
 
+        # Store the channel factory
+        if channelFactory is None:
+            channelFactory = ChannelFactory(logger)
+        self._channelFactory = channelFactory
+
         # Store the csvTable
         self._csvTable = csvTable
 
@@ -124,7 +138,8 @@ class YouScopeExperimentCompositeDatasetConfig(MicroscopyCompositeDatasetConfig)
         # Store the series number: make sure that it belongs to seriesIndices
         self._seriesNum = int(seriesNum)
         try:
-            self._seriesIndices.index(self._seriesNum)
+            if self._seriesNum != -1:
+                self._seriesIndices.index(self._seriesNum)
         except:
             raise(Exception("seriesNum (" + str(self._seriesNum) + ") MUST be contained " + \
                             "in seriesIndices " + str(self._seriesIndices) + "!"))
@@ -138,9 +153,6 @@ class YouScopeExperimentCompositeDatasetConfig(MicroscopyCompositeDatasetConfig)
         # Set the image library
         self.setImageLibrary("BioFormats")
 
-        # Disable thumbnail generation by ImageMagick
-        self.setUseImageMagicToGenerateThumbnails(False)
-
         # Set the recognized extensions -- currently just tif(f)
         self.setRecognizedImageExtensions(["tif", "tiff"])
 
@@ -155,24 +167,9 @@ class YouScopeExperimentCompositeDatasetConfig(MicroscopyCompositeDatasetConfig)
         @param channelCode Code of the channel as generated by extractImagesMetadata().
         """
 
-        # Get the indices of series and channel from the channel code
-        (seriesIndx, channelIndx) = self._getSeriesAndChannelNumbers(channelCode)
-
-        # Get the channel name
-        name = self._getChannelName(seriesIndx, channelIndx)
-
-        # Get the channel color (RGB)
-        colorRGB = self._getChannelColor(seriesIndx, channelIndx)
-
-        if self._DEBUG:
-            self._logger.info("YOUSCOPEEXPERIMENTCOMPOSITEDATASETCONFIG::createChannel(): " +
-                              "channel (s = " + str(seriesIndx) + ", c = " +
-                              str(channelIndx) + ") has code " + channelCode +
-                              ", color (" + str(colorRGB) + " and name " + name)
-
-        # Return the channel with given name and color (the code is set to
-        # be the same as the channel name).
-        return Channel(channelCode, name, colorRGB)
+        # Return the (cached) channel with given name and color (the code
+        # is set to be the same as the channel name).
+        return self._channelFactory.createChannel(channelCode, self)
 
     def extractImagesMetadata(self, imagePath, imageIdentifiers):
         """Overrides extractImageMetadata method making sure to store
@@ -274,7 +271,7 @@ class YouScopeExperimentCompositeDatasetConfig(MicroscopyCompositeDatasetConfig)
             self._logger.info("Series with ID " + seriesID + " corresponds to series number " + str(series))
 
         # Make sure to process only the relevant series
-        if series != self._seriesNum:
+        if self._seriesNum != -1 and series != self._seriesNum:
             return []
 
         # Get channel index from channel name
@@ -367,10 +364,7 @@ class YouScopeExperimentCompositeDatasetConfig(MicroscopyCompositeDatasetConfig)
             color = None
 
         if color is not None:
-            color = color.split(",")
-            R = int(255 * float(color[0]))
-            G = int(255 * float(color[1]))
-            B = int(255 * float(color[2]))
+            (R, G, B) = self._channelFactory.parseColor(color, 255.0)
         else:
 
             # If there is only one channel in the whole dataset,
@@ -411,9 +405,7 @@ class YouScopeExperimentCompositeDatasetConfig(MicroscopyCompositeDatasetConfig)
                     G = 255
                     B = 255
                 else:
-                    R = random.randint(0, 255)
-                    G = random.randint(0, 255)
-                    B = random.randint(0, 255)
+                    (R, G, B) = ChannelFactory.fallbackColor(channelIndx)
 
         # Work around an issue if all color components are 0
         if R == G == B == 0:
@@ -422,8 +414,8 @@ class YouScopeExperimentCompositeDatasetConfig(MicroscopyCompositeDatasetConfig)
             B = 255
             self._logger.info("Color changed from (0, 0, 0) to (255, 255, 255)")
 
-        # Create the ChannelColorRGB object
-        colorRGB = ChannelColorRGB(R, G, B)
+        # Get the (shared) ChannelColorRGB object
+        colorRGB = self._channelFactory.getColor(R, G, B)
 
         # Return it
         return colorRGB
@@ -436,25 +428,9 @@ class YouScopeExperimentCompositeDatasetConfig(MicroscopyCompositeDatasetConfig)
         @param channelCode Code of the channel as generated by extractImagesMetadata().
         """
 
-        p = re.compile("SERIES-(\d+)_CHANNEL-(\d+)")
-        m = p.match(channelCode)
-        if m is None or len(m.groups()) != 2:
-            err = "YOUSCOPEEXPERMENTCOMPOSITEDATASETCONFIG::_getSeriesAndChannelNumbers(): " + \
-            "Could not extract series and channel number!"
-            self._logger.error(err)
-            raise Exception(err)
-
-        # Now assign the indices
-        seriesIndx = int(m.group(1))
-        channelIndx = int(m.group(2))
-
-        if self._DEBUG:
-            self._logger.info("Current channel code " + channelCode + \
-                              " corresponds to series = " + str(seriesIndx) + \
-                              " and channel = " + str(channelIndx))
-
-        # Return them
-        return seriesIndx, channelIndx
+        # The channel code pattern is compiled (and the result cached) once
+        # for all series by the channel factory
+        return self._channelFactory.getSeriesAndChannelNumbers(channelCode)
 
     def _getChannelNumber(self, metadata, name):
         """
@@ -0,0 +1,546 @@
+# -*- coding: utf-8 -*-
+
+'''
+Dropbox that generates a chunked, multiscale image pyramid for a large series
+(MICROSCOPY_IMG_CONTAINER dataset) of a microscopy file.
+
+The microscopy_thumbnails_creation maintenance task queues a request for
+every large series once the thumbnail of its file is generated (i.e. shortly
+after registration, see _PYRAMID_REQUESTS_DIR in generate_thumbnails.py) by
+creating an (empty) file named after the code of the MICROSCOPY_IMG_CONTAINER
+in the incoming folder of this dropbox. The dropbox processes the requests
+one at a time, so at most one pyramid is written at any time and never twice for the
+same series (a series that already has a pyramid is skipped).
+
+The pyramid is written directly into a new MICROSCOPY_IMG_PYRAMID dataset
+(child of the MICROSCOPY_IMG_CONTAINER, in the same sample) with the following
+layout,
+modelled on OME-Zarr but with losslessly compressed PNG chunks (8 or 16 bit
+grayscale) that can be downloaded individually from the datastore server:
+
+    pyramid/pyramid.json
+    pyramid/<level>/<t>/<c>/<z>/<row>_<col>.png
+
+Level 0 is the full resolution; every further level is downsampled by 2 in
+x and y (mean of 2x2 pixels), down to the level that fits in one chunk.
+pyramid.json describes the geometry of the series and of all levels. Signed
+pixel types are stored with an offset (the "offset" in pyramid.json, e.g.
+32768 for int16) that must be subtracted from the stored values.
+
+The planes are read in strips of one chunk row with bio-formats, so that the
+memory needed is bounded by a few strips of the full width of the series,
+independently of the size of the planes and of the number of planes.
+
+Only series of single microscopy files are supported (not composite series
+stored in folders, nor files stored in HDF5 containers).
+'''
+
+from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto import SearchCriteria
+from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto import SearchSubCriteria
+from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto.SearchCriteria import MatchClause
+from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto.SearchCriteria import MatchClauseAttribute
+from ch.systemsx.cisd.openbis.dss.generic.shared import ServiceProvider
+from java.awt.image import BandCombineOp
+from java.awt.image import BufferedImage
+from java.awt.image import ByteLookupTable
+from java.awt.image import ComponentSampleModel
+from java.awt.image import LookupOp
+from java.awt.image import Raster
+from java.awt.image import ShortLookupTable
+from java.io import File
+from java.lang import Float
+from java.lang.reflect import Array
+from java.nio import ByteBuffer
+from java.nio import ByteOrder
+from javax.imageio import ImageIO
+from loci.formats import ChannelSeparator
+from loci.formats import FormatTools
+from loci.formats import ImageReader
+from xml.etree import ElementTree as ET
+import jarray
+import json
+import logging
+import os
+
+_DEBUG = False
+
+# Size of the (square) chunks
+_CHUNK_SIZE = 256
+
+# Series with planes larger than _MIN_PLANE_SIZE (in x or y) or with more than
+# _MIN_NUM_PLANES planes get a pyramid (keep in sync with pyramid_requests.py
+# in the microscopy_thumbnails_creation maintenance task)
+_MIN_PLANE_SIZE = 4096
+_MIN_NUM_PLANES = 1000
+
+
+class PyramidBuilder():
+    """
+    Builds the levels of the pyramid of one plane from strips of the full
+    resolution plane (top to bottom), and writes the chunks as soon as a
+    chunk row of a level is complete.
+
+    Each level keeps a buffer of one chunk row; the strips of level n are
+    downsampled by 2 (mean of 2x2 pixels, computed on the raster samples so
+    that 16-bit data keeps its full precision, see _downsample()) and
+    appended to the buffer of level n + 1. The buffers have one spare row
+    and column, where the last row and column are repeated if the size of
+    the strip is odd.
+    """
+
+    def __init__(self, width, height, imageType, numLevels, writeChunk):
+        """Constructor
+
+        width, height: size of the full resolution plane.
+        imageType:     BufferedImage type of the strips.
+        numLevels:     number of levels of the pyramid.
+        writeChunk:    function(level, row, col, image) that stores a chunk.
+        """
+
+        self._imageType = imageType
+        self._writeChunk = writeChunk
+
+        # Per level: [width, buffer, number of rows in the buffer, chunk row]
+        self._levels = []
+        for level in range(numLevels):
+            levelWidth = _getLevelSize(width, level)
+            self._levels.append([levelWidth,
+                                 BufferedImage(levelWidth + 1, _CHUNK_SIZE + 1, imageType),
+                                 0, 0])
+
+    def addStrip(self, strip):
+        """Add the next strip of the full resolution plane (all strips but
+        the last one must be _CHUNK_SIZE rows high)."""
+
+        self._append(0, strip)
+
+    def finish(self):
+        """Write the incomplete chunk rows of all levels."""
+
+        for level in range(len(self._levels)):
+            self._flush(level)
+
+    def _append(self, level, strip):
+        """Append a strip to the buffer of a level."""
+
+        state = self._levels[level]
+        state[1].getRaster().setRect(0, state[2], strip.getRaster())
+        state[2] += strip.getHeight()
+
+        if state[2] >= _CHUNK_SIZE:
+            self._flush(level)
+
+    def _flush(self, level):
+        """Write the chunk row in the buffer of a level and pass it on,
+        downsampled, to the next level."""
+
+        levelWidth, buf, numRows, chunkRow = self._levels[level]
+        if numRows == 0:
+            return
+
+        strip = buf.getSubimage(0, 0, levelWidth, numRows)
+        for col in range((levelWidth + _CHUNK_SIZE - 1) / _CHUNK_SIZE):
+            chunkWidth = min(_CHUNK_SIZE, levelWidth - col * _CHUNK_SIZE)
+            self._writeChunk(level, chunkRow, col,
+                             strip.getSubimage(col * _CHUNK_SIZE, 0, chunkWidth, numRows))
+
+        if level + 1 < len(self._levels):
+            raster = buf.getRaster()
+            if levelWidth % 2 == 1:
+                raster.setRect(1, 0, raster.createChild(levelWidth - 1, 0, 1, numRows,
+                                                        levelWidth - 1, 0, None))
+            if numRows % 2 == 1:
+                raster.setRect(0, 1, raster.createChild(0, numRows - 1, levelWidth + 1, 1,
+                                                        0, numRows - 1, None))
+            reduced = BufferedImage((levelWidth + 1) / 2, (numRows + 1) / 2, self._imageType)
+            _downsample(raster, reduced.getRaster())
+            self._append(level + 1, reduced)
+
+        self._levels[level][2] = 0
+        self._levels[level][3] = chunkRow + 1
+
+
+class PyramidGenerator():
+    """
+    Generates and registers the MICROSCOPY_IMG_PYRAMID dataset of a
+    MICROSCOPY_IMG_CONTAINER.
+    """
+
+    def __init__(self, transaction, containerCode, logger):
+        """Constructor
+
+        transaction  : dropbox transaction.
+        containerCode: code of the MICROSCOPY_IMG_CONTAINER dataset.
+        logger:        logger.
+        """
+
+        self._transaction = transaction
+        self._searchService = transaction.getSearchService()
+        self._containerCode = containerCode
+        self._logger = logger
+
+        # Error message
+        self._message = ""
+
+        # Code of the registered (or existing) pyramid dataset
+        self._pyramidCode = ""
+
+    def process(self):
+        """Generate and register the pyramid (if needed).
+
+        Returns True for success (also if the series does not need a pyramid
+        or already has one). In case of error, returns False and sets the
+        error message in self._message -- to be retrieved with the
+        getErrorMessage() method.
+        """
+
+        container = self._getContainer()
+        if container is None:
+            return False
+
+        # Already generated?
+        existing = self._getExistingPyramid()
+        if existing is not None:
+            self._pyramidCode = existing.getDataSetCode()
+            if _DEBUG:
+                self._logger.info("Dataset " + self._containerCode + " already has pyramid " +
+                                  self._pyramidCode + ".")
+            return True
+
+        # Series number and geometry
+        metadata = self._getSeriesMetadata(container)
+        if metadata is None:
+            return False
+        sizes = [int(metadata.get(key, "1")) for key in ["sizeX", "sizeY", "sizeZ", "sizeC", "sizeT"]]
+        sizeX, sizeY, sizeZ, sizeC, sizeT = sizes
+        if max(sizeX, sizeY) <= _MIN_PLANE_SIZE and sizeZ * sizeC * sizeT <= _MIN_NUM_PLANES:
+            if _DEBUG:
+                self._logger.info("Series " + self._containerCode + " is too small for a pyramid.")
+            return True
+
+        # The file
+        fileName = self._getMicroscopyFile()
+        if fileName is None:
+            return False
+
+        # Write the pyramid into the directory of the new dataset (the
+        # transaction is rolled back if the pyramid cannot be completed)
+        dataSet = self._transaction.createNewDataSet("MICROSCOPY_IMG_PYRAMID")
+        dataSet.setSample(self._transaction.getSampleForUpdate(
+            container.getSample().getSampleIdentifier()))
+        dataSet.setParentDatasets([self._containerCode])
+        pyramidDir = self._transaction.createNewDirectory(dataSet, "pyramid")
+        if not self._writePyramid(fileName, int(metadata.get("numSeries", "0")), pyramidDir):
+            return False
+
+        self._pyramidCode = dataSet.getDataSetCode()
+        self._logger.info("Generated pyramid " + self._pyramidCode + " for series " +
+                          self._containerCode + ".")
+        return True
+
+    def getErrorMessage(self):
+        """Return the error message (in case process() returned failure)."""
+
+        return self._message
+
+    def getPyramidCode(self):
+        """Return the code of the pyramid dataset ("" if there is none)."""
+
+        return self._pyramidCode
+
+    def _getContainer(self):
+        """Find the MICROSCOPY_IMG_CONTAINER dataset."""
+
+        dataSetCriteria = SearchCriteria()
+        dataSetCriteria.addMatchClause(
+            MatchClause.createAttributeMatch(
+                MatchClauseAttribute.TYPE,
+                "MICROSCOPY_IMG_CONTAINER"))
+        dataSetCriteria.addMatchClause(
+            MatchClause.createAttributeMatch(
+                MatchClauseAttribute.CODE,
+                self._containerCode))
+
+        dataSets = self._searchService.searchForDataSets(dataSetCriteria)
+        if len(dataSets) == 0:
+            self._message = "Could not retrieve MICROSCOPY_IMG_CONTAINER dataset " + \
+                self._containerCode + "."
+            self._logger.error(self._message)
+            return None
+
+        return dataSets[0]
+
+    def _getExistingPyramid(self):
+        """Return the MICROSCOPY_IMG_PYRAMID child of the container (or None)."""
+
+        parentCriteria = SearchCriteria()
+        parentCriteria.addMatchClause(
+            MatchClause.createAttributeMatch(
+                MatchClauseAttribute.CODE,
+                self._containerCode))
+
+        dataSetCriteria = SearchCriteria()
+        dataSetCriteria.addMatchClause(
+            MatchClause.createAttributeMatch(
+                MatchClauseAttribute.TYPE,
+                "MICROSCOPY_IMG_PYRAMID"))
+        dataSetCriteria.addSubCriteria(
+            SearchSubCriteria.createDataSetParentCriteria(parentCriteria))
+
+        dataSets = self._searchService.searchForDataSets(dataSetCriteria)
+        if len(dataSets) == 0:
+            return None
+        return dataSets[0]
+
+    def _getSeriesMetadata(self, container):
+        """Return the series metadata (attributes of the
+        MICROSCOPY_IMG_CONTAINER_METADATA property) as a dictionary."""
+
+        metadataXML = container.getPropertyValue("MICROSCOPY_IMG_CONTAINER_METADATA")
+        try:
+            return ET.fromstring(metadataXML).attrib
+        except Exception:
+            self._message = "Could not parse the metadata of dataset " + self._containerCode + "."
+            self._logger.error(self._message)
+            return None
+
+    def _getMicroscopyFile(self):
+        """Return the full path of the microscopy file of the series (None
+        if the series is not a single file on disk)."""
+
+        content = ServiceProvider.getHierarchicalContentProvider().asContent(self._containerCode)
+        try:
+            nodes = content.listMatchingNodes("original", ".*")
+            files = []
+            if nodes is not None:
+                for node in nodes:
+                    if node.isDirectory():
+                        continue
+                    fileName = node.tryGetFile()
+                    if fileName is None:
+                        self._message = "Dataset " + self._containerCode + \
+                            " is stored in an HDF5 container: no pyramid generated."
+                        self._logger.error(self._message)
+                        return None
+                    files.append(str(fileName))
+        finally:
+            content.close()
+
+        if len(files) != 1:
+            self._message = "Dataset " + self._containerCode + " is not a single " + \
+                "microscopy file: no pyramid generated."
+            self._logger.error(self._message)
+            return None
+
+        return files[0]
+
+    def _writePyramid(self, fileName, seriesNum, pyramidDir):
+        """Read all planes of the series in strips and write their pyramids."""
+
+        reader = ChannelSeparator(ImageReader())
+        try:
+            reader.setId(fileName)
+            reader.setSeries(seriesNum)
+
+            # Signed values are shifted into the unsigned range by flipping
+            # their sign bit (i.e. adding the offset)
+            pixelType = reader.getPixelType()
+            if pixelType in [FormatTools.UINT8, FormatTools.INT8]:
+                imageType = BufferedImage.TYPE_BYTE_GRAY
+                offset = 128 if pixelType == FormatTools.INT8 else 0
+            elif pixelType in [FormatTools.UINT16, FormatTools.INT16]:
+                imageType = BufferedImage.TYPE_USHORT_GRAY
+                offset = 32768 if pixelType == FormatTools.INT16 else 0
+            else:
+                self._message = "Pixel type " + FormatTools.getPixelTypeString(pixelType) + \
+                    " of dataset " + self._containerCode + " is not supported."
+                self._logger.error(self._message)
+                return False
+            byteOrder = ByteOrder.LITTLE_ENDIAN if reader.isLittleEndian() else ByteOrder.BIG_ENDIAN
+            signFlip = _getSignFlip(imageType) if offset != 0 else None
+
+            width = reader.getSizeX()
+            height = reader.getSizeY()
+            numLevels = 1
+            while max(_getLevelSize(width, numLevels - 1),
+                      _getLevelSize(height, numLevels - 1)) > _CHUNK_SIZE:
+                numLevels += 1
+
+            for planeNum in range(reader.getImageCount()):
+
+                z, c, t = reader.getZCTCoords(planeNum)
+                planeDir = os.path.join(str(t), str(c), str(z))
+
+                def writeChunk(level, row, col, image, planeDir=planeDir):
+                    chunkDir = os.path.join(pyramidDir, str(level), planeDir)
+                    if not os.path.exists(chunkDir):
+                        os.makedirs(chunkDir)
+                    ImageIO.write(image, "png",
+                                  File(os.path.join(chunkDir, str(row) + "_" + str(col) + ".png")))
+
+                builder = PyramidBuilder(width, height, imageType, numLevels, writeChunk)
+                for y in range(0, height, _CHUNK_SIZE):
+                    stripHeight = min(_CHUNK_SIZE, height - y)
+                    data = reader.openBytes(planeNum, 0, y, width, stripHeight)
+                    builder.addStrip(_toImage(data, width, stripHeight, imageType, byteOrder,
+                                              signFlip))
+                builder.finish()
+
+            # Describe the pyramid
+            levels = []
+            for level in range(numLevels):
+                levelWidth = _getLevelSize(width, level)
+                levelHeight = _getLevelSize(height, level)
+                levels.append({"level": level,
+                               "scale": 2 ** level,
+                               "width": levelWidth,
+                               "height": levelHeight,
+                               "columns": (levelWidth + _CHUNK_SIZE - 1) / _CHUNK_SIZE,
+                               "rows": (levelHeight + _CHUNK_SIZE - 1) / _CHUNK_SIZE})
+
+            description = {"version": 1,
+                           "series": seriesNum,
+                           "sizeX": width,
+                           "sizeY": height,
+                           "sizeZ": reader.getSizeZ(),
+                           "sizeC": reader.getEffectiveSizeC(),
+                           "sizeT": reader.getSizeT(),
+                           "dataType": FormatTools.getPixelTypeString(pixelType),
+                           "offset": offset,
+                           "chunkSize": _CHUNK_SIZE,
+                           "chunkPath": "{level}/{t}/{c}/{z}/{row}_{col}.png",
+                           "levels": levels}
+            f = open(os.path.join(pyramidDir, "pyramid.json"), "w")
+            try:
+                f.write(json.dumps(description))
+            finally:
+                f.close()
+
+        except Exception, e:
+            self._message = "Could not generate the pyramid of dataset " + \
+                self._containerCode + ": " + str(e)
+            self._logger.error(self._message)
+            return False
+
+        finally:
+            reader.close()
+
+        return True
+
+
+def _getPluginPath():
+    """Return the path to the containing folder."""
+
+    # __file__ does not work (reliably) in Jython
+    return "../core-plugins/microscopy/4/dss/drop-boxes/MicroscopyPyramidDropbox"
+
+
+def _getLevelSize(size, level):
+    """Size (in pixels) of a dimension at given level of the pyramid."""
+
+    for i in range(level):
+        size = (size + 1) / 2
+    return size
+
+
+def _downsample(raster, reduced):
+    """Downsample a raster by 2 in x and y into the raster reduced: every
+    pixel is the (rounded) mean of 2x2 pixels. The raster must have (at
+    least) twice the width and height of reduced, and 8- or 16-bit samples
+    stored one after the other (as in the rasters of BufferedImages of type
+    TYPE_BYTE_GRAY or TYPE_USHORT_GRAY).
+
+    The mean is computed in Java by a BandCombineOp, on a view of the
+    samples in which the 2x2 pixels of every block are the bands of one
+    pixel."""
+
+    sampleModel = raster.getSampleModel()
+    pixelStride = sampleModel.getPixelStride()
+    scanlineStride = sampleModel.getScanlineStride()
+    offset = sampleModel.getBandOffsets()[0]
+
+    blocks = Raster.createRaster(
+        ComponentSampleModel(sampleModel.getDataType(),
+                             reduced.getWidth(), reduced.getHeight(),
+                             2 * pixelStride, 2 * scanlineStride,
+                             [offset, offset + pixelStride,
+                              offset + scanlineStride, offset + scanlineStride + pixelStride]),
+        raster.getDataBuffer(), None)
+
+    # Mean of the 4 bands, + 0.5 to round
+    matrix = Array.newInstance(Float.TYPE, [1, 5])
+    matrix[0] = jarray.array([0.25, 0.25, 0.25, 0.25, 0.5], "f")
+    BandCombineOp(matrix, None).filter(blocks, reduced)
+
+
+def _getSignFlip(imageType):
+    """LookupOp that flips the sign bit of 8- or 16-bit samples, i.e. shifts
+    signed values into the unsigned range (adds 128 or 32768)."""
+
+    if imageType == BufferedImage.TYPE_BYTE_GRAY:
+        table = jarray.array([(i ^ 0x80) - 256 * ((i ^ 0x80) >> 7) for i in range(256)], "b")
+        return LookupOp(ByteLookupTable(0, table), None)
+
+    table = jarray.array([(i ^ 0x8000) - 65536 * ((i ^ 0x8000) >> 15) for i in range(65536)], "h")
+    return LookupOp(ShortLookupTable(0, table), None)
+
+
+def _toImage(data, width, height, imageType, byteOrder, signFlip):
+    """Create a grayscale image from the raw bytes returned by bio-formats.
+
+    signFlip: None for unsigned data, or the LookupOp (see _getSignFlip())
+    that shifts signed data into the unsigned range."""
+
+    image = BufferedImage(width, height, imageType)
+    if imageType == BufferedImage.TYPE_BYTE_GRAY:
+        image.getRaster().setDataElements(0, 0, width, height, data)
+    else:
+        samples = jarray.zeros(width * height, "h")
+        ByteBuffer.wrap(data).order(byteOrder).asShortBuffer().get(samples)
+        image.getRaster().setDataElements(0, 0, width, height, samples)
+    if signFlip is not None:
+        flipped = BufferedImage(width, height, imageType)
+        signFlip.filter(image.getRaster(), flipped.getRaster())
+        image = flipped
+    return image
+
+
+def setUpLogging():
+    """Set up logging."""
+
+    # Path to the logs subfolder
+    logPath = os.path.join(_getPluginPath(), "logs")
+
+    # Make sure the logs subfolder exist
+    if not os.path.exists(logPath):
+        os.makedirs(logPath)
+
+    # Path for the log file
+    logFile = os.path.join(logPath, "log.txt")
+
+    # Set up logging
+    logging.basicConfig(filename=logFile, level=logging.DEBUG,
+                        format='%(asctime)-15s %(levelname)s: %(message)s')
+    return logging.getLogger()
+
+
+def process(transaction):
+    """Dropbox entry point.
+
+    The name of the incoming file is the code of the MICROSCOPY_IMG_CONTAINER
+    dataset.
+
+    @param transaction, the transaction object
+    """
+
+    logger = setUpLogging()
+
+    containerCode = transaction.getIncoming().getName()
+
+    if _DEBUG:
+        logger.info("Pyramid requested for MICROSCOPY_IMG_CONTAINER dataset " + containerCode)
+
+    generator = PyramidGenerator(transaction, containerCode, logger)
+    if not generator.process():
+        # Roll back (the request is moved to the faulty paths)
+        raise Exception(generator.getErrorMessage())
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+
+'''
+Dropbox that composes the thumbnails of all samples of a MICROSCOPY_EXPERIMENT
+into sprite sheets.
+
+The thumbnail maintenance task queues a request after generating a thumbnail
+by creating (or touching) a file named after the permId of the
+MICROSCOPY_EXPERIMENT sample in the incoming folder of this dropbox. The
+request is processed once no thumbnail of the experiment was generated for
+the quiet period of the dropbox, i.e. after the thumbnail datasets have been
+registered, and once for a whole batch of thumbnails.
+
+The sheets are registered as MICROSCOPY_IMG_THUMBNAIL_SHEET datasets of the
+MICROSCOPY_EXPERIMENT sample; the position of every thumbnail is stored as
+JSON in the MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX property of the dataset:
+
+    {
+        "sequence": 3,
+        "tileSize": 256,
+        "sheets": {"sheet_0.png": {"width": 1280, "height": 1280}, ...},
+        "tiles": {"<sample permId>": {"sheet": "sheet_0.png",
+                                      "x": 0, "y": 0,
+                                      "width": 256, "height": 192,
+                                      "thumbnail": "<thumbnail dataset code>"}, ...}
+    }
+
+The sheets are refreshed incrementally: each request only adds the samples
+that have a thumbnail and are not in any sheet yet, or whose thumbnail
+(MICROSCOPY_IMG_THUMBNAIL dataset) changed since their tile was composed.
+Samples without a thumbnail are ignored. The tiles of the last, incomplete
+sheet of the most recent dataset are copied into the new dataset, so that
+appending samples one by one does not produce one sheet per sample. If a
+sample appears in more than one dataset, the most recent one wins.
+
+The datasets of an experiment are numbered in the "sequence" of their index
+(1 for the first one): the most recent dataset is the one with the highest
+sequence. Dataset codes cannot be used for this, since they do not sort
+numerically (e.g. ...-9 and ...-10).
+
+Superseded datasets (whose tiles are all in more recent datasets) are kept:
+the dropbox cannot delete datasets in its transaction, and trashing them
+outside of it would lose the tiles if the registration of the new dataset
+failed. The viewer ignores them; they can be trashed manually.
+'''
+
+from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto import SearchCriteria
+from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto import SearchSubCriteria
+from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto.SearchCriteria import MatchClause
+from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto.SearchCriteria import MatchClauseAttribute
+from ch.systemsx.cisd.openbis.dss.generic.shared import ServiceProvider
+from java.awt.image import BufferedImage
+from java.io import File
+from javax.imageio import ImageIO
+import json
+import logging
+import os
+
+_DEBUG = False
+
+# Size of a tile (thumbnails are at most 256 x 256 pixels)
+_TILE_SIZE = 256
+
+# Number of tiles per row and per sheet
+_SHEET_COLUMNS = 5
+_TILES_PER_SHEET = 25
+
+# Maximum number of new thumbnails per registered dataset: more thumbnails
+# are registered in several datasets, so that at most this many thumbnails
+# are kept in memory
+_MAX_NEW_TILES = 200
+
+
+class ThumbnailSheetComposer():
+    """
+    Collects the thumbnails of the samples of a MICROSCOPY_EXPERIMENT that are
+    not in a thumbnail sheet yet (or whose thumbnail changed) and registers
+    them in a new MICROSCOPY_IMG_THUMBNAIL_SHEET dataset.
+    """
+
+    def __init__(self, transaction, expSamplePermId, logger):
+        """Constructor
+
+        transaction    : dropbox transaction.
+        expSamplePermId: permId of the MICROSCOPY_EXPERIMENT sample.
+        logger:          logger.
+        """
+
+        self._transaction = transaction
+        self._searchService = transaction.getSearchService()
+        self._expSamplePermId = expSamplePermId
+        self._logger = logger
+
+        # Error message
+        self._message = ""
+
+    def process(self):
+        """Compose and register the new sheets.
+
+        Returns True for success. In case of error, returns False and sets
+        the error message in self._message -- to be retrieved with the
+        getErrorMessage() method.
+        """
+
+        # Get the MICROSCOPY_EXPERIMENT sample
+        expSample = self._getMicroscopyExperimentSample()
+        if expSample is None:
+            return False
+
+        # Thumbnails of the samples in a sheet, and most recent dataset
+        indexedThumbnails, latestDataSet, latestIndex = self._getIndexedSamples()
+
+        # Thumbnails of the samples not in a sheet yet, or that changed
+        pending = [(samplePermId, thumbnailCode)
+                   for samplePermId, thumbnailCode in self._getThumbnailDataSetCodes()
+                   if indexedThumbnails.get(samplePermId) != thumbnailCode]
+
+        if len(pending) == 0:
+            if _DEBUG:
+                self._logger.info("All thumbnails are already in a sheet.")
+            return True
+
+        # Tiles of the last incomplete sheet, except the ones that are replaced
+        pendingPermIds = set([samplePermId for samplePermId, thumbnailCode in pending])
+        carriedTiles = [tile for tile in self._getCarriedTiles(latestDataSet, latestIndex)
+                        if tile[0] not in pendingPermIds]
+
+        # Number the new datasets after the most recent one
+        sequence = 0
+        if latestIndex is not None:
+            sequence = _getSequence(latestIndex)
+
+        for start in range(0, len(pending), _MAX_NEW_TILES):
+
+            newTiles = []
+            for samplePermId, thumbnailCode in pending[start:start + _MAX_NEW_TILES]:
+                image = self._readThumbnail(thumbnailCode)
+                if image is not None:
+                    newTiles.append((samplePermId, thumbnailCode, image))
+            if len(newTiles) == 0:
+                continue
+
+            # Register a new dataset
+            tiles = carriedTiles + newTiles
+            sequence += 1
+            self._registerSheets(expSample, tiles, sequence)
+
+            self._logger.info("Added " + str(len(newTiles)) + " thumbnails (and " +
+                              str(len(carriedTiles)) + " from the last incomplete sheet) " +
+                              "to the sheets of sample " + self._expSamplePermId + ".")
+
+            # The tiles of the last incomplete sheet go into the next dataset
+            numLastTiles = len(tiles) % _TILES_PER_SHEET
+            carriedTiles = tiles[len(tiles) - numLastTiles:] if numLastTiles > 0 else []
+
+        return True
+
+    def getErrorMessage(self):
+        """Return the error message (in case process() returned failure)."""
+
+        return self._message
+
+    def _getMicroscopyExperimentSample(self):
+        """Find the MICROSCOPY_EXPERIMENT sample with given permId."""
+
+        sampleCriteria = SearchCriteria()
+        sampleCriteria.addMatchClause(
+            MatchClause.createAttributeMatch(
+                MatchClauseAttribute.TYPE,
+                "MICROSCOPY_EXPERIMENT"))
+        sampleCriteria.addMatchClause(
+            MatchClause.createAttributeMatch(
+                MatchClauseAttribute.PERM_ID,
+                self._expSamplePermId))
+
+        samples = self._searchService.searchForSamples(sampleCriteria)
+        if len(samples) == 0:
+            self._message = "Could not retrieve MICROSCOPY_EXPERIMENT sample with permId " + \
+                self._expSamplePermId + "."
+            self._logger.error(self._message)
+            return None
+
+        return samples[0]
+
+    def _getIndexedSamples(self):
+        """Return the map sample permId -> thumbnail dataset code of the
+        samples that are already in a sheet (from the most recent dataset that
+        contains them), and the most recent dataset with its index (None, None
+        if there is none)."""
+
+        dataSetCriteria = SearchCriteria()
+        dataSetCriteria.addMatchClause(
+            MatchClause.createAttributeMatch(
+                MatchClauseAttribute.TYPE,
+                "MICROSCOPY_IMG_THUMBNAIL_SHEET"))
+        dataSetCriteria.addSubCriteria(
+            SearchSubCriteria.createSampleCriteria(self._getExperimentSampleCriteria()))
+        dataSets = self._searchService.searchForDataSets(dataSetCriteria)
+
+        # Process the most recent datasets last
+        indexedDataSets = []
+        for dataSet in dataSets:
+            index = self._parseIndex(dataSet)
+            if index is not None:
+                indexedDataSets.append((dataSet, index))
+        indexedDataSets.sort(key=lambda d: (_getSequence(d[1]), d[0].getDataSetCode()))
+
+        indexedThumbnails = {}
+        latestDataSet = None
+        latestIndex = None
+        for dataSet, index in indexedDataSets:
+            for permId, tile in index["tiles"].items():
+                indexedThumbnails[permId] = tile.get("thumbnail")
+            latestDataSet = dataSet
+            latestIndex = index
+
+        return indexedThumbnails, latestDataSet, latestIndex
+
+    def _getCarriedTiles(self, latestDataSet, latestIndex):
+        """Return the tiles (sample permId, thumbnail dataset code, image) of
+        the last sheet of the most recent dataset if it is incomplete."""
+
+        if latestDataSet is None:
+            return []
+
+        # Tiles of the last sheet of the most recent dataset
+        lastSheet = "sheet_" + str(len(latestIndex["sheets"]) - 1) + ".png"
+        lastTiles = [(permId, tile) for permId, tile in latestIndex["tiles"].items()
+                     if tile["sheet"] == lastSheet]
+        if len(lastTiles) >= _TILES_PER_SHEET:
+            return []
+
+        sheet = self._readImage(latestDataSet.getDataSetCode(), lastSheet)
+        if sheet is None:
+            return []
+
+        # Keep the original order of the tiles
+        lastTiles.sort(key=lambda t: (t[1]["y"], t[1]["x"]))
+        carriedTiles = []
+        for permId, tile in lastTiles:
+            carriedTiles.append((permId, tile.get("thumbnail"),
+                                 sheet.getSubimage(tile["x"], tile["y"],
+                                                   tile["width"], tile["height"])))
+        return carriedTiles
+
+    def _parseIndex(self, dataSet):
+        """Return the index of a MICROSCOPY_IMG_THUMBNAIL_SHEET dataset (or
+        None if it cannot be parsed)."""
+
+        value = dataSet.getPropertyValue("MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX")
+        if value is None or value == "":
+            return None
+        try:
+            index = json.loads(value)
+        except ValueError:
+            self._logger.error("Could not parse the index of dataset " +
+                               dataSet.getDataSetCode() + ".")
+            return None
+        if "tiles" not in index or "sheets" not in index:
+            return None
+        return index
+
+    def _getExperimentSampleCriteria(self):
+        """Search criteria for the MICROSCOPY_EXPERIMENT sample."""
+
+        sampleCriteria = SearchCriteria()
+        sampleCriteria.addMatchClause(
+            MatchClause.createAttributeMatch(
+                MatchClauseAttribute.TYPE,
+                "MICROSCOPY_EXPERIMENT"))
+        sampleCriteria.addMatchClause(
+            MatchClause.createAttributeMatch(
+                MatchClauseAttribute.PERM_ID,
+                self._expSamplePermId))
+        return sampleCriteria
+
+    def _getThumbnailDataSetCodes(self):
+        """Return the list of (sample permId, MICROSCOPY_IMG_THUMBNAIL dataset
+        code) for all samples of the experiment that have a thumbnail, ordered
+        by sample code.
+
+        As in the viewer, the thumbnail of the MICROSCOPY_IMG_CONTAINER with
+        the lowest code (i.e. of the first series) is used.
+        """
+
+        # All MICROSCOPY_IMG_CONTAINERs of the MICROSCOPY_SAMPLE_TYPE samples of the experiment
+        sampleCriteria = SearchCriteria()
+        sampleCriteria.addMatchClause(
+            MatchClause.createAttributeMatch(
+                MatchClauseAttribute.TYPE,
+                "MICROSCOPY_SAMPLE_TYPE"))
+        sampleCriteria.addSubCriteria(
+            SearchSubCriteria.createSampleParentCriteria(self._getExperimentSampleCriteria()))
+
+        dataSetCriteria = SearchCriteria()
+        dataSetCriteria.addMatchClause(
+            MatchClause.createAttributeMatch(
+                MatchClauseAttribute.TYPE,
+                "MICROSCOPY_IMG_CONTAINER"))
+        dataSetCriteria.addSubCriteria(
+            SearchSubCriteria.createSampleCriteria(sampleCriteria))
+        containers = self._searchService.searchForDataSets(dataSetCriteria)
+
+        # Map sample -> (container code, thumbnail code)
+        thumbnails = {}
+        sampleCodes = {}
+        for container in containers:
+            sample = container.getSample()
+            if sample is None:
+                continue
+            permId = sample.getPermId()
+            current = thumbnails.get(permId)
+            if current is not None and current[0] < container.getDataSetCode():
+                continue
+            for component in container.getContainedDataSets():
+                if component.getDataSetType() == "MICROSCOPY_IMG_THUMBNAIL":
+                    thumbnails[permId] = (container.getDataSetCode(), component.getDataSetCode())
+                    sampleCodes[permId] = sample.getCode()
+                    break
+
+        if _DEBUG:
+            self._logger.info("Found thumbnails for " + str(len(thumbnails)) + " samples.")
+
+        permIds = sorted(thumbnails.keys(), key=lambda p: sampleCodes[p])
+        return [(permId, thumbnails[permId][1]) for permId in permIds]
+
+    def _readThumbnail(self, dataSetCode):
+        """Read the (256 x 256) thumbnail of a MICROSCOPY_IMG_THUMBNAIL dataset."""
+
+        return self._readImage(dataSetCode, "thumbnail.png")
+
+    def _readImage(self, dataSetCode, fileName):
+        """Read an image with given file name from a dataset (None if it does
+        not exist or cannot be read)."""
+
+        content = ServiceProvider.getHierarchicalContentProvider().asContent(dataSetCode)
+        try:
+            nodes = content.listMatchingNodes("(.*/)?" + fileName.replace(".", "\\."))
+            if nodes is None or len(nodes) == 0:
+                self._logger.error("Could not find " + fileName + " in dataset " + dataSetCode + ".")
+                return None
+            stream = nodes[0].getInputStream()
+            try:
+                return ImageIO.read(stream)
+            finally:
+                stream.close()
+        except Exception, e:
+            self._logger.error("Could not read " + fileName + " from dataset " +
+                               dataSetCode + ": " + str(e))
+            return None
+        finally:
+            content.close()
+
+    def _registerSheets(self, expSample, tiles, sequence):
+        """Compose the tiles into sheets and register them with their index
+        (numbered with given sequence) in a new MICROSCOPY_IMG_THUMBNAIL_SHEET
+        dataset."""
+
+        dataSet = self._transaction.createNewDataSet("MICROSCOPY_IMG_THUMBNAIL_SHEET")
+        dataSet.setSample(self._transaction.getSampleForUpdate(expSample.getSampleIdentifier()))
+
+        index = {"sequence": sequence, "tileSize": _TILE_SIZE, "sheets": {}, "tiles": {}}
+        for sheetNum in range(0, len(tiles), _TILES_PER_SHEET):
+
+            sheetTiles = tiles[sheetNum:sheetNum + _TILES_PER_SHEET]
+            sheetName = "sheet_" + str(sheetNum / _TILES_PER_SHEET) + ".png"
+
+            numColumns = min(_SHEET_COLUMNS, len(sheetTiles))
+            numRows = (len(sheetTiles) + _SHEET_COLUMNS - 1) / _SHEET_COLUMNS
+            sheet = BufferedImage(numColumns * _TILE_SIZE, numRows * _TILE_SIZE,
+                                  BufferedImage.TYPE_INT_RGB)
+            graphics = sheet.createGraphics()
+            try:
+                for i, (permId, thumbnailCode, image) in enumerate(sheetTiles):
+                    x = (i % _SHEET_COLUMNS) * _TILE_SIZE
+                    y = (i / _SHEET_COLUMNS) * _TILE_SIZE
+                    width = min(image.getWidth(), _TILE_SIZE)
+                    height = min(image.getHeight(), _TILE_SIZE)
+                    graphics.drawImage(image, x, y, width, height, None)
+                    index["tiles"][permId] = {"sheet": sheetName, "x": x, "y": y,
+                                              "width": width, "height": height,
+                                              "thumbnail": thumbnailCode}
+            finally:
+                graphics.dispose()
+
+            index["sheets"][sheetName] = {"width": sheet.getWidth(),
+                                          "height": sheet.getHeight()}
+
+            sheetFile = self._transaction.createNewFile(dataSet, sheetName)
+            ImageIO.write(sheet, "png", File(sheetFile))
+
+        dataSet.setPropertyValue("MICROSCOPY_IMG_THUMBNAIL_SHEET_INDEX", json.dumps(index))
+
+
+def _getSequence(index):
+    """Return the sequence number of a sheet index (0 for the indices written
+    before the datasets were numbered)."""
+
+    try:
+        return int(index.get("sequence", 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def setUpLogging():
+    """Set up logging."""
+
+    # Get path to containing folder
+    # __file__ does not work (reliably) in Jython
+    dbPath = "../core-plugins/microscopy/4/dss/drop-boxes/MicroscopyThumbnailSheetDropbox"
+
+    # Path to the logs subfolder
+    logPath = os.path.join(dbPath, "logs")
+
+    # Make sure the logs subfolder exist
+    if not os.path.exists(logPath):
+        os.makedirs(logPath)
+
+    # Path for the log file
+    logFile = os.path.join(logPath, "log.txt")
+
+    # Set up logging
+    logging.basicConfig(filename=logFile, level=logging.DEBUG,
+                        format='%(asctime)-15s %(levelname)s: %(message)s')
+    return logging.getLogger()
+
+
+def process(transaction):
+    """Dropbox entry point.
+
+    The name of the incoming file is the permId of the MICROSCOPY_EXPERIMENT
+    sample.
+
+    @param transaction, the transaction object
+    """
+
+    logger = setUpLogging()
+
+    expSamplePermId = transaction.getIncoming().getName()
+
+    if _DEBUG:
+        logger.info("Thumbnail sheets requested for MICROSCOPY_EXPERIMENT sample " +
+                    expSamplePermId)
+
+    composer = ThumbnailSheetComposer(transaction, expSamplePermId, logger)
+    if not composer.process():
+        # Roll back (the request is moved to the faulty paths)
+        raise Exception(composer.getErrorMessage())
@@ -0,0 +1,146 @@
+import xml.etree.ElementTree as ET
+
+from container_properties import storeContainerProperty
+
+
+class ChannelStatistics(object):
+    """
+    Per-channel intensity statistics (min, max, coarse histogram and 0.1 /
+    99.9 percentiles) accumulated on subsampled pixels of the planes read
+    for the thumbnail. Series without a thumbnail (by default all but the
+    first series of a file) have no statistics.
+
+    The pixels are binned into a fine histogram (one bin per intensity for
+    data of up to 16 bits); the statistics are derived from it at the end,
+    so that no pixel values have to be kept in memory.
+    """
+
+    # Number of bins of the fine histogram (intensities are clamped to it)
+    _NUM_FINE_BINS = 65536
+
+    # Number of bins of the stored (coarse) histogram
+    _NUM_COARSE_BINS = 64
+
+    # Percentiles
+    _LOW_PERCENTILE = 0.1
+    _HIGH_PERCENTILE = 99.9
+
+    def __init__(self, samplesPerPlane=16384):
+        """
+        Constructor
+
+        samplesPerPlane: approximate number of pixels sampled per plane.
+        """
+
+        self.samplesPerPlane = samplesPerPlane
+
+        # Fine histogram per channel code
+        self.histograms = {}
+
+    def subsample(self, plane):
+        """Return a subsample of the pixel values of a (full-resolution) plane:
+        every step-th pixel of every step-th row.
+
+        This only reads the plane (so that it can be released before the
+        next one is read); the values are then added to the statistics with
+        add().
+        """
+
+        width = plane.getWidth()
+        height = plane.getHeight()
+        step = max(1, int((float(width) * height / self.samplesPerPlane) ** 0.5))
+
+        values = []
+        raster = plane.getRaster()
+        for y in xrange(0, height, step):
+            values.extend(raster.getSamples(0, y, width, 1, 0, None)[::step])
+        return values
+
+    def add(self, channelCode, values):
+        """Add pixel values (as returned by subsample()) to the statistics
+        of the channel."""
+
+        histogram = self.histograms.get(channelCode)
+        if histogram is None:
+            histogram = [0] * self._NUM_FINE_BINS
+            self.histograms[channelCode] = histogram
+
+        maxBin = self._NUM_FINE_BINS - 1
+        for value in values:
+            value = int(value)
+            if value < 0:
+                value = 0
+            elif value > maxBin:
+                value = maxBin
+            histogram[value] += 1
+
+    def toXML(self):
+        """Return the statistics of all channels as XML string:
+
+        <ChannelStatistics>
+            <Channel code="..." min="..." max="..." p0.1="..." p99.9="..."
+                     numSamples="..." binWidth="..." histogram="n0,n1,...,n63"/>
+        </ChannelStatistics>
+        """
+
+        root = ET.Element("ChannelStatistics")
+        for channelCode in sorted(self.histograms.keys()):
+            stats = self._getStatistics(self.histograms[channelCode])
+            if stats is None:
+                continue
+            node = ET.SubElement(root, "Channel")
+            node.set("code", channelCode)
+            for key in ["min", "max", "p0.1", "p99.9", "numSamples", "binWidth"]:
+                node.set(key, str(stats[key]))
+            node.set("histogram", ",".join([str(n) for n in stats["histogram"]]))
+
+        return ET.tostring(root, encoding="UTF-8")
+
+    def _getStatistics(self, histogram):
+        """Derive the statistics from a fine histogram."""
+
+        numSamples = sum(histogram)
+        if numSamples == 0:
+            return None
+
+        # Min and max
+        low = 0
+        while histogram[low] == 0:
+            low += 1
+        high = len(histogram) - 1
+        while histogram[high] == 0:
+            high -= 1
+
+        # Percentiles
+        lowCount = numSamples * self._LOW_PERCENTILE / 100.0
+        highCount = numSamples * self._HIGH_PERCENTILE / 100.0
+        pLow = None
+        pHigh = high
+        cumulative = 0
+        for value in xrange(low, high + 1):
+            cumulative += histogram[value]
+            if pLow is None and cumulative >= lowCount:
+                pLow = value
+            if cumulative >= highCount:
+                pHigh = value
+                break
+
+        # Coarse histogram between min and max
+        binWidth = max(1, (high - low + self._NUM_COARSE_BINS) / self._NUM_COARSE_BINS)
+        coarse = [0] * self._NUM_COARSE_BINS
+        for value in xrange(low, high + 1):
+            coarse[min(self._NUM_COARSE_BINS - 1, (value - low) / binWidth)] += histogram[value]
+
+        return {"min": low, "max": high, "p0.1": pLow, "p99.9": pHigh,
+                "numSamples": numSamples, "binWidth": binWidth,
+                "histogram": coarse}
+
+
+def storeChannelStatistics(dataSetCode, statisticsXML, logger=None):
+    """Store the statistics (as returned by ChannelStatistics.toXML()) in the
+    MICROSCOPY_IMG_CHANNEL_STATISTICS property of the MICROSCOPY_IMG_CONTAINER
+    dataset that contains the dataset with given code (or of the dataset
+    itself if it is the container)."""
+
+    return storeContainerProperty(dataSetCode, "MICROSCOPY_IMG_CHANNEL_STATISTICS",
+                                  statisticsXML, logger)
@@ -0,0 +1,50 @@
+from ch.systemsx.cisd.openbis.dss.generic.shared import ServiceProvider
+from ch.ethz.sis.openbis.generic.asapi.v3.dto.dataset.fetchoptions import DataSetFetchOptions
+from ch.ethz.sis.openbis.generic.asapi.v3.dto.dataset.id import DataSetPermId
+from ch.ethz.sis.openbis.generic.asapi.v3.dto.dataset.update import DataSetUpdate
+
+
+def storeContainerProperty(dataSetCode, propertyCode, value, logger=None):
+    """Store a property of the MICROSCOPY_IMG_CONTAINER dataset that contains
+    the dataset with given code (or of the dataset itself if it is the
+    container).
+
+    Returns True if the property was stored."""
+
+    service = ServiceProvider.getV3ApplicationService()
+    sessionToken = ServiceProvider.getOpenBISService().getSessionToken()
+
+    # Find the container
+    fetchOptions = DataSetFetchOptions()
+    fetchOptions.withType()
+    fetchOptions.withContainers().withType()
+    dataSetId = DataSetPermId(dataSetCode)
+    dataSets = service.getDataSets(sessionToken, [dataSetId], fetchOptions)
+    dataSet = dataSets.get(dataSetId)
+    if dataSet is None:
+        if logger is not None:
+            logger.error("Could not retrieve dataset " + dataSetCode +
+                         ": " + propertyCode + " not stored.")
+        return False
+
+    container = None
+    if dataSet.getType().getCode() == "MICROSCOPY_IMG_CONTAINER":
+        container = dataSet
+    else:
+        for candidate in dataSet.getContainers():
+            if candidate.getType().getCode() == "MICROSCOPY_IMG_CONTAINER":
+                container = candidate
+                break
+
+    if container is None:
+        if logger is not None:
+            logger.error("Dataset " + dataSetCode + " has no MICROSCOPY_IMG_CONTAINER: " +
+                         propertyCode + " not stored.")
+        return False
+
+    update = DataSetUpdate()
+    update.setDataSetId(container.getPermId())
+    update.setProperty(propertyCode, value)
+    service.updateDataSets(sessionToken, [update])
+
+    return True
@@ -1,35 +1,246 @@
-from ch.systemsx.cisd.openbis.dss.etl.dto.api.impl import MaximumIntensityProjectionGenerationAlgorithm
+import time
 
+from java.util import ArrayList
 
-class CustomExperimentMaximumIntensityProjectionGenerationAlgorithm(MaximumIntensityProjectionGenerationAlgorithm):
+from channel_statistics import storeChannelStatistics
+from container_properties import storeContainerProperty
+from image_structure_summary import ImageStructureSummary
+from pyramid_requests import requestPyramids
+from streaming_mip_generation_algorithm import StreamingMaximumIntensityProjectionGenerationAlgorithm
+from thumbnail_sheets import requestThumbnailSheets
+
+
+class CustomExperimentMaximumIntensityProjectionGenerationAlgorithm(StreamingMaximumIntensityProjectionGenerationAlgorithm):
     """
     Custom MaximumIntensityProjectionGenerationAlgorithm that makes sure that the first
     timepoint in a series is registered for creation of the representative thumbnail.
+    The projection is computed by StreamingMaximumIntensityProjectionGenerationAlgorithm
+    (bounded memory, independent of the depth of the stack).
+
+    Optionally, only a subset of the planes of the first timepoint is projected
+    (sampled preview): either every step-th plane, or at most maxPlanes planes
+    spread evenly over the stack. The number of projected planes is then
+    stored as "<projected>/<total>" in the MICROSCOPY_IMG_THUMBNAIL_PLANES
+    property of the MICROSCOPY_IMG_CONTAINER (the thumbnail is not modified).
     """
 
-    def __init__(self, datasetTypeCode, width, height, filename):
+    def __init__(self, datasetTypeCode, width, height, filename, summary=None,
+                 step=0, maxPlanes=0, additionalSizes=None,
+                 budget=None, metrics=None, statistics=None, cache=None,
+                 sheetRequestsDir=None, pyramidRequestsDir=None):
         """
         Constructor
+
+        summary:   (optional) ImageStructureSummary of the dataset, if already
+                   computed by the caller.
+        step:      (optional) project every step-th plane only (0 or 1 for all).
+        maxPlanes: (optional) project at most maxPlanes planes, spread over
+                   the stack (0 for all). Ignored if step is set.
+        additionalSizes: (optional) additional thumbnail sizes generated from
+                   the same projection.
+        budget:    (optional) ThumbnailBudget to charge the time spent and
+                   the bytes read to.
+        metrics:   (optional) ThumbnailMetrics to record the time spent, the
+                   bytes read and failures.
+        statistics: (optional) ChannelStatistics: if set, the intensity
+                   statistics of the projected planes are computed and stored
+                   in the MICROSCOPY_IMG_CONTAINER of the dataset.
+        cache:     (optional) ThumbnailCache: if set, the thumbnails of a
+                   series that is already in the cache are reused, and the
+                   generated ones are added to it.
+        sheetRequestsDir: (optional) incoming folder of the
+                   MicroscopyThumbnailSheetDropbox: if set, a refresh of the
+                   thumbnail sheets of the experiment is requested for every
+                   thumbnail.
+        pyramidRequestsDir: (optional) incoming folder of the
+                   MicroscopyPyramidDropbox: if set, the generation of the
+                   pyramids of the large series of the file is requested
+                   for every thumbnail.
         """
 
         # Call the parent base constructor
-        MaximumIntensityProjectionGenerationAlgorithm.__init__(self,
-            datasetTypeCode, width, height, filename)
+        StreamingMaximumIntensityProjectionGenerationAlgorithm.__init__(self,
+            datasetTypeCode, width, height, filename,
+            additionalSizes=additionalSizes)
+
+        # Image structure summary
+        self.summary = summary
+
+        # Budget
+        self.budget = budget
+
+        # Metrics
+        self.metrics = metrics
+
+        # Channel statistics
+        self.statistics = statistics
+
+        # Thumbnail cache
+        self.cache = cache
+
+        # Thumbnail sheet requests
+        self.sheetRequestsDir = sheetRequestsDir
+
+        # Pyramid requests
+        self.pyramidRequestsDir = pyramidRequestsDir
+
+        # Plane sampling
+        self.step = step
+        self.maxPlanes = maxPlanes
+
+        # Depths to project at the minimum timepoint (None for all)
+        self.selectedDepths = None
+        self.numDepths = 0
 
     def findMinTimepoint(self, information):
-        mintimepoint = None
-        for image in information.getImageDataSetStructure().getImages():
-            timepoint = image.tryGetTimepoint()
-            if timepoint is not None:
-                if mintimepoint is None:
-                    mintimepoint = timepoint
-                else:
-                    mintimepoint = min(mintimepoint, timepoint)
-        return mintimepoint
+        if self.summary is None:
+            self.summary = ImageStructureSummary(information.getImageDataSetStructure())
+        return self.summary.minTimepoint
+
+    def selectDepths(self, depths):
+        """Return the subset of depths to project (None for all)."""
+
+        numDepths = len(depths)
+        if self.step > 1:
+            return set(depths[::self.step])
+        if self.maxPlanes > 0 and numDepths > self.maxPlanes:
+            if self.maxPlanes == 1:
+                return set([depths[numDepths / 2]])
+            return set([depths[int(round(i * (numDepths - 1) / float(self.maxPlanes - 1)))]
+                        for i in range(self.maxPlanes)])
+        return None
 
     def generateImages(self, information, thumbnailDatasets, imageProvider):
         self.mintimepoint = self.findMinTimepoint(information)
-        return super(CustomExperimentMaximumIntensityProjectionGenerationAlgorithm, self).generateImages(information, thumbnailDatasets, imageProvider)
+        depths = self.summary.getDepths(self.mintimepoint)
+        self.numDepths = len(depths)
+        self.selectedDepths = self.selectDepths(depths)
+        start = time.time()
+
+        # Reuse the thumbnails of a series that was already processed
+        fingerprint = self.getFingerprint(information)
+        if fingerprint is not None:
+            cached = self.cache.get(fingerprint)
+            if self.metrics is not None:
+                self.metrics.cacheLookup(cached is not None)
+            if cached is not None:
+                cachedImages, statisticsXML = cached
+                if self.metrics is not None:
+                    self.metrics.datasetProcessed(information.getDataSetCode(), time.time() - start, 0)
+                if statisticsXML is not None:
+                    self.storeStatistics(information, statisticsXML)
+                self.storeSampledPlanes(information)
+                images = ArrayList()
+                for image in cachedImages:
+                    images.add(image)
+                if images.size() > 0:
+                    self.requestSheets(information)
+                    self.requestPyramids(information)
+                return images
+
+        try:
+            images = super(CustomExperimentMaximumIntensityProjectionGenerationAlgorithm, self).generateImages(information, thumbnailDatasets, imageProvider)
+        except:
+            if self.metrics is not None:
+                self.metrics.datasetProcessed(information.getDataSetCode(), time.time() - start, self.numBytesRead, failed=True)
+            raise
+        if self.budget is not None:
+            self.budget.consume(time.time() - start, self.numBytesRead)
+        if self.metrics is not None:
+            self.metrics.datasetProcessed(information.getDataSetCode(), time.time() - start, self.numBytesRead)
+        self.storeSampledPlanes(information)
+        statisticsXML = None
+        if self.statistics is not None:
+            statisticsXML = self.statistics.toXML()
+            self.storeStatistics(information, statisticsXML)
+        if fingerprint is not None and images.size() > 0:
+            self.cache.put(fingerprint, list(images), statisticsXML)
+        if images.size() > 0:
+            self.requestSheets(information)
+            self.requestPyramids(information)
+        return images
+
+    def getFingerprint(self, information):
+        """Fingerprint of the series for the thumbnail cache (None if there
+        is no cache or the series cannot be fingerprinted)."""
+
+        if self.cache is None:
+            return None
+
+        # The thumbnails also depend on the settings
+        settings = ",".join([str(self.width), str(self.height),
+                             str(self.additionalSizes), str(self.step),
+                             str(self.maxPlanes), str(self.statistics is not None)])
+        try:
+            return self.cache.getFingerprint(information, self.summary.getFirstSeries(), settings,
+                                             self.imageToBeIgnored)
+        except Exception, e:
+            if self.metrics is not None:
+                self.metrics.logger.error("Could not compute the thumbnail fingerprint: " + str(e))
+            return None
+
+    def storeStatistics(self, information, statisticsXML):
+        """Store the channel statistics (failures do not affect the thumbnail)."""
+
+        logger = None
+        if self.metrics is not None:
+            logger = self.metrics.logger
+        try:
+            storeChannelStatistics(information.getDataSetCode(), statisticsXML, logger)
+        except Exception, e:
+            if logger is not None:
+                logger.error("Could not store channel statistics: " + str(e))
+
+    def storeSampledPlanes(self, information):
+        """Store the number of projected planes of a sampled preview (failures
+        do not affect the thumbnail)."""
+
+        if self.selectedDepths is None:
+            return
+
+        logger = None
+        if self.metrics is not None:
+            logger = self.metrics.logger
+        try:
+            storeContainerProperty(information.getDataSetCode(),
+                                   "MICROSCOPY_IMG_THUMBNAIL_PLANES",
+                                   str(len(self.selectedDepths)) + "/" + str(self.numDepths),
+                                   logger)
+        except Exception, e:
+            if logger is not None:
+                logger.error("Could not store the number of projected planes: " + str(e))
+
+    def requestSheets(self, information):
+        """Request a refresh of the thumbnail sheets of the experiment
+        (failures do not affect the thumbnail)."""
+
+        if self.sheetRequestsDir is None:
+            return
+
+        logger = None
+        if self.metrics is not None:
+            logger = self.metrics.logger
+        try:
+            requestThumbnailSheets(information.getDataSetCode(), self.sheetRequestsDir, logger)
+        except Exception, e:
+            if logger is not None:
+                logger.error("Could not request the thumbnail sheets: " + str(e))
+
+    def requestPyramids(self, information):
+        """Request the multiscale pyramids of the large series of the file
+        (failures do not affect the thumbnail)."""
+
+        if self.pyramidRequestsDir is None:
+            return
+
+        logger = None
+        if self.metrics is not None:
+            logger = self.metrics.logger
+        try:
+            requestPyramids(information.getDataSetCode(), self.pyramidRequestsDir, logger)
+        except Exception, e:
+            if logger is not None:
+                logger.error("Could not request the image pyramids: " + str(e))
 
     def imageToBeIgnored(self, image):
         """
@@ -37,7 +248,14 @@ class CustomExperimentMaximumIntensityProjectionGenerationAlgorithm(MaximumInten
         series should be used to create the representative thumbnail is done
         elsewhere. Here we prevent the base
         MaximumIntensityProjectionGenerationAlgorithm.imageToBeIgnored() method
-        to make a decision based on the timepoint (==0).
+        to make a decision based on the timepoint (==0). In sampled mode,
+        the planes that are not selected are ignored as well.
         """
 
-        return image.tryGetTimepoint() != self.mintimepoint
\ No newline at end of file
+        if image.tryGetTimepoint() != self.mintimepoint:
+            return True
+
+        if self.selectedDepths is not None:
+            return image.tryGetDepth() not in self.selectedDepths
+
+        return False
\ No newline at end of file
@@ -1,18 +1,102 @@
 import os
 import logging
-from sets import Set
 
+from java.lang import System
+
+from channel_statistics import ChannelStatistics
 from custom_mip_generation_algorithm import CustomExperimentMaximumIntensityProjectionGenerationAlgorithm
+from image_structure_summary import ImageStructureSummary
+from thumbnail_budget import ThumbnailBudget
+from thumbnail_cache import ThumbnailCache
+from thumbnail_metrics import ThumbnailMetrics
 
 _DEBUG = False
 
+# Sampled-plane mode: datasets with more than _SAMPLING_MIN_IMAGES images
+# (planes) get a sampled preview built from at most _SAMPLING_MAX_PLANES
+# planes of the first timepoint, spread over the stack. Set _SAMPLING_STEP
+# to a value > 1 to project every _SAMPLING_STEP-th plane instead. The number
+# of projected planes is stored in the MICROSCOPY_IMG_THUMBNAIL_PLANES property
+# of the MICROSCOPY_IMG_CONTAINER (e.g. "64/2000").
+_SAMPLING_MIN_IMAGES = 1000
+_SAMPLING_MAX_PLANES = 64
+_SAMPLING_STEP = 0
+
+# Additional thumbnail sizes (the 256x256 thumbnail.png is always created):
+# they are generated from the same projection and stored as thumbnail_<size>.png.
+# The projection is computed at twice the thumbnail size: larger sizes are
+# skipped.
+_ADDITIONAL_THUMBNAIL_SIZES = [64, 512]
+
+# Thumbnails for all series: if True, thumbnails are also generated for the
+# series other than the first one, as long as the budget for the current time
+# window is not exhausted. The first series of a file always gets its
+# thumbnail and does not count against the budget. Series skipped because of
+# the budget do not get a thumbnail.
+_ALL_SERIES = False
+_BUDGET_WINDOW_SECONDS = 60
+_BUDGET_MAX_SECONDS = 30
+_BUDGET_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Backlog handling: for every dataset, the number of MICROSCOPY_IMG_CONTAINER
+# datasets registered after the last processed one (i.e. still waiting for
+# the task) is counted and written to logs/metrics.txt, with the generation
+# time, bytes read and failures. If more than _BACKLOG_THRESHOLD datasets are
+# waiting, the task is falling behind and the work per dataset is limited:
+# only the first series gets a thumbnail (even with _ALL_SERIES). With
+# _ALL_SERIES = False, this is always the case, and the thumbnails that are
+# generated always have the full quality. The interval of the task (see
+# plugin.properties) and the number of datasets it hands to the script per
+# run are set by the openBIS task and cannot be adapted from this script.
+_BACKLOG_THRESHOLD = 50
+
+# Per-channel intensity statistics (min, max, 0.1/99.9 percentiles and coarse
+# histogram) computed on subsampled pixels of the planes read for the
+# thumbnail and stored in the MICROSCOPY_IMG_CHANNEL_STATISTICS property of
+# the MICROSCOPY_IMG_CONTAINER dataset. Only series that get a thumbnail have
+# statistics: by default the first series of each file only (the others
+# with _ALL_SERIES, within the budget). They cover the planes projected for
+# the thumbnail, i.e. the first timepoint (sampled for large datasets).
+_CHANNEL_STATISTICS = True
+
+# Thumbnail cache: the thumbnails (and channel statistics) of every series
+# are kept in _CACHE_DIR (by default, the microscopy-thumbnail-cache folder
+# in the temporary folder of the DSS), keyed by a fingerprint of the files
+# read for the thumbnail (relative paths, sizes and first and last bytes of
+# a few of them), the series number and the thumbnail settings. A series
+# registered again (e.g. after an interrupted upload) reuses them instead of
+# reading the planes again. The least recently used entries are removed
+# above _CACHE_MAX_BYTES; hits and misses are counted in logs/metrics.txt.
+_CACHE = True
+_CACHE_DIR = None
+_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Thumbnail sheets: if set to the incoming folder of the
+# MicroscopyThumbnailSheetDropbox (its incoming-dir, with ${incoming-root-dir}
+# expanded), a refresh of the thumbnail sheets of the experiment is requested
+# for every thumbnail; the experiment viewer cuts the thumbnails from them.
+_THUMBNAIL_SHEET_REQUESTS_DIR = None
+
+# Image pyramids: if set to the incoming folder of the MicroscopyPyramidDropbox
+# (its incoming-dir, with ${incoming-root-dir} expanded), the generation of a
+# chunked multiscale pyramid is requested for every large series (see
+# pyramid_requests.py) of a file once its thumbnail is generated, i.e. shortly
+# after registration.
+_PYRAMID_REQUESTS_DIR = None
+
+
+def _getPluginPath():
+    """Return the path to the containing folder."""
+
+    # __file__ does not work (reliably) in Jython
+    return "../core-plugins/microscopy/4/dss/maintenance-tasks/microscopy_thumbnails_creation"
+
 
 def setUpLogging():
     """Set up logging."""
 
     # Get path to containing folder
-    # __file__ does not work (reliably) in Jython
-    dbPath = "../core-plugins/microscopy/4/dss/maintenance-tasks/microscopy_thumbnails_creation"
+    dbPath = _getPluginPath()
 
     # Path to the logs subfolder
     logPath = os.path.join(dbPath, "logs")
@@ -31,22 +115,13 @@ def setUpLogging():
     return logger
 
 
-def _get_series_num(logger):
-    """Retrieve series numbers."""
-
-    series_numbers = Set()
-    for image_info in image_data_set_structure.getImages():
-
-        if logger is not None:
-            logger.info("ImageInfo timepoint: " + str(image_info.tryGetTimepoint()))
-            logger.info("ImageInfo channel code: " + str(image_info.getChannelCode()))
-
-        series_numbers.add(image_info.tryGetSeriesNumber())
+def _get_series_num(summary, logger):
+    """Retrieve the series number from the structure summary."""
 
     if logger is not None:
-        logger.info("Series numbers: " + str(series_numbers))
+        logger.info("Image structure: " + str(summary))
 
-    return series_numbers.pop()
+    return summary.getFirstSeries()
 
 
 def process(transaction, parameters, tableBuilder):
@@ -57,17 +132,75 @@ def process(transaction, parameters, tableBuilder):
     if _DEBUG:
         logger = setUpLogging()
 
+    # Summarize the image structure (once per dataset)
+    summary = ImageStructureSummary(image_data_set_structure)
+
     # Get series number
-    series_num = int(_get_series_num(logger))
-
-    # Thumbnails are created only for the first series
-    if series_num == 0:
-        image_config.setImageGenerationAlgorithm(
-            CustomExperimentMaximumIntensityProjectionGenerationAlgorithm(
-                "MICROSCOPY_IMG_THUMBNAIL", 256, 256, "thumbnail.png"))
-        if logger is not None:
-            logger.info("Series number: " + str(series_num) + ": requested thumbnail generation.")
-
-    else:
-        if logger is not None:
-            logger.info("Series number: " + str(series_num) + ": skipped thumbnail generation.")
+    series_num = _get_series_num(summary, logger)
+
+    # Metrics
+    metrics = ThumbnailMetrics(os.path.join(_getPluginPath(), "logs", "metrics.txt"),
+                               logger)
+
+    # Falling behind?
+    pending = metrics.updatePendingDatasets()
+    catchUp = pending is not None and pending > _BACKLOG_THRESHOLD
+
+    metrics.datasetStarted(series_num, summary.numImages)
+
+    # The first series always gets a thumbnail; the others (if requested)
+    # only within the budget and while the task is not falling behind
+    budget = None
+    if series_num != 0:
+
+        if not _ALL_SERIES or catchUp or series_num is None:
+            if logger is not None:
+                logger.info("Series number: " + str(series_num) + ": skipped thumbnail generation" +
+                            (" (falling behind: " + str(pending) + " datasets pending)."
+                             if _ALL_SERIES and catchUp else "."))
+            metrics.datasetSkipped()
+            return
+
+        budget = ThumbnailBudget(os.path.join(_getPluginPath(), "logs", "budget.txt"),
+                                 _BUDGET_WINDOW_SECONDS,
+                                 _BUDGET_MAX_SECONDS,
+                                 _BUDGET_MAX_BYTES)
+        if not budget.isAvailable():
+            if logger is not None:
+                logger.info("Series number: " + str(series_num) + ": skipped thumbnail " +
+                            "generation (budget exhausted: " + str(budget) + ").")
+            metrics.datasetSkipped()
+            return
+
+    # Sample the planes of large datasets
+    step = 0
+    maxPlanes = 0
+    if summary.numImages > _SAMPLING_MIN_IMAGES:
+        step = _SAMPLING_STEP
+        maxPlanes = _SAMPLING_MAX_PLANES
+
+    # Channel statistics
+    statistics = None
+    if _CHANNEL_STATISTICS:
+        statistics = ChannelStatistics()
+
+    # Thumbnail cache
+    cache = None
+    if _CACHE:
+        cacheDir = _CACHE_DIR
+        if cacheDir is None:
+            cacheDir = os.path.join(System.getProperty("java.io.tmpdir"),
+                                    "microscopy-thumbnail-cache")
+        cache = ThumbnailCache(cacheDir,
+                               _CACHE_MAX_BYTES,
+                               metrics.logger)
+
+    image_config.setImageGenerationAlgorithm(
+        CustomExperimentMaximumIntensityProjectionGenerationAlgorithm(
+            "MICROSCOPY_IMG_THUMBNAIL", 256, 256, "thumbnail.png", summary,
+            step, maxPlanes, _ADDITIONAL_THUMBNAIL_SIZES, budget, metrics,
+            statistics, cache, _THUMBNAIL_SHEET_REQUESTS_DIR,
+            _PYRAMID_REQUESTS_DIR))
+    if logger is not None:
+        logger.info("Series number: " + str(series_num) + ": requested thumbnail generation" +
+                    " (step = " + str(step) + ", maxPlanes = " + str(maxPlanes) + ").")
@@ -0,0 +1,84 @@
+class ImageStructureSummary(object):
+    """
+    Summary of the image data set structure of a dataset, collected in a
+    single pass over its images: series numbers, minimum and maximum
+    timepoint, and number of planes and channels per series.
+
+    It is computed once per dataset by the maintenance task script and
+    shared with the MIP generation algorithm, so that neither has to
+    iterate over the images again.
+    """
+
+    def __init__(self, structure):
+        """
+        Constructor
+
+        @param structure: ImageDataSetStructure of the dataset.
+        """
+
+        # Series numbers
+        self.series = set()
+
+        # Minimum and maximum timepoint (None if the images have no timepoint)
+        self.minTimepoint = None
+        self.maxTimepoint = None
+
+        # Number of planes per series
+        self.planesPerSeries = {}
+
+        # Channel codes per series
+        self.channelsPerSeries = {}
+
+        # Depths (z positions) per timepoint
+        self.depthsPerTimepoint = {}
+
+        # Total number of images
+        self.numImages = 0
+
+        for image in structure.getImages():
+
+            self.numImages += 1
+
+            seriesNum = image.tryGetSeriesNumber()
+            if seriesNum is not None:
+                seriesNum = int(seriesNum)
+            self.series.add(seriesNum)
+
+            self.planesPerSeries[seriesNum] = self.planesPerSeries.get(seriesNum, 0) + 1
+            self.channelsPerSeries.setdefault(seriesNum, set()).add(image.getChannelCode())
+
+            timepoint = image.tryGetTimepoint()
+            depth = image.tryGetDepth()
+            if depth is not None:
+                self.depthsPerTimepoint.setdefault(timepoint, set()).add(depth)
+            if timepoint is not None:
+                if self.minTimepoint is None or timepoint < self.minTimepoint:
+                    self.minTimepoint = timepoint
+                if self.maxTimepoint is None or timepoint > self.maxTimepoint:
+                    self.maxTimepoint = timepoint
+
+    def getFirstSeries(self):
+        """Return the lowest series number (None if there are no images)."""
+
+        known = [s for s in self.series if s is not None]
+        if len(known) > 0:
+            return min(known)
+        return None
+
+    def getNumChannels(self, seriesNum):
+        """Return the number of channels of given series."""
+
+        return len(self.channelsPerSeries.get(seriesNum, []))
+
+    def getDepths(self, timepoint):
+        """Return the sorted list of depths (z positions) at given timepoint."""
+
+        return sorted(self.depthsPerTimepoint.get(timepoint, []))
+
+    def __str__(self):
+        return "images = " + str(self.numImages) + \
+            ", series = " + str(sorted(self.series)) + \
+            ", timepoints = [" + str(self.minTimepoint) + ", " + str(self.maxTimepoint) + "]" + \
+            ", planes per series = " + str(self.planesPerSeries) + \
+            ", channels per series = " + \
+            str(dict([(s, len(c)) for s, c in self.channelsPerSeries.items()]))
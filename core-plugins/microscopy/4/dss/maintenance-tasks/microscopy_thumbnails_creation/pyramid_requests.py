@@ -0,0 +1,99 @@
+import os
+
+from ch.systemsx.cisd.openbis.dss.generic.shared import ServiceProvider
+from ch.ethz.sis.openbis.generic.asapi.v3.dto.dataset.fetchoptions import DataSetFetchOptions
+from ch.ethz.sis.openbis.generic.asapi.v3.dto.dataset.id import DataSetPermId
+from ch.ethz.sis.openbis.generic.asapi.v3.dto.dataset.search import DataSetSearchCriteria
+from java.io import File
+from xml.etree import ElementTree as ET
+
+# Series with planes larger than _MIN_PLANE_SIZE (in x or y) or with more than
+# _MIN_NUM_PLANES planes get a pyramid: keep in sync with the thresholds of
+# the MicroscopyPyramidDropbox (which checks again and skips smaller series).
+_MIN_PLANE_SIZE = 4096
+_MIN_NUM_PLANES = 1000
+
+
+def requestPyramids(dataSetCode, requestsDir, logger=None):
+    """Queue the generation of the multiscale pyramids of the large series
+    of the file of the dataset with given code in the
+    MicroscopyPyramidDropbox.
+
+    All MICROSCOPY_IMG_CONTAINER datasets (series) of the sample of the
+    dataset are checked, since the thumbnail is only generated for (and the
+    task only reaches) the first series of a file. A request is a file named
+    after the code of the MICROSCOPY_IMG_CONTAINER in requestsDir (the
+    incoming folder of the dropbox), followed by its marker file. Series that
+    already have a MICROSCOPY_IMG_PYRAMID child or are already queued are
+    skipped.
+
+    Returns the number of queued requests (None in case of error)."""
+
+    service = ServiceProvider.getV3ApplicationService()
+    sessionToken = ServiceProvider.getOpenBISService().getSessionToken()
+
+    if not os.path.isdir(requestsDir):
+        if logger is not None:
+            logger.error("The pyramid requests folder " + requestsDir +
+                         " does not exist: pyramids not requested.")
+        return None
+
+    # Find the sample
+    fetchOptions = DataSetFetchOptions()
+    fetchOptions.withSample()
+    dataSetId = DataSetPermId(dataSetCode)
+    dataSets = service.getDataSets(sessionToken, [dataSetId], fetchOptions)
+    dataSet = dataSets.get(dataSetId)
+    if dataSet is None or dataSet.getSample() is None:
+        if logger is not None:
+            logger.error("Could not retrieve the sample of dataset " + dataSetCode +
+                         ": pyramids not requested.")
+        return None
+
+    # All series of the sample, with their geometry and children
+    criteria = DataSetSearchCriteria()
+    criteria.withType().withCode().thatEquals("MICROSCOPY_IMG_CONTAINER")
+    criteria.withSample().withPermId().thatEquals(dataSet.getSample().getPermId().getPermId())
+    fetchOptions = DataSetFetchOptions()
+    fetchOptions.withProperties()
+    fetchOptions.withChildren().withType()
+    containers = service.searchDataSets(sessionToken, criteria, fetchOptions).getObjects()
+
+    numQueued = 0
+    for container in containers:
+
+        containerCode = container.getCode()
+
+        if not _isLarge(container.getProperty("MICROSCOPY_IMG_CONTAINER_METADATA")):
+            continue
+
+        # Already generated?
+        if any(child.getType().getCode() == "MICROSCOPY_IMG_PYRAMID"
+               for child in container.getChildren()):
+            continue
+
+        # Queue the request (if it is not queued yet)
+        if not File(requestsDir, containerCode).createNewFile():
+            continue
+        File(requestsDir, ".MARKER_is_finished_" + containerCode).createNewFile()
+        numQueued += 1
+
+        if logger is not None:
+            logger.info("Queued pyramid generation for series " + containerCode + ".")
+
+    return numQueued
+
+
+def _isLarge(metadataXML):
+    """Return True if the series with given metadata (the
+    MICROSCOPY_IMG_CONTAINER_METADATA property) needs a pyramid."""
+
+    if metadataXML is None:
+        return False
+    try:
+        metadata = ET.fromstring(metadataXML).attrib
+        sizeX, sizeY, sizeZ, sizeC, sizeT = \
+            [int(metadata.get(key, "1")) for key in ["sizeX", "sizeY", "sizeZ", "sizeC", "sizeT"]]
+    except Exception:
+        return False
+    return max(sizeX, sizeY) > _MIN_PLANE_SIZE or sizeZ * sizeC * sizeT > _MIN_NUM_PLANES
@@ -0,0 +1,396 @@
+import jarray
+import os
+
+from ch.systemsx.cisd.openbis.dss.etl.dto.api.impl import MaximumIntensityProjectionGenerationAlgorithm
+from java.awt import RenderingHints
+from java.awt.image import BandCombineOp
+from java.awt.image import BufferedImage
+from java.awt.image import ComponentSampleModel
+from java.awt.image import DataBuffer
+from java.awt.image import Raster
+from java.awt.image import RescaleOp
+from java.io import File
+from java.lang import Float
+from java.lang import System
+from java.lang.reflect import Array
+from java.math import BigInteger
+from java.nio import ByteBuffer
+from java.util import ArrayList
+from java.util import Arrays
+
+
+class StreamingMaximumIntensityProjectionGenerationAlgorithm(MaximumIntensityProjectionGenerationAlgorithm):
+    """
+    MaximumIntensityProjectionGenerationAlgorithm with bounded memory and
+    time per plane.
+
+    Each plane is downsampled as soon as it is read and merged into a
+    running maximum accumulator for its channel. The planes are read one at
+    a time, so at most one full-resolution plane is in memory at any time,
+    and the projection itself is computed at once to twice the oversampled
+    thumbnail resolution, independently of the number of planes in the
+    stack. The planes are downsampled by an integer factor, with the mean of
+    the blocks of pixels computed on the raster samples (see _boxReduce()),
+    so that 16-bit data keeps its full precision. The running maximum and
+    the merging of the channels are done on Java arrays and rasters (see
+    _maximum()), not pixel by pixel.
+
+    Besides the thumbnail of size (width, height), the same projection can be
+    saved at additional sizes (e.g. 64 and 512 pixels): these are stored as
+    <filename>_<size>.<ext> next to the main thumbnail. Sizes larger than the
+    projection are skipped (the projection is never upscaled).
+    """
+
+    def __init__(self, datasetTypeCode, width, height, filename, oversampling=2,
+                 additionalSizes=None):
+        """
+        Constructor
+
+        oversampling:    the planes are downsampled to (at least) oversampling *
+                         (width, height) before they are projected.
+        additionalSizes: (optional) list of additional thumbnail sizes in pixels
+                         (the larger of width and height of the thumbnail), at
+                         most oversampling * max(width, height).
+        """
+
+        # Call the parent base constructor
+        MaximumIntensityProjectionGenerationAlgorithm.__init__(self,
+            datasetTypeCode, width, height, filename)
+
+        # Thumbnail size
+        self.width = width
+        self.height = height
+
+        # Resolution of the accumulators relative to the thumbnail
+        self.oversampling = max(1, int(oversampling))
+
+        # Thumbnail file name
+        self.filename = filename
+
+        # Additional thumbnail sizes (that fit in the projection)
+        if additionalSizes is None:
+            additionalSizes = []
+        maxSize = self.oversampling * max(width, height)
+        self.additionalSizes = [int(size) for size in additionalSizes if int(size) <= maxSize]
+
+        # (Optional) ChannelStatistics fed with the full-resolution planes
+        self.statistics = None
+
+        # Number of planes projected and of (uncompressed) bytes read during
+        # the last call to generateImages()
+        self.numProjectedPlanes = 0
+        self.numBytesRead = 0
+
+    def generateImages(self, information, thumbnailDatasets, imageProvider):
+
+        structure = information.getImageDataSetStructure()
+        incomingDirectory = information.getIncomingDirectory()
+        storageConfiguration = structure.getImageStorageConfiguraton()
+
+        # Planes to project
+        images = [image for image in structure.getImages()
+                  if not self.imageToBeIgnored(image)]
+
+        # Running maximum per channel code: [packed accumulator, width, height]
+        accumulators = {}
+
+        # Masks for _maximum() per number of pixels
+        laneMasks = {}
+
+        self.numProjectedPlanes = 0
+        self.numBytesRead = 0
+        for plane in self._readPlanes(images, incomingDirectory, storageConfiguration,
+                                      imageProvider):
+
+            if plane is None:
+                continue
+            channelCode, samples, accWidth, accHeight, numBytes, statisticsValues = plane
+            self.numBytesRead += numBytes
+            if statisticsValues is not None:
+                self.statistics.add(channelCode, statisticsValues)
+
+            # Update the running maximum of the channel
+            if channelCode in accumulators:
+                accumulator = accumulators[channelCode]
+                if accumulator[1] != accWidth or accumulator[2] != accHeight:
+                    # Planes with a different geometry are skipped
+                    continue
+                numPixels = accWidth * accHeight
+                if numPixels not in laneMasks:
+                    laneMasks[numPixels] = _getLaneMasks(numPixels)
+                guard, mask = laneMasks[numPixels]
+                accumulator[0] = _maximum(accumulator[0], _pack(samples), guard, mask)
+            else:
+                accumulators[channelCode] = [_pack(samples), accWidth, accHeight]
+
+            self.numProjectedPlanes += 1
+
+        result = ArrayList()
+        if len(accumulators) == 0:
+            return result
+
+        # Merge the channels and scale to all thumbnail sizes
+        projection = self._mergeChannels(accumulators, self._getChannelColors(structure))
+        result.add(self._scale(projection, self.width, self.height))
+        for size in self.additionalSizes:
+            result.add(self._scale(projection, size, size))
+        return result
+
+    def getImageFileName(self, index):
+        """File name of the thumbnail with given index: the main thumbnail
+        keeps the original file name, the additional sizes get the size as
+        suffix (e.g. thumbnail_512.png)."""
+
+        if index == 0:
+            return self.filename
+        base, ext = os.path.splitext(self.filename)
+        return base + "_" + str(self.additionalSizes[index - 1]) + ext
+
+    def _readPlanes(self, images, incomingDirectory, storageConfiguration, imageProvider):
+        """Read and downsample the planes in order, one at a time (the image
+        provider is not known to be thread-safe)."""
+
+        for image in images:
+            yield self._readPlane(image, incomingDirectory, storageConfiguration,
+                                  imageProvider)
+
+    def _readPlane(self, image, incomingDirectory, storageConfiguration, imageProvider):
+        """Read a full-resolution plane and immediately reduce it.
+
+        Returns (channelCode, samples, width, height, number of bytes read,
+        pixel values for the channel statistics or None), or None if the
+        plane could not be read.
+        """
+
+        plane = imageProvider.getImage(
+            File(incomingDirectory, image.getImageRelativePath()),
+            image.tryGetUniqueStringIdentifier(),
+            storageConfiguration)
+        if plane is None:
+            return None
+
+        numBytes = plane.getWidth() * plane.getHeight() * \
+            max(1, plane.getColorModel().getPixelSize() / 8)
+        factor = self._getReductionFactor(plane.getWidth(), plane.getHeight())
+        accWidth = plane.getWidth() / factor
+        accHeight = plane.getHeight() / factor
+        samples = self._downsample(plane, factor)
+        statisticsValues = None
+        if self.statistics is not None:
+            statisticsValues = self.statistics.subsample(plane)
+        return image.getChannelCode(), samples, accWidth, accHeight, numBytes, statisticsValues
+
+    def _getReductionFactor(self, width, height):
+        """Integer factor by which a plane of given size is downsampled: the
+        largest one that keeps the plane at least as large as oversampling
+        times the thumbnail size (in the dimension that needs the larger
+        reduction). The accumulator is therefore smaller than twice that
+        size, and a plane is never upscaled."""
+
+        maxWidth = self.oversampling * self.width
+        maxHeight = self.oversampling * self.height
+        return max(1, width / maxWidth, height / maxHeight)
+
+    def _downsample(self, plane, factor):
+        """Downsample a plane by given factor (mean of factor x factor pixels)
+        and return its pixel values."""
+
+        if factor == 1:
+            raster = _getComponentRaster(plane.getRaster(), 0)
+            return raster.getSamples(0, 0, raster.getWidth(), raster.getHeight(), 0, None)
+
+        reduced = _boxReduce(plane.getRaster(), 0, factor)
+        return reduced.getSamples(0, 0, reduced.getWidth(), reduced.getHeight(), 0, None)
+
+    def _getChannelColors(self, structure):
+        """Map channel code -> (R, G, B)."""
+
+        colors = {}
+        for channel in structure.getChannels():
+            color = channel.tryGetChannelColorRGB()
+            if color is None:
+                colors[channel.getCode()] = (255, 255, 255)
+            else:
+                colors[channel.getCode()] = (color.getR(), color.getG(), color.getB())
+        return colors
+
+    def _mergeChannels(self, accumulators, colors):
+        """Stretch the projection of each channel to its full intensity range
+        and combine all channels into one RGB image (maximum per component)."""
+
+        codes = accumulators.keys()
+        width, height = accumulators[codes[0]][1:3]
+
+        numPixels = width * height
+        guard, mask = _getLaneMasks(numPixels)
+
+        # Packed maximum per component (red, green, blue)
+        components = [None, None, None]
+
+        for code in codes:
+
+            accumulator, accWidth, accHeight = accumulators[code]
+            if accWidth != width or accHeight != height:
+                # Channels with a different geometry are skipped
+                continue
+
+            samples = _unpack(accumulator, numPixels)
+            low = min(samples)
+            high = max(samples)
+            raster = BufferedImage(width, height, BufferedImage.TYPE_USHORT_GRAY).getRaster()
+            raster.setPixels(0, 0, width, height, samples)
+
+            color = colors.get(code, (255, 255, 255))
+            for band in range(3):
+                # (v - low) * color / (high - low)
+                factor = color[band] / float(high - low) if high > low else 0.0
+                stretched = RescaleOp(factor, -low * factor, None).filter(raster, None)
+                value = _pack(stretched.getPixels(0, 0, width, height, None))
+                if components[band] is None:
+                    components[band] = value
+                else:
+                    components[band] = _maximum(components[band], value, guard, mask)
+
+        projection = BufferedImage(width, height, BufferedImage.TYPE_INT_RGB)
+        for band in range(3):
+            if components[band] is not None:
+                projection.getRaster().setSamples(0, 0, width, height, band,
+                                                  _unpack(components[band], numPixels))
+        return projection
+
+    def _scale(self, image, maxWidth, maxHeight):
+        """Scale an image to fit maxWidth x maxHeight (preserving the aspect ratio).
+
+        The image is first reduced by the largest integer factor that keeps
+        it larger than the thumbnail (mean of blocks of pixels, see
+        _boxReduce()); the remaining factor (less than 2) is interpolated."""
+
+        scale = min(float(maxWidth) / image.getWidth(), float(maxHeight) / image.getHeight())
+        width = max(1, int(round(image.getWidth() * scale)))
+        height = max(1, int(round(image.getHeight() * scale)))
+
+        factor = max(1, min(image.getWidth() / width, image.getHeight() / height))
+        if factor > 1:
+            reduced = BufferedImage(image.getWidth() / factor, image.getHeight() / factor,
+                                    BufferedImage.TYPE_INT_RGB)
+            for band in range(3):
+                reducedBand = _boxReduce(image.getRaster(), band, factor)
+                reduced.getRaster().setSamples(
+                    0, 0, reduced.getWidth(), reduced.getHeight(), band,
+                    reducedBand.getSamples(0, 0, reduced.getWidth(), reduced.getHeight(), 0, None))
+            image = reduced
+
+        thumbnail = BufferedImage(width, height, BufferedImage.TYPE_INT_RGB)
+        graphics = thumbnail.createGraphics()
+        try:
+            graphics.setRenderingHint(RenderingHints.KEY_INTERPOLATION,
+                                      RenderingHints.VALUE_INTERPOLATION_BILINEAR)
+            graphics.drawImage(image, 0, 0, width, height, None)
+        finally:
+            graphics.dispose()
+
+        return thumbnail
+
+
+def _boxReduce(raster, band, factor):
+    """Downsample a band of a raster by given factor: every pixel of the
+    result is the (rounded) mean of a block of factor x factor pixels.
+    Returns a 16-bit grayscale raster; the last rows and columns that do not
+    fill a block are dropped.
+
+    The mean is computed by a BandCombineOp on a view of the samples in
+    which the factor x factor pixels of every block are the bands of one
+    pixel, so that there is no loop over the pixels in Python."""
+
+    source = _getComponentRaster(raster, band)
+    sampleModel = source.getSampleModel()
+    pixelStride = sampleModel.getPixelStride()
+    scanlineStride = sampleModel.getScanlineStride()
+    offset = sampleModel.getBandOffsets()[0]
+
+    width = source.getWidth() / factor
+    height = source.getHeight() / factor
+    blockOffsets = [offset + y * scanlineStride + x * pixelStride
+                    for y in range(factor) for x in range(factor)]
+    blocks = Raster.createRaster(
+        ComponentSampleModel(sampleModel.getDataType(), width, height,
+                             factor * pixelStride, factor * scanlineStride,
+                             blockOffsets),
+        source.getDataBuffer(), None)
+
+    # Mean of the bands, + 0.5 to round
+    numBands = factor * factor
+    matrix = Array.newInstance(Float.TYPE, [1, numBands + 1])
+    matrix[0] = jarray.array([1.0 / numBands] * numBands + [0.5], "f")
+
+    reduced = BufferedImage(width, height, BufferedImage.TYPE_USHORT_GRAY).getRaster()
+    BandCombineOp(matrix, None).filter(blocks, reduced)
+    return reduced
+
+
+def _getComponentRaster(raster, band):
+    """Return the raster itself if it has the given band only, with 8- or
+    16-bit samples stored one after the other (the layout _boxReduce()
+    needs), or else a 16-bit grayscale copy of the band."""
+
+    sampleModel = raster.getSampleModel()
+    if isinstance(sampleModel, ComponentSampleModel) and \
+            raster.getNumBands() == 1 and band == 0 and \
+            sampleModel.getBankIndices()[0] == 0 and \
+            sampleModel.getDataType() in [DataBuffer.TYPE_BYTE, DataBuffer.TYPE_USHORT] and \
+            raster.getSampleModelTranslateX() == 0 and \
+            raster.getSampleModelTranslateY() == 0:
+        return raster
+
+    width = raster.getWidth()
+    height = raster.getHeight()
+    copy = BufferedImage(width, height, BufferedImage.TYPE_USHORT_GRAY).getRaster()
+    copy.setSamples(0, 0, width, height, 0,
+                    raster.getSamples(raster.getMinX(), raster.getMinY(),
+                                      width, height, band, None))
+    return copy
+
+
+def _pack(samples):
+    """Pack pixel values of at most 16 bits (int[]) into the 32-bit lanes of
+    a BigInteger, so that _maximum() can process all of them at once."""
+
+    data = ByteBuffer.allocate(4 * len(samples))
+    data.asIntBuffer().put(samples)
+    return BigInteger(1, data.array())
+
+
+def _unpack(lanes, numValues):
+    """Unpack numValues pixel values packed by _pack() into an int[]."""
+
+    packed = lanes.toByteArray()
+    data = jarray.zeros(4 * numValues, "b")
+    n = min(len(packed), len(data))
+    System.arraycopy(packed, len(packed) - n, data, len(data) - n, n)
+    samples = jarray.zeros(numValues, "i")
+    ByteBuffer.wrap(data).asIntBuffer().get(samples)
+    return samples
+
+
+def _getLaneMasks(numValues):
+    """Masks for _maximum() for numValues packed values: (guard, mask), with
+    bit 16 respectively bits 0 to 15 of every lane set."""
+
+    guard = jarray.zeros(numValues, "i")
+    Arrays.fill(guard, 0x10000)
+    mask = jarray.zeros(numValues, "i")
+    Arrays.fill(mask, 0xFFFF)
+    return _pack(guard), _pack(mask)
+
+
+def _maximum(a, b, guard, mask):
+    """Lane-wise maximum of two sets of values packed by _pack(), computed
+    with a few BigInteger operations instead of a loop over the pixels.
+
+    In every lane, a + 2^16 - b is positive (no borrow from the next lane)
+    and keeps bit 16 set if and only if a >= b; this bit selects a or b."""
+
+    difference = a.add(guard).subtract(b)
+    greaterOrEqual = difference.andNot(mask).shiftRight(16)
+    select = greaterOrEqual.shiftLeft(16).subtract(greaterOrEqual)
+    return a.andNot(mask.subtract(select)).add(b.andNot(select))
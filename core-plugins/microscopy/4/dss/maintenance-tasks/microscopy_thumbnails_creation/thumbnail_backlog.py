@@ -0,0 +1,42 @@
+from ch.systemsx.cisd.openbis.dss.generic.shared import ServiceProvider
+from ch.ethz.sis.openbis.generic.asapi.v3.dto.dataset.fetchoptions import DataSetFetchOptions
+from ch.ethz.sis.openbis.generic.asapi.v3.dto.dataset.id import DataSetPermId
+from ch.ethz.sis.openbis.generic.asapi.v3.dto.dataset.search import DataSetSearchCriteria
+from java.util import Date
+
+
+def getRegistrationTime(dataSetCode):
+    """Return the registration time (in ms since the epoch) of the dataset
+    with given code, or None if it cannot be retrieved."""
+
+    service = ServiceProvider.getV3ApplicationService()
+    sessionToken = ServiceProvider.getOpenBISService().getSessionToken()
+
+    dataSetId = DataSetPermId(dataSetCode)
+    dataSets = service.getDataSets(sessionToken, [dataSetId], DataSetFetchOptions())
+    dataSet = dataSets.get(dataSetId)
+    if dataSet is None or dataSet.getRegistrationDate() is None:
+        return None
+    return dataSet.getRegistrationDate().getTime()
+
+
+def countDataSetsRegisteredAfter(registrationTime):
+    """Return the number of MICROSCOPY_IMG_CONTAINER datasets registered
+    after the given time (in ms since the epoch).
+
+    The task hands the datasets to the script in the order of registration:
+    the datasets registered after the last one that was processed are the
+    ones still waiting for the task."""
+
+    service = ServiceProvider.getV3ApplicationService()
+    sessionToken = ServiceProvider.getOpenBISService().getSessionToken()
+
+    criteria = DataSetSearchCriteria()
+    criteria.withType().withCode().thatEquals("MICROSCOPY_IMG_CONTAINER")
+    criteria.withRegistrationDate().thatIsLaterThanOrEqualTo(Date(registrationTime + 1))
+
+    # Only the total count is needed
+    fetchOptions = DataSetFetchOptions()
+    fetchOptions.count(0)
+
+    return service.searchDataSets(sessionToken, criteria, fetchOptions).getTotalCount()
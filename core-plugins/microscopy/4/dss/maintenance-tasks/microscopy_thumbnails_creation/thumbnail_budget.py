@@ -0,0 +1,95 @@
+import os
+import time
+
+
+class ThumbnailBudget(object):
+    """
+    Time and byte budget for the generation of optional thumbnails (i.e. of
+    all series but the first) within a time window.
+
+    The maintenance task calls the script once per dataset, possibly in a
+    new interpreter every time: the consumed budget is therefore kept in a
+    small state file. The budget is reset when the current window expires.
+    """
+
+    def __init__(self, stateFile, window, maxSeconds, maxBytes):
+        """
+        Constructor
+
+        stateFile:  full path of the file that stores the consumed budget.
+        window:     length of the time window in seconds.
+        maxSeconds: maximum time (in seconds) to spend on optional thumbnails
+                    per window (0 for no limit).
+        maxBytes:   maximum number of bytes to read for optional thumbnails
+                    per window (0 for no limit).
+        """
+
+        self.stateFile = stateFile
+        self.window = window
+        self.maxSeconds = maxSeconds
+        self.maxBytes = maxBytes
+
+        # Consumed budget in the current window
+        self.windowStart = time.time()
+        self.seconds = 0.0
+        self.bytes = 0
+
+        self._load()
+
+    def isAvailable(self):
+        """Return True if there is budget left in the current window."""
+
+        if self.maxSeconds > 0 and self.seconds >= self.maxSeconds:
+            return False
+        if self.maxBytes > 0 and self.bytes >= self.maxBytes:
+            return False
+        return True
+
+    def consume(self, seconds, numBytes):
+        """Add the time and bytes spent on a thumbnail to the budget."""
+
+        self._load()
+        self.seconds += seconds
+        self.bytes += numBytes
+        self._save()
+
+    def _load(self):
+        """Read the consumed budget from the state file (and reset it if the
+        window has expired)."""
+
+        now = time.time()
+        try:
+            f = open(self.stateFile, "r")
+            try:
+                windowStart, seconds, numBytes = f.read().split()
+            finally:
+                f.close()
+            self.windowStart = float(windowStart)
+            self.seconds = float(seconds)
+            self.bytes = long(numBytes)
+        except (IOError, ValueError):
+            self.windowStart = now
+            self.seconds = 0.0
+            self.bytes = 0
+
+        if now - self.windowStart >= self.window:
+            self.windowStart = now
+            self.seconds = 0.0
+            self.bytes = 0
+
+    def _save(self):
+        """Write the consumed budget to the state file."""
+
+        folder = os.path.dirname(self.stateFile)
+        if folder != "" and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        f = open(self.stateFile, "w")
+        try:
+            f.write(str(self.windowStart) + " " + str(self.seconds) + " " + str(self.bytes))
+        finally:
+            f.close()
+
+    def __str__(self):
+        return "seconds = " + str(self.seconds) + "/" + str(self.maxSeconds) + \
+            ", bytes = " + str(self.bytes) + "/" + str(self.maxBytes)
@@ -0,0 +1,187 @@
+import hashlib
+import jarray
+import os
+import shutil
+import time
+
+from java.io import File
+from java.io import RandomAccessFile
+from javax.imageio import ImageIO
+
+
+class ThumbnailCache(object):
+    """
+    Cache of generated thumbnails keyed by a fingerprint of the source series,
+    so that the thumbnails of content that is registered again (e.g. after
+    an interrupted upload) are reused instead of being computed from the
+    image data again.
+
+    The fingerprint combines the series number, the thumbnail settings and,
+    for every file that the projection reads, its relative path and its size.
+    A hash of the first and last bytes is added for at most _MAX_SAMPLED_FILES
+    of these files, spread over them, so that a lookup reads a few hundred kB
+    at most, whatever the number of files.
+
+    Every entry is a folder <fingerprint>/ with one PNG per thumbnail size
+    (0.png, 1.png, ...) and, if available, the channel statistics
+    (statistics.xml). The least recently used entries are removed when the
+    cache grows beyond maxBytes.
+    """
+
+    # Number of bytes read from the start and from the end of a sampled file
+    _SAMPLE_BYTES = 16384
+
+    # Maximum number of files whose bytes are sampled
+    _MAX_SAMPLED_FILES = 8
+
+    def __init__(self, cacheDir, maxBytes, logger=None):
+        """
+        Constructor
+
+        cacheDir: folder of the cache.
+        maxBytes: maximum size of the cache in bytes.
+        logger:   (optional) logger.
+        """
+
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.logger = logger
+
+    def getFingerprint(self, information, seriesNum, settings, imageToBeIgnored=None):
+        """Return the fingerprint of the series of a dataset (None if a file
+        of the series cannot be read, e.g. if it is stored in an HDF5
+        container).
+
+        information: ImageDataSetInformation of the dataset.
+        seriesNum:   series number.
+        settings:    string describing the thumbnail settings.
+        imageToBeIgnored: (optional) function that returns True for the
+                     images that the projection does not read.
+        """
+
+        incomingDirectory = information.getIncomingDirectory()
+        structure = information.getImageDataSetStructure()
+
+        paths = set()
+        for image in structure.getImages():
+            if imageToBeIgnored is not None and imageToBeIgnored(image):
+                continue
+            paths.add(image.getImageRelativePath())
+        paths = sorted(paths)
+
+        # Files whose bytes are sampled
+        numSampled = min(len(paths), self._MAX_SAMPLED_FILES)
+        sampled = set([paths[i * len(paths) / numSampled] for i in range(numSampled)])
+
+        digest = hashlib.sha1()
+        digest.update(str(seriesNum) + "\n" + settings + "\n")
+        for path in paths:
+            f = File(incomingDirectory, path)
+            if not f.isFile():
+                return None
+            digest.update(path + "\n" + str(f.length()) + "\n")
+            if path in sampled:
+                digest.update(self._sample(f))
+        return digest.hexdigest()
+
+    def get(self, fingerprint):
+        """Return (list of images, statistics XML or None) for a fingerprint,
+        or None if it is not in the cache."""
+
+        entryDir = os.path.join(self.cacheDir, fingerprint)
+        if not os.path.isdir(entryDir):
+            return None
+
+        images = []
+        try:
+            while True:
+                imageFile = os.path.join(entryDir, str(len(images)) + ".png")
+                if not os.path.exists(imageFile):
+                    break
+                images.append(ImageIO.read(File(imageFile)))
+
+            statisticsXML = None
+            statisticsFile = os.path.join(entryDir, "statistics.xml")
+            if os.path.exists(statisticsFile):
+                f = open(statisticsFile, "r")
+                try:
+                    statisticsXML = f.read()
+                finally:
+                    f.close()
+        except Exception, e:
+            if self.logger is not None:
+                self.logger.error("Could not read cached thumbnail " + fingerprint + ": " + str(e))
+            return None
+
+        if len(images) == 0:
+            return None
+
+        # Mark the entry as recently used
+        now = time.time()
+        os.utime(entryDir, (now, now))
+
+        return images, statisticsXML
+
+    def put(self, fingerprint, images, statisticsXML=None):
+        """Store the thumbnails (and the channel statistics) of a series."""
+
+        entryDir = os.path.join(self.cacheDir, fingerprint)
+        tmpDir = entryDir + ".tmp"
+        try:
+            if os.path.exists(tmpDir):
+                shutil.rmtree(tmpDir)
+            os.makedirs(tmpDir)
+            for i in range(len(images)):
+                ImageIO.write(images[i], "png", File(os.path.join(tmpDir, str(i) + ".png")))
+            if statisticsXML is not None:
+                f = open(os.path.join(tmpDir, "statistics.xml"), "w")
+                try:
+                    f.write(statisticsXML)
+                finally:
+                    f.close()
+            if os.path.exists(entryDir):
+                shutil.rmtree(entryDir)
+            os.rename(tmpDir, entryDir)
+        except Exception, e:
+            if self.logger is not None:
+                self.logger.error("Could not cache thumbnail " + fingerprint + ": " + str(e))
+            return
+
+        self._evict()
+
+    def _sample(self, f):
+        """Return the first and last bytes of a file."""
+
+        raf = RandomAccessFile(f, "r")
+        try:
+            length = raf.length()
+            head = jarray.zeros(min(length, self._SAMPLE_BYTES), "b")
+            raf.readFully(head)
+            tail = jarray.zeros(min(length, self._SAMPLE_BYTES), "b")
+            raf.seek(length - len(tail))
+            raf.readFully(tail)
+            return head.tostring() + tail.tostring()
+        finally:
+            raf.close()
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache fits in
+        maxBytes."""
+
+        entries = []
+        totalBytes = 0
+        for name in os.listdir(self.cacheDir):
+            entryDir = os.path.join(self.cacheDir, name)
+            if not os.path.isdir(entryDir) or name.endswith(".tmp"):
+                continue
+            size = sum([os.path.getsize(os.path.join(entryDir, f)) for f in os.listdir(entryDir)])
+            entries.append((os.path.getmtime(entryDir), entryDir, size))
+            totalBytes += size
+
+        entries.sort()
+        while totalBytes > self.maxBytes and len(entries) > 0:
+            lastUsed, entryDir, size = entries.pop(0)
+            shutil.rmtree(entryDir, True)
+            totalBytes -= size
+            if self.logger is not None:
+                self.logger.info("Evicted cached thumbnail " + os.path.basename(entryDir) + ".")
@@ -0,0 +1,200 @@
+import os
+import time
+
+from thumbnail_backlog import countDataSetsRegisteredAfter
+from thumbnail_backlog import getRegistrationTime
+
+
+class ThumbnailMetrics(object):
+    """
+    Metrics of the thumbnail maintenance task: number of datasets waiting for
+    the task (queue depth), generation time, bytes read and failures per
+    dataset, totals and thumbnail cache hits and misses.
+
+    The queue depth is the number of MICROSCOPY_IMG_CONTAINER datasets
+    registered after the last dataset that was processed (see
+    thumbnail_backlog); it is unknown (-1) until a first dataset was
+    processed.
+
+    Like ThumbnailBudget, the metrics are kept in a small file, since the
+    script may be run in a new interpreter for every dataset. The same file
+    is meant to be read by monitoring: one "key = value" pair per line.
+    """
+
+    # Keys stored in the metrics file (in this order)
+    _KEYS = ["lastUpdate", "pendingDatasets", "lastRegistrationTime",
+             "lastDatasetSeriesNum", "lastDatasetImages",
+             "lastDatasetSeconds", "lastDatasetBytes", "lastDatasetStatus",
+             "totalDatasets", "totalFailures", "totalSeconds", "totalBytes",
+             "cacheHits", "cacheMisses"]
+
+    def __init__(self, metricsFile, logger=None):
+        """
+        Constructor
+
+        metricsFile: full path of the metrics file.
+        logger:      (optional) logger.
+        """
+
+        self.metricsFile = metricsFile
+        self.logger = logger
+
+        self.values = {}
+        self._load()
+
+    def updatePendingDatasets(self):
+        """Count the datasets waiting for the task and return the count (None
+        if it is unknown)."""
+
+        pending = -1
+        if self.values["lastRegistrationTime"] > 0:
+            try:
+                pending = countDataSetsRegisteredAfter(self.values["lastRegistrationTime"])
+            except Exception, e:
+                if self.logger is not None:
+                    self.logger.error("Could not count the pending datasets: " + str(e))
+        self.values["pendingDatasets"] = pending
+        self._save()
+
+        if pending < 0:
+            return None
+        return pending
+
+    def datasetStarted(self, seriesNum, numImages):
+        """Record that a dataset was handed to the script."""
+
+        self.values["lastDatasetSeriesNum"] = seriesNum
+        self.values["lastDatasetImages"] = numImages
+        self.values["lastDatasetSeconds"] = 0.0
+        self.values["lastDatasetBytes"] = 0
+        self.values["lastDatasetStatus"] = "started"
+        self._save()
+
+    def datasetSkipped(self):
+        """Record that no thumbnail is generated for the last dataset."""
+
+        self.values["lastDatasetStatus"] = "skipped"
+        self._save()
+
+    def datasetProcessed(self, dataSetCode, seconds, numBytes, failed=False):
+        """Record the result of the thumbnail generation for a dataset."""
+
+        # Registration time of the dataset (the datasets registered later are pending)
+        registrationTime = None
+        try:
+            registrationTime = getRegistrationTime(dataSetCode)
+        except Exception, e:
+            if self.logger is not None:
+                self.logger.error("Could not retrieve the registration time of dataset " +
+                                  dataSetCode + ": " + str(e))
+
+        # The generation may run after the script returned: reload first
+        self._load()
+
+        if registrationTime is not None and registrationTime > self.values["lastRegistrationTime"]:
+            self.values["lastRegistrationTime"] = registrationTime
+
+        self.values["lastDatasetSeconds"] = seconds
+        self.values["lastDatasetBytes"] = numBytes
+        self.values["totalDatasets"] += 1
+        self.values["totalSeconds"] += seconds
+        self.values["totalBytes"] += numBytes
+        if failed:
+            self.values["lastDatasetStatus"] = "failed"
+            self.values["totalFailures"] += 1
+        else:
+            self.values["lastDatasetStatus"] = "ok"
+        self._save()
+
+        if self.logger is not None:
+            self.logger.info("Thumbnail generation " + self.values["lastDatasetStatus"] +
+                             " in " + ("%.2f" % seconds) + " s (" + str(numBytes) +
+                             " bytes read); " + str(self))
+
+    def cacheLookup(self, hit):
+        """Record a lookup in the thumbnail cache."""
+
+        self._load()
+
+        if hit:
+            self.values["cacheHits"] += 1
+        else:
+            self.values["cacheMisses"] += 1
+        self._save()
+
+    def getCacheHitRate(self):
+        """Fraction of the lookups in the thumbnail cache that were hits
+        (None if there was no lookup yet)."""
+
+        lookups = self.values["cacheHits"] + self.values["cacheMisses"]
+        if lookups == 0:
+            return None
+        return float(self.values["cacheHits"]) / lookups
+
+    def _load(self):
+        """Read the metrics from file."""
+
+        for key in self._KEYS:
+            self.values[key] = 0
+        self.values["lastDatasetStatus"] = ""
+
+        try:
+            f = open(self.metricsFile, "r")
+        except IOError:
+            return
+
+        try:
+            for line in f:
+                parts = line.split("=")
+                if len(parts) != 2:
+                    continue
+                key = parts[0].strip()
+                value = parts[1].strip()
+                if key not in self._KEYS:
+                    continue
+                if key == "lastDatasetStatus":
+                    self.values[key] = value
+                    continue
+                try:
+                    if "." in value:
+                        self.values[key] = float(value)
+                    else:
+                        self.values[key] = long(value)
+                except ValueError:
+                    pass
+        finally:
+            f.close()
+
+    def _save(self):
+        """Write the metrics to file."""
+
+        self.values["lastUpdate"] = time.time()
+
+        folder = os.path.dirname(self.metricsFile)
+        if folder != "" and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        f = open(self.metricsFile, "w")
+        try:
+            for key in self._KEYS:
+                f.write(key + " = " + str(self.values[key]) + "\n")
+        finally:
+            f.close()
+
+    def __str__(self):
+        return "pending datasets = " + self._formatPending() + \
+            ", total datasets = " + str(self.values["totalDatasets"]) + \
+            ", total failures = " + str(self.values["totalFailures"]) + \
+            ", cache hit rate = " + self._formatHitRate()
+
+    def _formatPending(self):
+        if self.values["pendingDatasets"] < 0:
+            return "n/a"
+        return str(self.values["pendingDatasets"])
+
+    def _formatHitRate(self):
+        hitRate = self.getCacheHitRate()
+        if hitRate is None:
+            return "n/a"
+        return ("%.1f" % (100.0 * hitRate)) + " % (" + str(self.values["cacheHits"]) + \
+            "/" + str(self.values["cacheHits"] + self.values["cacheMisses"]) + ")"
@@ -0,0 +1,58 @@
+import os
+
+from ch.systemsx.cisd.openbis.dss.generic.shared import ServiceProvider
+from ch.ethz.sis.openbis.generic.asapi.v3.dto.dataset.fetchoptions import DataSetFetchOptions
+from ch.ethz.sis.openbis.generic.asapi.v3.dto.dataset.id import DataSetPermId
+from java.io import File
+from java.lang import System
+
+
+def requestThumbnailSheets(dataSetCode, requestsDir, logger=None):
+    """Queue a refresh of the thumbnail sheets of the MICROSCOPY_EXPERIMENT
+    of the dataset with given code in the MicroscopyThumbnailSheetDropbox.
+
+    The request is a file named after the permId of the MICROSCOPY_EXPERIMENT
+    sample in requestsDir (the incoming folder of the dropbox). It is touched
+    if it already exists, so that the dropbox processes it once for all the
+    thumbnails of a batch.
+
+    Returns True if the request was queued."""
+
+    service = ServiceProvider.getV3ApplicationService()
+    sessionToken = ServiceProvider.getOpenBISService().getSessionToken()
+
+    # Find the MICROSCOPY_EXPERIMENT sample
+    fetchOptions = DataSetFetchOptions()
+    fetchOptions.withSample().withParents().withType()
+    dataSetId = DataSetPermId(dataSetCode)
+    dataSets = service.getDataSets(sessionToken, [dataSetId], fetchOptions)
+    dataSet = dataSets.get(dataSetId)
+    if dataSet is None or dataSet.getSample() is None:
+        if logger is not None:
+            logger.error("Could not retrieve the sample of dataset " + dataSetCode +
+                         ": thumbnail sheets not requested.")
+        return False
+
+    expSample = None
+    for parent in dataSet.getSample().getParents():
+        if parent.getType().getCode() == "MICROSCOPY_EXPERIMENT":
+            expSample = parent
+            break
+
+    if expSample is None:
+        if logger is not None:
+            logger.error("Dataset " + dataSetCode + " has no MICROSCOPY_EXPERIMENT: " +
+                         "thumbnail sheets not requested.")
+        return False
+
+    if not os.path.isdir(requestsDir):
+        if logger is not None:
+            logger.error("The thumbnail sheet requests folder " + requestsDir +
+                         " does not exist: thumbnail sheets not requested.")
+        return False
+
+    requestFile = File(requestsDir, expSample.getPermId().getPermId())
+    if not requestFile.createNewFile():
+        requestFile.setLastModified(System.currentTimeMillis())
+
+    return True
@@ -10,19 +10,80 @@ from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto import SearchSubCriteria
 from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto.SearchCriteria import MatchClause
 from ch.systemsx.cisd.openbis.generic.shared.api.v1.dto.SearchCriteria import MatchClauseAttribute
 from ch.systemsx.cisd.base.utilities import OSUtilities
+from ch.systemsx.cisd.openbis.dss.generic.shared import ServiceProvider
+from ch.ethz.sis.openbis.generic.asapi.v3.dto.dataset.fetchoptions import DataSetFetchOptions
+from ch.ethz.sis.openbis.generic.asapi.v3.dto.dataset.id import DataSetPermId
+import itertools
+import json
 import os
+import stat
 import subprocess
 import sys
 import re
+import time
 import zipfile
+import jarray
 import java.io.File
+from java.io import FileInputStream
+from java.io import FileOutputStream
+from java.io import RandomAccessFile
+from java.lang import System
+from java.lang import UnsupportedOperationException
+from java.nio.file import FileAlreadyExistsException
+from java.nio.file import Files
+from java.nio.file import FileSystemException
+from java.nio.file import Paths
+from java.nio.file import StandardCopyOption
+from java.util.zip import CRC32
+from java.lang.management import ManagementFactory
 import logging
-from ch.ethz.scu.obit.common.server.longrunning import LRCache
 import uuid
-from threading import Thread
+import export_scheduler
+from java.util.concurrent import Callable
+from java.util.concurrent import ExecutionException
+from java.util.concurrent import Executors
 
 _DEBUG = False
 
+# Maximum number of bytes transferred per call when copying a file in-process
+_COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Default number of threads copying files in parallel (can be overridden by
+# copy_workers in plugin.properties)
+_NUM_COPY_WORKERS = 8
+
+# Files larger than this are split in parts of _COPY_PART_SIZE bytes that
+# are copied in parallel
+_COPY_PART_MIN_SIZE = 1024 * 1024 * 1024
+_COPY_PART_SIZE = 256 * 1024 * 1024
+
+# Default number of exports running at the same time, and per user (can be
+# overridden by export_workers and export_jobs_per_user in plugin.properties)
+_NUM_EXPORT_WORKERS = 2
+_NUM_EXPORT_JOBS_PER_USER = 1
+
+# Jobs are kept in the job store for _JOB_TTL_SECONDS after their last
+# update; progress is written at most every _JOB_PROGRESS_INTERVAL seconds
+_JOB_TTL_SECONDS = 24 * 3600
+_JOB_PROGRESS_INTERVAL = 2
+
+# Copy strategies (see Mover._copyFile()), in the order they are reported
+_COPY_STRATEGIES = ["reflink", "hardlink", "copy"]
+
+# Maximum number of failed files listed in the error message
+_MAX_REPORTED_ERRORS = 10
+
+# Size of the buffer used to stream files out of HDF5 containers into
+# the zip archive
+_ZIP_BUFFER_SIZE = 1024 * 1024
+
+
+def _getPluginPath():
+    """Return the path to the containing folder."""
+
+    # __file__ does not work (reliably) in Jython
+    return "../core-plugins/microscopy/4/dss/reporting-plugins/export_microscopy_datasets"
+
 
 def touch(full_file):
     """Touches a file.
@@ -31,79 +92,190 @@ def touch(full_file):
     f.close()
 
 
-def c_unique(seq):
-    """Implements 'unique' of a list.
+def _isCrossDeviceError(e):
+    """Checks whether a java.nio.file.FileSystemException was caused by a
+    link across devices (EXDEV).
     """
-    seen = set()
-    seen_add = seen.add
-    return [ x for x in seq if not (x in seen or seen_add(x))]
+    reason = e.getReason()
+    return reason is not None and "cross-device" in reason.lower()
 
 
-def zip_folder(folder_path, output_path):
-    """Zip the contents of an entire folder recursively. Please notice that
-    empty sub-folders will NOT be included in the archive.
+def format_size(num_bytes):
+    """Formats a size in bytes for display (e.g. "1.5 GB").
+    """
+    if num_bytes < 1024:
+        return str(num_bytes) + " bytes"
+    size = float(num_bytes)
+    for unit in ["kB", "MB", "GB", "TB"]:
+        size /= 1024
+        if size < 1024 or unit == "TB":
+            return "%.1f %s" % (size, unit)
+
+
+def zip_write_stream(zip_file, input_stream, file_size, arc_name):
+    """Writes the content of a (Java) input stream to a new stored entry of
+    an open zip file, computing the CRC on the fly. This is the equivalent
+    of zip_file.write() for content that is not a file on disk (Jython's
+    zipfile cannot open entries for writing): the local header is written
+    first and rewritten with the CRC once the data is written.
     """
 
-    # Note: os.path.relpath() does not exist in Jython.
-    # target = os.path.relpath(folder_path, start=os.path.dirname(folder_path))
-    target = folder_path[folder_path.rfind(os.sep) + 1:]
-
-    # Simple trick to build relative paths
-    root_len = folder_path.find(target)
-
-    try:
-
-        # Open zip file (no compression)
-        zip_file = zipfile.ZipFile(output_path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+    zinfo = zipfile.ZipInfo(arc_name, time.localtime(time.time())[:6])
+    zinfo.external_attr = 0600 << 16L
+    zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.file_size = file_size
+    zinfo.compress_size = file_size
+    zinfo.flag_bits = 0x00
+    zinfo.header_offset = zip_file.fp.tell()
+    zinfo.CRC = 0
+    zip64 = file_size > zipfile.ZIP64_LIMIT
+    zip_file.fp.write(zinfo.FileHeader(zip64))
+
+    crc = CRC32()
+    buf = jarray.zeros(_ZIP_BUFFER_SIZE, 'b')
+    written = 0
+    while True:
+        n = input_stream.read(buf)
+        if n < 0:
+            break
+        crc.update(buf, 0, n)
+        zip_file.fp.write(buf[:n].tostring())
+        written += n
+
+    if written != file_size:
+        raise Exception("Expected " + str(file_size) + " bytes for " + arc_name +
+                        ", got " + str(written) + ".")
+
+    # Rewrite the local header with the CRC
+    zinfo.CRC = crc.getValue()
+    position = zip_file.fp.tell()
+    zip_file.fp.seek(zinfo.header_offset, 0)
+    zip_file.fp.write(zinfo.FileHeader(zip64))
+    zip_file.fp.seek(position, 0)
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
+
+
+def getScheduler(properties):
+    """Returns the ExportScheduler shared by all calls to the plug-in (it is
+    created on first use)."""
+
+    numWorkers = _NUM_EXPORT_WORKERS
+    numJobsPerUser = _NUM_EXPORT_JOBS_PER_USER
+    if properties is not None:
+        numWorkers = max(1, int(properties.get('export_workers', numWorkers)))
+        numJobsPerUser = max(1, int(properties.get('export_jobs_per_user', numJobsPerUser)))
+    return export_scheduler.getScheduler(numWorkers, numJobsPerUser)
+
+
+class ExportJobStore():
+    """
+    Stores the status and progress of the export jobs (as returned to the
+    clients by aggregate()) on disk, one JSON file per job, so that they
+    survive the plug-in calls and a restart of the DSS. Jobs are removed
+    _JOB_TTL_SECONDS after their last update.
+
+    Every job records the start time of the JVM that runs it: a job that
+    did not complete in a JVM that is no longer running was interrupted by
+    a restart and is reported as failed (see get()).
+    """
 
-        # Now recurse into the folder
-        for root, folders, files in os.walk(folder_path):
+    def __init__(self, storeDir, ttl=_JOB_TTL_SECONDS):
+        """Constructor
 
-            # We do not process folders. This is only useful to store empty
-            # folders to the archive, but 1) jython's zipfile implementation
-            # throws:
-            #
-            #     Exception: [Errno 21] Is a directory <directory_name>
-            #
-            # when trying to write a directory to a zip file (in contrast to
-            # Python's implementation) and 2) oBIT does not export empty
-            # folders in the first place.
+        storeDir: folder of the job files.
+        ttl     : time (in seconds) after the last update before a job is
+                  removed.
+        """
 
-            # Build the relative directory path (current root)
-            relative_dir_path = os.path.abspath(root)[root_len:]
+        self._storeDir = storeDir
+        self._ttl = ttl
 
-            # If a folder only contains a subfolder, we disrupt the hierarchy,
-            # unless we add a file.
-            if len(files) == 0:
-                touch(os.path.join(root, '~'))
-                files.append('~')
+        # Start time of the JVM
+        self._serverStart = ManagementFactory.getRuntimeMXBean().getStartTime()
 
-            # Include all files
-            for file_name in files:
+        if not os.path.isdir(self._storeDir):
+            os.makedirs(self._storeDir)
 
-                # Full file path to add
-                full_file_path = os.path.join(root, file_name)
-                relative_file_path = os.path.join(relative_dir_path, file_name)
+    def get(self, uid):
+        """Returns the job with given uid, or None if it does not exist (or
+        was removed)."""
 
-                # Workaround problem with file name encoding
-                full_file_path = full_file_path.encode('latin-1')
-                relative_file_path = relative_file_path.encode('latin-1')
+        fileName = self._getFileName(uid)
+        try:
+            f = open(fileName, "r")
+        except IOError:
+            return None
+        try:
+            job = json.load(f)
+        finally:
+            f.close()
+
+        # Interrupted by a restart?
+        if not job["completed"] and job.get("serverStart") != self._serverStart:
+            job["completed"] = True
+            job["success"] = False
+            job["message"] = "The export was interrupted by a restart of the " + \
+                "server. Please export the data again."
+            self.set(uid, job)
+
+        return job
+
+    def set(self, uid, job):
+        """Stores a job (written to a temporary file first)."""
+
+        job["serverStart"] = self._serverStart
+        job["updated"] = time.time()
+        fileName = self._getFileName(uid)
+        tmpFileName = fileName + ".tmp"
+        f = open(tmpFileName, "w")
+        try:
+            json.dump(job, f)
+        finally:
+            f.close()
+        os.rename(tmpFileName, fileName)
+
+    def evict(self):
+        """Removes the jobs that were not updated for longer than the TTL."""
+
+        now = time.time()
+        for name in os.listdir(self._storeDir):
+            fileName = os.path.join(self._storeDir, name)
+            try:
+                if now - os.path.getmtime(fileName) > self._ttl:
+                    os.remove(fileName)
+            except OSError:
+                pass
+
+    def _getFileName(self, uid):
+        """Returns the file name of a job (the uid is generated by the
+        plug-in, but also sent back by the clients)."""
+
+        return os.path.join(self._storeDir, re.sub("[^a-zA-Z0-9-]", "_", uid) + ".json")
+
+
+def getJobStore():
+    """Returns the store of the export jobs, in the jobs_dir folder set in
+    plugin.properties (by default, the microscopy-export-jobs folder in the
+    temporary folder of the DSS)."""
 
-                # Write to zip
-                zip_file.write(full_file_path, relative_file_path, \
-                               zipfile.ZIP_STORED)
+    properties = parsePropertiesFile()
+    if properties is not None and "jobs_dir" in properties:
+        storeDir = properties["jobs_dir"]
+    else:
+        storeDir = os.path.join(System.getProperty("java.io.tmpdir"), "microscopy-export-jobs")
+    return ExportJobStore(storeDir)
 
-    except IOError, message:
-        raise Exception(message)
 
-    except OSError, message:
-        raise Exception(message)
+class _CopyJob(Callable):
+    """Runs one copy job of the Mover in a worker thread."""
 
-    except zipfile.BadZipfile, message:
-        raise Exception(message)
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
 
-    finally:
-        zip_file.close()
+    def call(self):
+        return self.function(*self.args)
 
 
 class Mover():
@@ -112,7 +284,8 @@ class Mover():
     performs the actual copying.
     """
 
-    def __init__(self, experimentId, expSamplePermId, samplePermId, mode, userId, properties, logger):
+    def __init__(self, experimentId, expSamplePermId, samplePermId, mode, userId, properties, logger,
+                 isCancelled=None, progress=None):
         """Constructor
 
         experimentId   : id of the (COLLECTION) experiment (must be specified)
@@ -128,11 +301,29 @@ class Mover():
         userId:          user id.
         properties:      plug-in properties. 
         logger:          logger.
+        isCancelled:     (optional) function that returns True if the export
+                         was cancelled: it is then stopped at the next file.
+        progress:        (optional) function called with (files done, files
+                         total, bytes done, bytes total, estimated bytes) as
+                         the export proceeds.
         """
 
         # Logger
         self._logger = logger
 
+        # Cancellation check
+        self._isCancelled = isCancelled
+
+        # Progress report
+        self._progress = progress
+        self._numFilesTotal = 0
+        self._numBytesTotal = 0
+        self._numFilesDone = 0
+        self._numBytesDone = 0
+
+        # Size of the export estimated before it starts (see _checkSpace())
+        self._numBytesEstimated = 0
+
         # Inform
         if _DEBUG:
             self._logger.info("Mover called with parameters: \n" +
@@ -266,6 +457,55 @@ class Mover():
         # Keep track of the number of copied files
         self._numCopiedFiles = 0
 
+        # Keep track of the number of copied bytes
+        self._numCopiedBytes = 0
+
+        # Number of threads copying the files
+        self._numCopyWorkers = _NUM_COPY_WORKERS
+        if 'copy_workers' in self._properties:
+            self._numCopyWorkers = max(1, int(self._properties['copy_workers']))
+
+        # Files that could not be copied: list of (file, error)
+        self._copyErrors = []
+
+        # Zero-copy export (reflink or hardlink) if the export folder is on
+        # the same file system as the datastore; each strategy is disabled
+        # for the rest of the export as soon as it fails
+        self._zeroCopy = self._properties.get('zero_copy', 'false').lower() == 'true'
+        self._reflinkSupported = self._zeroCopy and self._mode != "zip"
+        self._hardlinkSupported = self._zeroCopy and self._mode != "zip"
+
+        # Number of copied files per strategy
+        self._numFilesPerStrategy = dict([(strategy, 0) for strategy in _COPY_STRATEGIES])
+
+        # Incremental export: the experiment is always exported to the same
+        # folder, and the files that are already there (same size and
+        # modification time, and optionally same checksum) are skipped
+        self._incremental = self._mode != "zip" and \
+            self._properties.get('incremental_export', 'false').lower() == 'true'
+        self._incrementalChecksum = self._incremental and \
+            self._properties.get('incremental_checksum', 'false').lower() == 'true'
+
+        # Keep track of the number of skipped files and bytes
+        self._numSkippedFiles = 0
+        self._numSkippedBytes = 0
+
+        # Content nodes of the files on disk (to retrieve the stored checksums)
+        self._contentNodes = {}
+
+        # Modification times to set on the files copied in incremental mode:
+        # file -> (destination file, modification time)
+        self._modificationTimes = {}
+
+        # Zip archive the files are written to (in "zip" mode)
+        self._zipArchive = None
+
+        # Maximum size of the data in the user folder (optional, in GB):
+        # exports that would exceed it are refused
+        self._userQuota = None
+        if 'user_quota' in self._properties:
+            self._userQuota = long(float(self._properties['user_quota']) * 1024 * 1024 * 1024)
+
     # Public methods
     # =========================================================================
 
@@ -298,6 +538,15 @@ class Mover():
                 self._logger.error(self._message)
                 return False
 
+        # Make sure that the export fits in the user folder before anything
+        # is written
+        if not self._checkSpace():
+            return False
+
+        # In "zip" mode, the files are streamed straight into the archive
+        if self._mode == "zip":
+            return self._zipFilesForExperiment()
+
         # At this stage we can create the experiment folder in the user dir
         # (and export root)
         if not self._createRootAndExperimentFolder():
@@ -311,14 +560,6 @@ class Mover():
         return (self._copyFilesForExperiment("MICROSCOPY_IMG_CONTAINER") and
                 self._copyFilesForExperiment("MICROSCOPY_ACCESSORY_FILE"))
 
-    def compressIfNeeded(self):
-        """Compresses the exported experiment folder to a zip archive
-        but only if the mode was "zip".
-        """
-
-        if self._mode == "zip":
-            zip_folder(self._rootExportPath, self.getZipArchiveFullPath())
-
     def getZipArchiveFullPath(self):
         """Return the full path of the zip archive (or "" if mode was "normal").
         """
@@ -343,12 +584,52 @@ class Mover():
         """
         return self._message
 
+    def getProgress(self):
+        """
+        Return (files done, files total, bytes done, bytes total): files
+        done include the skipped and the failed files.
+        """
+        return (self._numFilesDone, self._numFilesTotal,
+                self._numBytesDone, self._numBytesTotal)
+
+    def getEstimatedSize(self):
+        """
+        Return the size of the export in bytes, as estimated before it started.
+        """
+        return self._numBytesEstimated
+
+    def getNumberOfSkippedFiles(self):
+        """
+        Return the number of files skipped because they were already exported.
+        """
+        return self._numSkippedFiles
+
+    def getNumberOfSkippedBytes(self):
+        """
+        Return the number of bytes of the skipped files.
+        """
+        return self._numSkippedBytes
+
+    def getCopyStrategies(self):
+        """
+        Return the number of files copied with each strategy, as a string
+        (e.g. "reflink: 12, hardlink: 0, copy: 3").
+        """
+        return ", ".join([strategy + ": " + str(self._numFilesPerStrategy[strategy])
+                          for strategy in _COPY_STRATEGIES])
+
     def getNumberOfCopiedFiles(self):
         """
         Return the number of copied files.
         """
         return self._numCopiedFiles
 
+    def getNumberOfCopiedBytes(self):
+        """
+        Return the number of copied bytes.
+        """
+        return self._numCopiedBytes
+
     def getRelativeRootExperimentPath(self):
         """
         Return the experiment path relative to the user folder.
@@ -483,6 +764,9 @@ class Mover():
         getErrorMessage() method.
         """
 
+        if self._cancelled():
+            return False
+
         # Only two types of experiment are allowed
         assert requestedDatasetType == "MICROSCOPY_IMG_CONTAINER" or requestedDatasetType == "MICROSCOPY_ACCESSORY_FILE", \
             "Input argument 'requestedDatasetType' must be one of MICROSCOPY_IMG_CONTAINER or MICROSCOPY_ACCESSORY_FILE."
@@ -503,34 +787,171 @@ class Mover():
             self._logger.error("Experiment does not contain datasets of type MICROSCOPY_IMG_CONTAINER.")
             return False
 
-        # Get the files for the datasets
+        # Walk the files of the datasets (lazily: they are enumerated while
+        # they are copied)
         dataSetFiles = self._getFilesForDataSets(dataSets, requestedDatasetType)
-        if requestedDatasetType == "MICROSCOPY_IMG_CONTAINER" and len(dataSetFiles) == 0:
-            self._logger.error("Datasets do not contain files.")
+        try:
+            firstFile = dataSetFiles.next()
+        except StopIteration:
+            if requestedDatasetType == "MICROSCOPY_IMG_CONTAINER":
+                self._message = "Could not retrieve dataset files!"
+                self._logger.error(self._message)
+                return False
+            return True
+        dataSetFiles = itertools.chain([firstFile], dataSetFiles)
+
+        # Copy the files to the experiment folder (or the zip archive)
+        if self._zipArchive is not None:
+            return self._zipFiles(dataSetFiles)
+        return self._copyFiles(dataSetFiles, self._experimentPath)
+
+    def _fileDone(self, numBytes):
+        """Records that a file of numBytes bytes is exported (or skipped)."""
+
+        self._numFilesDone += 1
+        self._numBytesDone += numBytes
+        self._reportProgress()
+
+    def _reportProgress(self):
+        """Reports the progress of the export (if requested)."""
+
+        if self._progress is not None:
+            self._progress(self._numFilesDone, self._numFilesTotal,
+                           self._numBytesDone, self._numBytesTotal,
+                           self._numBytesEstimated)
+
+    def _cancelled(self):
+        """Returns True (and sets the error message) if the export was
+        cancelled."""
+
+        if self._isCancelled is None or not self._isCancelled():
             return False
+        self._message = "The export was cancelled."
+        return True
 
-        if _DEBUG:
-            self._logger.info("Found " + str(len(dataSetFiles)) + " files for "
-                              "dataSets of type " + requestedDatasetType +
-                              " to copy.")
+    def _checkSpace(self):
+        """
+        Estimates the size of the export (see _estimateSize()) and checks that
+        it fits in the free space of the user folder and, if user_quota is
+        set, in what is left of the quota of the user. In incremental mode,
+        the size of the previous export of the experiment is deducted, since
+        its files are skipped or overwritten. The free space is checked for
+        zero-copy exports as well: which files can be linked rather than
+        copied is only known while they are exported.
+
+        Returns True if the export fits. Otherwise, returns False and sets
+        the error message in self._message.
+        """
 
-        # Process returned dataset files
-        if dataSetFiles:
+        self._numBytesEstimated = self._estimateSize()
+        self._reportProgress()
 
-            # Since sub-series reference the same file, we make sure to keep
-            # a unique version of the file list
-            dataSetFiles = c_unique(dataSetFiles)
+        numBytesNeeded = self._numBytesEstimated
+        if self._incremental:
+            numBytesNeeded = max(0, numBytesNeeded - self._getFolderSize(self._rootExportPath))
 
-            # Copy the files to the experiment folder
-            for micrFile in dataSetFiles:
-                if os.path.isdir(micrFile):
-                    self._copyDir(micrFile, self._experimentPath)
-                else:
-                    self._copyFile(micrFile, self._experimentPath)
+        freeBytes = java.io.File(self._userFolder).getUsableSpace()
+        self._logger.info("Estimated export size: " + str(self._numBytesEstimated) +
+                          " bytes (" + str(numBytesNeeded) + " bytes needed, " +
+                          str(freeBytes) + " bytes free).")
+
+        if numBytesNeeded > freeBytes:
+            self._message = "The export needs about " + format_size(numBytesNeeded) + \
+                ", but only " + format_size(freeBytes) + " are free in the export folder."
+            self._logger.error(self._message)
+            return False
+
+        if self._userQuota is not None:
+            usedBytes = self._getFolderSize(self._userFolder)
+            if usedBytes + numBytesNeeded > self._userQuota:
+                self._message = "The export needs about " + format_size(numBytesNeeded) + \
+                    ", but only " + format_size(max(0, self._userQuota - usedBytes)) + \
+                    " of your quota of " + format_size(self._userQuota) + \
+                    " are left. Please remove some older exports."
+                self._logger.error(self._message)
+                return False
 
-        # Return success
         return True
 
+    def _estimateSize(self):
+        """
+        Returns the estimated size of the export in bytes. The image files of
+        a sample are sized by its MICROSCOPY_SAMPLE_SIZE_IN_BYTES property, or
+        by the size of its datasets stored in openBIS if the property is not
+        set; the accessory files are always sized by their datasets. The
+        datasets of all samples are retrieved at once and no files are
+        listed.
+        """
+
+        if self._exportCompleteExperiment:
+            samples = self._getSamples(self._expSampleType, self._expSamplePermId,
+                                       self._sampleType)
+            samplePermId = None
+        else:
+            samples = [self._sample]
+            samplePermId = self._samplePermId
+
+        # Size of the samples that have the property
+        sampleSizes = {}
+        for sample in samples:
+            try:
+                sampleSizes[sample.getPermId()] = \
+                    long(sample.getPropertyValue("MICROSCOPY_SAMPLE_SIZE_IN_BYTES"))
+            except (TypeError, ValueError):
+                pass
+
+        # Datasets of the other samples, and accessory files
+        dataSets = self._getDataSets(self._expSampleType, self._expSamplePermId,
+                                     self._sampleType, samplePermId,
+                                     "MICROSCOPY_IMG_CONTAINER")
+        dataSetCodes = [dataSet.getDataSetCode() for dataSet in dataSets
+                        if dataSet.getSample().getPermId() not in sampleSizes]
+        dataSets = self._getDataSets(self._expSampleType, self._expSamplePermId,
+                                     self._sampleType, samplePermId,
+                                     "MICROSCOPY_ACCESSORY_FILE")
+        dataSetCodes += [dataSet.getDataSetCode() for dataSet in dataSets]
+
+        return sum(sampleSizes.values()) + self._getDataSetSizes(dataSetCodes)
+
+    def _getDataSetSizes(self, dataSetCodes):
+        """Returns the total size in bytes of the datasets with given codes,
+        as stored in openBIS (the size of a container is the size of its
+        components; datasets whose size is not known count as 0)."""
+
+        if len(dataSetCodes) == 0:
+            return 0
+
+        service = ServiceProvider.getV3ApplicationService()
+        sessionToken = ServiceProvider.getOpenBISService().getSessionToken()
+
+        fetchOptions = DataSetFetchOptions()
+        fetchOptions.withPhysicalData()
+        fetchOptions.withComponents().withPhysicalData()
+        dataSets = service.getDataSets(sessionToken,
+                                       [DataSetPermId(code) for code in dataSetCodes],
+                                       fetchOptions)
+
+        numBytes = 0
+        for dataSet in dataSets.values():
+            parts = [dataSet]
+            if dataSet.getPhysicalData() is None:
+                parts = dataSet.getComponents()
+            for part in parts:
+                physicalData = part.getPhysicalData()
+                if physicalData is not None and physicalData.getSize() is not None:
+                    numBytes += physicalData.getSize()
+        return numBytes
+
+    def _getFolderSize(self, folder):
+        """Returns the total size in bytes of the files in folder (0 if it
+        does not exist)."""
+
+        numBytes = 0
+        for root, folders, files in os.walk(folder):
+            for f in files:
+                numBytes += os.lstat(os.path.join(root, f)).st_size
+        return numBytes
+
     def _getDataSetsForMicroscopySampleType(self, requestedDatasetType="MICROSCOPY_IMG_CONTAINER"):
         """
         Return a list of datasets of requested type belonging to the MICROSCOPY_EXPERIMENT sample 
@@ -593,46 +1014,50 @@ class Mover():
                               requestedDatasetType + " from " +
                               "MICROSCOPY_SAMPLE_TYPE samples.")
 
-        # Initialize dataSets list
-        dataSets = []
-
-        # Process all samples
-        for sample in samples:
+        # Retrieve the datasets of all samples at once
+        dataSets = self._getDataSets(self._expSampleType,
+                                     self._expSamplePermId,
+                                     self._sampleType,
+                                     None,
+                                     requestedDatasetType)
 
-            if _DEBUG:
-                self._logger.info("* Querying sample with identifier " + sample.getSampleIdentifier() + \
-                                  " and permId " + sample.getPermId())
-
-            # Retrieve datasets for sample
-            currentDataSets = self._getDataSets(self._expSampleType,
-                                                self._expSamplePermId,
-                                                self._sampleType,
-                                                sample.getPermId(),
-                                                requestedDatasetType)
-
-            # We expect that ALL samples have at least one dataset of type MICROSCOPY_IMG_CONTAINER,
-            # but samples of type MICROSCOPY_ACCESSORY_FILE may be absent.
-            numRetrievedDataSets = len(currentDataSets)
-            if numRetrievedDataSets == 0 and requestedDatasetType == "MICROSCOPY_IMG_CONTAINER":
-                self._message = "Could not retrieve any datasets for sample of type " + \
-                "MICROSCOPY_SAMPLE_TYPE and permId " + sample.getPermId() + "."
-                self._logger.error(self._message)
-                # Return an empty list of datasets
-                dataSets = []
-                return dataSets
+        # Group them by sample
+        dataSetsPerSample = {}
+        for dataSet in dataSets:
+            samplePermId = dataSet.getSample().getPermId()
+            dataSetsPerSample.setdefault(samplePermId, []).append(dataSet)
+
+        # We expect that ALL samples have at least one dataset of type MICROSCOPY_IMG_CONTAINER,
+        # but samples of type MICROSCOPY_ACCESSORY_FILE may be absent.
+        if requestedDatasetType == "MICROSCOPY_IMG_CONTAINER":
+            for sample in samples:
+                if sample.getPermId() not in dataSetsPerSample:
+                    self._message = "Could not retrieve any datasets for sample of type " + \
+                    "MICROSCOPY_SAMPLE_TYPE and permId " + sample.getPermId() + "."
+                    self._logger.error(self._message)
+                    # Return an empty list of datasets
+                    dataSets = []
+                    return dataSets
 
-            # Append the retrieved datasets to the global list
-            if numRetrievedDataSets > 0:
-                dataSets.extend(currentDataSets)
+        if _DEBUG:
+            for sample in samples:
+                self._logger.info("* Sample with identifier " + sample.getSampleIdentifier() + \
+                                  " and permId " + sample.getPermId() + ": " + \
+                                  str(len(dataSetsPerSample.get(sample.getPermId(), []))) + \
+                                  " datasets")
 
-        # We collected all datasets
+        # We collected all datasets, in the order of the samples
+        dataSets = []
+        for sample in samples:
+            dataSets.extend(dataSetsPerSample.get(sample.getPermId(), []))
         return dataSets
 
     def _getDataSets(self, expSampleType, expSamplePermId, sampleType, samplePermId,
                      requestedDatasetType="MICROSCOPY_IMG_CONTAINER"):
         """
         Return a list of datasets of requested type belonging to the MICROSCOPY_EXPERIMENT sample 
-        and a specific sample of type MICROSCOPY_SAMPLE_TYPE.
+        and a specific sample of type MICROSCOPY_SAMPLE_TYPE (or all samples of type
+        MICROSCOPY_SAMPLE_TYPE if samplePermId is None).
         If none are found, return [].
         """
 
@@ -648,7 +1073,7 @@ class Mover():
             self._logger.info("* Requested experiment sample type: " + expSampleType)
             self._logger.info("* Requested experiment sample permId: " + expSamplePermId)
             self._logger.info("* Requested sample type: " + sampleType)
-            self._logger.info("* Requested sample permId: " + samplePermId)
+            self._logger.info("* Requested sample permId: " + str(samplePermId))
 
         # Dataset criteria
         datasetSearchCriteria = SearchCriteria()
@@ -677,11 +1102,12 @@ class Mover():
                 MatchClauseAttribute.TYPE,
                 sampleType)
             )
-        sampleCriteria.addMatchClause(
-             MatchClause.createAttributeMatch(
-                MatchClauseAttribute.PERM_ID,
-                samplePermId)
-             )
+        if samplePermId is not None:
+            sampleCriteria.addMatchClause(
+                 MatchClause.createAttributeMatch(
+                    MatchClauseAttribute.PERM_ID,
+                    samplePermId)
+                 )
         sampleCriteria.addSubCriteria(
             SearchSubCriteria.createSampleParentCriteria(
                 sampleExpCriteria)
@@ -748,85 +1174,570 @@ class Mover():
 
     def _getFilesForDataSets(self, dataSets, requestedDatasetType="MICROSCOPY_IMG_CONTAINER"):
         """
-        Get the list of microscopy file paths that correspond to the input list
-        of datasets. If no files are found, returns [].
+        Walks the 'original' folders of the input list of datasets and yields
+        one (source, relative destination path, size) tuple per file to
+        export. The content is walked lazily, while the files are copied.
+
+        The source is the full path of the file; files of datasets whose
+        original data is stored in an HDF5 container do not exist on disk:
+        their hierarchical content node is yielded instead, to be extracted
+        with _extractContainerFile(). The destination path is the path of
+        the file relative to the 'original' folder (see
+        _getContainerFilePath() for files in HDF5 containers).
+
+        Series of a file share its dataset content, so the same physical
+        file can be reached through several datasets: it is yielded once.
         """
 
         # Only two types of experiment are allowed
         assert requestedDatasetType == "MICROSCOPY_IMG_CONTAINER" or requestedDatasetType == "MICROSCOPY_ACCESSORY_FILE", \
             "Input argument 'requestedDatasetType' must be one of MICROSCOPY_IMG_CONTAINER or MICROSCOPY_ACCESSORY_FILE."
 
-        if dataSets == []:
-            return []
+        # Only the image files at the top of the 'original' folder are
+        # checked: the content of folders is exported as is
+        filterFiles = requestedDatasetType == "MICROSCOPY_IMG_CONTAINER"
+
+        # Real paths of the files on disk and destination paths of the files
+        # in HDF5 containers already yielded
+        seen = set()
 
-        dataSetFiles = []
         for dataSet in dataSets:
             content = contentProvider.getContent(dataSet.getDataSetCode())
-            nodes = content.listMatchingNodes("original", ".*")
-
-            if nodes is not None:
-                for node in nodes:
-                    fileName = node.tryGetFile()
-                    if fileName is not None:
-                        fileName = str(fileName)
-                        if os.path.isdir(str(fileName)):
-                            dataSetFiles.append(fileName)
-                        else:
-                            if requestedDatasetType == "MICROSCOPY_IMG_CONTAINER":
-                                if self._isValidMicroscopyFile(fileName):
-                                    # Only valid microscopy files are accepted
-                                    dataSetFiles.append(fileName)
-                            else:
-                                # All files are accepted
-                                dataSetFiles.append(fileName)
-
-        if len(dataSetFiles) == 0:
-            self._message = "Could not retrieve dataset files!"
-            self._logger.error(self._message)
 
-        # Return the files
-        return dataSetFiles
+            # Stack of (node, is at the top of 'original') still to walk
+            stack = []
+            for node in content.getRootNode().getChildNodes():
+                if node.getName() == "original" or node.getName().startswith("original."):
+                    stack.extend([(child, True) for child in reversed(list(node.getChildNodes()))])
+
+            while len(stack) > 0:
+                node, topLevel = stack.pop()
+                if node.isDirectory():
+                    stack.extend([(child, False) for child in reversed(list(node.getChildNodes()))])
+                    continue
+
+                fileName = node.tryGetFile()
+                if fileName is None:
+                    # The file is stored in an HDF5 container
+                    source = node
+                    relPath = os.path.join(*self._getContainerFilePath(node))
+                    key = relPath
+                else:
+                    source = str(fileName)
+                    if topLevel and filterFiles and not self._isValidMicroscopyFile(source):
+                        continue
+                    relPath = os.path.join(*node.getRelativePath().split("/")[1:])
+                    key = os.path.realpath(source)
+
+                if key in seen:
+                    continue
+                seen.add(key)
+
+                if fileName is not None and self._incrementalChecksum:
+                    self._contentNodes[source] = node
+
+                yield source, relPath, node.getFileLength()
 
     def _isValidMicroscopyFile(self, fileName):
         """Checks whether the file has a compatible extension."""
 
         for validExt in self._validExtensions:
-            fileName.lower().endswith("." + validExt)
-            return True
+            if fileName.lower().endswith("." + validExt):
+                return True
 
         self._logger.error("File " + fileName + " is not a valid microscopy file.")
         return False
 
-    def _copyFile(self, source, dstDir):
-        """Copies the source file (with full path) to directory dstDir.
-        We use a trick to preserve the NFSv4 ACLs: since copying the file
-        loses them, we first touch the destination file to create it, and
-        then we overwrite it.
+    def _copyFiles(self, dataSetFiles, dstDir):
+        """Copies the files yielded by _getFilesForDataSets() to directory
+        dstDir, at their relative destination paths.
+
+        The files are consumed as the copy progresses: the destination
+        folders are created and the copy jobs of a file are planned (see
+        _planJobs()) only when a pool of self._numCopyWorkers threads has
+        room for them. Large files are split in parts that are copied in
+        parallel (unless they can be linked, see _copyFile()). Failures do
+        not stop the copy of the other files: they are collected, and if any
+        file could not be copied, the method returns False and sets the
+        error message in self._message.
         """
-        dstFile = os.path.join(dstDir, os.path.basename(source))
-        touch = "/usr/bin/touch" if OSUtilities.isMacOS() else "/bin/touch"
-        subprocess.call([touch, dstFile])
-        subprocess.call(["/bin/cp", source, dstDir])
-        self._logger.info("Copying file " + source + " to " + dstDir)
-        self._numCopiedFiles += 1
 
-    def _copyDir(self, source, dstDir):
-        """Copies the source directory (with full path) recursively to directory dstDir.
+        self._modificationTimes = {}
+        plannedJobs = self._planJobs(dataSetFiles, dstDir)
+
+        # Number of jobs left, strategy and failure of the files being copied
+        # (large files are copied in parts)
+        numJobsLeft = {}
+        strategies = {}
+        failedFiles = set()
+
+        # Run the jobs, with at most two jobs per worker waiting; each job
+        # returns (number of bytes, strategy)
+        executor = Executors.newFixedThreadPool(self._numCopyWorkers)
+        try:
+            pending = []
+            jobs = []
+            planned = False
+            while True:
+                if not planned and self._cancelled():
+                    # Only wait for the jobs already submitted
+                    planned = True
+                    jobs = []
+                while len(pending) < 2 * self._numCopyWorkers:
+                    if len(jobs) == 0:
+                        if planned:
+                            break
+                        try:
+                            jobs = plannedJobs.next()
+                        except StopIteration:
+                            planned = True
+                            break
+                        numJobsLeft[jobs[0][0]] = len(jobs)
+                    fileName, function, args = jobs.pop(0)
+                    pending.append((fileName, executor.submit(_CopyJob(function, args))))
+                if len(pending) == 0:
+                    break
+
+                fileName, future = pending.pop(0)
+                try:
+                    numBytes, strategy = future.get()
+                    self._numCopiedBytes += numBytes
+                    self._numBytesDone += numBytes
+                    strategies[fileName] = strategy
+                except ExecutionException, e:
+                    if fileName not in failedFiles:
+                        failedFiles.add(fileName)
+                        self._copyErrors.append((fileName, str(e.getCause())))
+                    self._logger.error("Could not copy " + fileName + ": " + str(e.getCause()))
+
+                numJobsLeft[fileName] -= 1
+                if numJobsLeft[fileName] == 0:
+                    del numJobsLeft[fileName]
+                    strategy = strategies.pop(fileName, None)
+                    if fileName in failedFiles:
+                        failedFiles.remove(fileName)
+                    else:
+                        self._numCopiedFiles += 1
+                        self._numFilesPerStrategy[strategy] += 1
+                        if fileName in self._modificationTimes and strategy != "hardlink":
+                            dstFile, mtime = self._modificationTimes[fileName]
+                            os.utime(dstFile, (mtime, mtime))
+                    self._modificationTimes.pop(fileName, None)
+                    self._numFilesDone += 1
+                self._reportProgress()
+        finally:
+            executor.shutdown()
+
+        if self._cancelled():
+            return False
+
+        if len(self._copyErrors) > 0:
+            self._message = "Could not copy " + str(len(self._copyErrors)) + " file(s): " + \
+                "; ".join([f + " (" + e + ")" for f, e in self._copyErrors[:_MAX_REPORTED_ERRORS]])
+            if len(self._copyErrors) > _MAX_REPORTED_ERRORS:
+                self._message += "; ..."
+            return False
+
+        return True
+
+    def _planJobs(self, dataSetFiles, dstDir):
+        """Creates the destination folders of the files yielded by
+        _getFilesForDataSets() and yields, for every file that must be
+        copied, the list of its copy jobs (file, function, args)."""
+
+        createdDirs = set()
+        for source, relPath, size in dataSetFiles:
+            dstFile = os.path.join(dstDir, relPath)
+            dstSubDir = os.path.dirname(dstFile)
+            if dstSubDir not in createdDirs:
+                self._createDir(dstSubDir)
+                createdDirs.add(dstSubDir)
+
+            if isinstance(source, basestring):
+                jobs = self._getFileJobs(source, dstFile, size)
+            else:
+                # File stored in an HDF5 container
+                jobs = self._getContainerFileJobs(source, dstFile)
+            if len(jobs) > 0:
+                yield jobs
+
+    def _getFileJobs(self, source, dstFile, size):
+        """Returns the job(s) to copy the source file (with full path) of
+        given size to dstFile: one job for the whole file, or one job per
+        part for large files. Returns [] if the file needs no copy."""
+
+        self._numFilesTotal += 1
+        self._numBytesTotal += size
+
+        # In incremental mode, skip the files that are already exported
+        if self._incremental:
+            mtime = os.path.getmtime(source)
+            if self._isExported(dstFile, size, mtime, self._contentNodes.get(source)):
+                self._numSkippedFiles += 1
+                self._numSkippedBytes += size
+                self._fileDone(size)
+                return []
+            self._modificationTimes[source] = (dstFile, mtime)
+
+        if size < _COPY_PART_MIN_SIZE:
+            return [(source, self._copyFile, (source, dstFile))]
+
+        # Linking is cheap: try it right away
+        strategy = self._linkFile(source, dstFile)
+        if strategy is not None:
+            self._numCopiedFiles += 1
+            self._numCopiedBytes += size
+            self._numFilesPerStrategy[strategy] += 1
+            if self._incremental and strategy != "hardlink":
+                os.utime(dstFile, (mtime, mtime))
+            self._modificationTimes.pop(source, None)
+            self._fileDone(size)
+            return []
+
+        # Create the destination file (see _copyFile()) and copy it in parts
+        self._logger.info("Copying file " + source + " to " + dstFile + " in parts")
+        touch(dstFile)
+        return [(source, self._copyFilePart,
+                 (source, dstFile, offset, min(_COPY_PART_SIZE, size - offset)))
+                for offset in range(0, size, _COPY_PART_SIZE)]
+
+    def _getContainerFileJobs(self, node, dstFile):
+        """Returns the job to extract a file stored in an HDF5 container
+        (passed as hierarchical content node) to dstFile, or [] if the file
+        needs no extraction."""
+
+        self._numFilesTotal += 1
+        self._numBytesTotal += node.getFileLength()
+
+        # In incremental mode, skip the files that are already exported
+        if self._incremental:
+            mtime = node.getLastModified() / 1000
+            if self._isExported(dstFile, node.getFileLength(), mtime,
+                                node if self._incrementalChecksum else None):
+                self._numSkippedFiles += 1
+                self._numSkippedBytes += node.getFileLength()
+                self._fileDone(node.getFileLength())
+                return []
+            self._modificationTimes[node.getRelativePath()] = (dstFile, mtime)
+
+        return [(node.getRelativePath(), self._extractContainerFile, (node, dstFile))]
+
+    def _isExported(self, dstFile, size, mtime, node=None):
+        """Checks whether dstFile is an up-to-date export of a file of given
+        size and modification time (in seconds). If the content node of the
+        file is passed, the CRC32 checksum stored in the datastore must also
+        match the one of dstFile."""
+
+        if not os.path.isfile(dstFile):
+            return False
+        if os.path.getsize(dstFile) != size or int(os.path.getmtime(dstFile)) != int(mtime):
+            return False
+        if node is None:
+            return True
+
+        crc = CRC32()
+        buf = jarray.zeros(_ZIP_BUFFER_SIZE, 'b')
+        inputStream = FileInputStream(dstFile)
+        try:
+            while True:
+                n = inputStream.read(buf)
+                if n < 0:
+                    break
+                crc.update(buf, 0, n)
+        finally:
+            inputStream.close()
+        return crc.getValue() == (node.getChecksumCRC32() & 0xffffffffL)
+
+    def _getContainerFilePath(self, node):
+        """Returns the path of a file stored in an HDF5 container (passed as
+        hierarchical content node) as list of path components, without
+        'original' and without the container extensions."""
+
+        parts = node.getRelativePath().split("/")
+        if len(parts) > 1 and (parts[0] == "original" or parts[0].startswith("original.")):
+            parts = parts[1:]
+        for i in range(len(parts) - 1):
+            for ext in [".h5ar", ".h5"]:
+                if parts[i].lower().endswith(ext):
+                    parts[i] = parts[i][:-len(ext)]
+        return parts
+
+    def _copyFile(self, source, dstFile):
+        """Copies the source file (with full path) to dstFile and returns
+        (number of copied bytes, strategy).
+        To preserve the NFSv4 ACLs, the destination file must be created
+        by opening it (so that it inherits the default ACL of its folder) and
+        then overwritten, rather than be replaced by a copy of the source
+        with its own ACLs. With zero_copy enabled, the file is linked if
+        possible (see _linkFile()). Otherwise, the copy is done in-process
+        by _transferFile(); if that fails, we fall back to touching the
+        destination file and overwriting it with /bin/cp.
+        """
+        strategy = self._linkFile(source, dstFile)
+        if strategy is not None:
+            return os.path.getsize(source), strategy
+
+        self._logger.info("Copying file " + source + " to " + dstFile)
+        try:
+            return self._transferFile(source, dstFile), "copy"
+        except Exception, e:
+            self._logger.warning("In-process copy of " + source + " failed (" +
+                                 str(e) + "): falling back to /bin/cp.")
+            touch = "/usr/bin/touch" if OSUtilities.isMacOS() else "/bin/touch"
+            subprocess.call([touch, dstFile])
+            if subprocess.call(["/bin/cp", source, dstFile]) != 0:
+                raise Exception("/bin/cp failed.")
+            return os.path.getsize(dstFile), "copy"
+
+    def _linkFile(self, source, dstFile):
+        """Tries to export the source file without copying its content, and
+        returns the strategy used ("reflink" or "hardlink"), or None if the
+        file must be copied.
+
+        A reflink (copy-on-write clone, with cp --reflink=always, or cp -c
+        on macOS) is a new file that shares the data blocks of the source:
+        it is created like a copy (see _copyFile()) and gets the ACLs of the
+        destination folder. A hardlink is the source file itself: it keeps
+        the permissions of the datastore, and changes to it would change the
+        stored data. Hardlinks are therefore only used for files that nobody
+        can write and that everybody can read. A stale destination file
+        (e.g. from an earlier incremental export) is removed first. Hardlinks
+        are disabled for the rest of the export only if the file system does
+        not support them or the destination is on another device; any other
+        failure only falls back to a copy of this file.
         """
-        dstSubDir = os.path.join(dstDir, os.path.basename(source))
-        self._createDir(dstSubDir)
 
-        # Info
-        self._logger.info("Copying directory " + source + " to " + dstDir)
-
-        # Now copy recursively (by preserving NFSv4 ACLs)
-        files = os.listdir(source)
-        for f in files:
-            fullPath = os.path.join(source, f)
-            if os.path.isdir(fullPath):
-                self._copyDir(fullPath, dstSubDir)
+        if self._reflinkSupported:
+            touch(dstFile)
+            if OSUtilities.isMacOS():
+                command = ["/bin/cp", "-c", source, dstFile]
             else:
-                self._copyFile(fullPath, dstSubDir)
+                command = ["/bin/cp", "--reflink=always", source, dstFile]
+            devNull = open(os.devnull, 'w')
+            try:
+                result = subprocess.call(command, stderr=devNull)
+            finally:
+                devNull.close()
+            if result == 0:
+                self._logger.info("Reflinked file " + source + " to " + dstFile)
+                return "reflink"
+            self._logger.info("Reflinks are not supported: disabled for this export.")
+            self._reflinkSupported = False
+            os.remove(dstFile)
+
+        if self._hardlinkSupported:
+            mode = os.stat(source).st_mode
+            if mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH) == 0 and \
+                    mode & stat.S_IROTH != 0:
+                if os.path.lexists(dstFile):
+                    os.remove(dstFile)
+                try:
+                    Files.createLink(Paths.get(dstFile), Paths.get(source))
+                    self._logger.info("Hardlinked file " + source + " to " + dstFile)
+                    return "hardlink"
+                except FileAlreadyExistsException, e:
+                    self._logger.warning("Could not hardlink " + source + " to " + dstFile +
+                                         " (the destination already exists): copying it.")
+                except UnsupportedOperationException, e:
+                    self._logger.info("Hardlinks are not supported (" + str(e) +
+                                      "): disabled for this export.")
+                    self._hardlinkSupported = False
+                except FileSystemException, e:
+                    if _isCrossDeviceError(e):
+                        self._logger.info("Hardlinks are not possible across devices (" +
+                                          str(e) + "): disabled for this export.")
+                        self._hardlinkSupported = False
+                    else:
+                        self._logger.warning("Could not hardlink " + source + " to " +
+                                             dstFile + " (" + str(e) + "): copying it.")
+                except Exception, e:
+                    self._logger.warning("Could not hardlink " + source + " to " +
+                                         dstFile + " (" + str(e) + "): copying it.")
+
+        return None
+
+    def _transferFile(self, source, dstFile):
+        """Copies the source file to dstFile with a channel transfer and
+        returns the number of copied bytes. The destination file is opened
+        for writing (and created if needed) without being replaced, which
+        preserves the NFSv4 ACLs (see _copyFile()).
+        """
+        inputStream = FileInputStream(source)
+        try:
+            outputStream = FileOutputStream(dstFile)
+            try:
+                inChannel = inputStream.getChannel()
+                outChannel = outputStream.getChannel()
+                size = inChannel.size()
+                self._transfer(inChannel, 0, size, outChannel, source)
+            finally:
+                outputStream.close()
+        finally:
+            inputStream.close()
+        return size
+
+    def _copyFilePart(self, source, dstFile, offset, length):
+        """Copies length bytes of the source file from given offset to the
+        same offset in the (existing) dstFile and returns (number of copied
+        bytes, strategy). Parts of a file can be copied in parallel."""
+        inputStream = FileInputStream(source)
+        try:
+            output = RandomAccessFile(dstFile, "rw")
+            try:
+                outChannel = output.getChannel()
+                outChannel.position(offset)
+                self._transfer(inputStream.getChannel(), offset, length, outChannel, source)
+            finally:
+                output.close()
+        finally:
+            inputStream.close()
+        return length, "copy"
+
+    def _transfer(self, inChannel, offset, length, outChannel, source):
+        """Transfers length bytes of inChannel from given offset to the
+        current position of outChannel."""
+        position = offset
+        end = offset + length
+        while position < end:
+            transferred = inChannel.transferTo(position,
+                                               min(_COPY_CHUNK_SIZE, end - position),
+                                               outChannel)
+            if transferred <= 0:
+                raise Exception("Could not transfer " + source + " at byte " +
+                                str(position) + ".")
+            position += transferred
+
+    def _extractContainerFile(self, node, dstFile):
+        """Extracts a file stored in an HDF5 container (passed as hierarchical
+        content node) to dstFile and returns (number of extracted bytes,
+        strategy).
+        """
+
+        # Touch the destination file first to preserve the NFSv4 ACLs (see
+        # _copyFile()) and then stream the content out of the container
+        touch(dstFile)
+        inputStream = node.getInputStream()
+        try:
+            numBytes = Files.copy(inputStream, java.io.File(dstFile).toPath(),
+                                  StandardCopyOption.REPLACE_EXISTING)
+        finally:
+            inputStream.close()
+
+        self._logger.info("Extracting file " + node.getRelativePath() + " to " +
+                          os.path.dirname(dstFile))
+        return numBytes, "copy"
+
+    def _zipFilesForExperiment(self):
+        """Writes the files of the experiment to the zip archive (stored,
+        ZIP64) without copying them to the export folder first: files are
+        read once from the datastore, and the CRCs are computed while they
+        are written.
+
+        Returns True for success. In case of error, returns False and sets
+        the error message in self._message.
+        """
+
+        if not self._createZipArchive():
+            self._message = "Could not create zip archive " + \
+                self.getZipArchiveFullPath()
+            return False
+
+        try:
+            return (self._copyFilesForExperiment("MICROSCOPY_IMG_CONTAINER") and
+                    self._copyFilesForExperiment("MICROSCOPY_ACCESSORY_FILE"))
+        finally:
+            self._zipArchive.close()
+            self._zipArchive = None
+
+    def _createZipArchive(self):
+        """Opens a new zip archive for the export. As for the experiment folder
+        (see _createRootAndExperimentFolder()), _{digit} is appended to the
+        name if the archive already exists.
+        """
+
+        expPath = self._rootExportPath
+        if os.path.exists(expPath + ".zip"):
+            counter = 1
+            while os.path.exists(expPath + "_" + str(counter) + ".zip"):
+                counter += 1
+            expPath = expPath + "_" + str(counter)
+
+        # Update the root and experiment paths
+        self._rootExportPath = expPath
+        self._experimentPath = os.path.join(self._rootExportPath,
+                                            self._experimentName)
+
+        # Create the folder containing the archive
+        self._createDir(os.path.dirname(self._rootExportPath))
+
+        try:
+            self._zipArchive = zipfile.ZipFile(self.getZipArchiveFullPath(), 'w',
+                                            zipfile.ZIP_STORED, allowZip64=True)
+        except IOError, message:
+            self._logger.error("Could not create zip archive: " + str(message))
+            return False
+
+        return True
+
+    def _zipFiles(self, dataSetFiles):
+        """Writes the files yielded by _getFilesForDataSets() to the zip
+        archive, in the same structure as they would be copied to the
+        experiment folder.
+
+        The archive is written sequentially; since an entry that failed
+        cannot be removed from it, the first failure stops the export.
+        """
+
+        # Paths in the archive are relative to the parent of the export root
+        arcRoot = os.path.join(os.path.basename(self._rootExportPath),
+                               self._experimentName)
+
+        for source, relPath, size in dataSetFiles:
+            if self._cancelled():
+                return False
+            self._numFilesTotal += 1
+            self._numBytesTotal += size
+            try:
+                if isinstance(source, basestring):
+                    self._zipFile(source, os.path.join(arcRoot, relPath))
+                else:
+                    # File stored in an HDF5 container
+                    self._zipContainerFile(source, os.path.join(arcRoot, relPath))
+            except Exception, e:
+                self._copyErrors.append((relPath, str(e)))
+                self._message = "Could not add " + relPath + " to the zip archive: " + str(e)
+                self._logger.error(self._message)
+                return False
+
+        return True
+
+    def _zipFile(self, source, arcName):
+        """Writes the source file (with full path) to the zip archive as
+        arcName."""
+
+        # Workaround problem with file name encoding
+        self._zipArchive.write(source.encode('latin-1'), arcName.encode('latin-1'),
+                            zipfile.ZIP_STORED)
+        self._numCopiedFiles += 1
+        self._numCopiedBytes += os.path.getsize(source)
+        self._numFilesPerStrategy["copy"] += 1
+        self._fileDone(os.path.getsize(source))
+
+    def _zipContainerFile(self, node, arcName):
+        """Streams a file stored in an HDF5 container (passed as hierarchical
+        content node) to the zip archive as arcName."""
+
+        self._logger.info("Adding file " + node.getRelativePath() + " to the zip archive")
+        inputStream = node.getInputStream()
+        try:
+            zip_write_stream(self._zipArchive, inputStream, node.getFileLength(),
+                             arcName.encode('latin-1'))
+        finally:
+            inputStream.close()
+        self._numCopiedFiles += 1
+        self._numCopiedBytes += node.getFileLength()
+        self._numFilesPerStrategy["copy"] += 1
+        self._fileDone(node.getFileLength())
 
     def _createDir(self, dirFullPath):
         """Creates the passed directory (with full path).
@@ -850,7 +1761,7 @@ class Mover():
         Please notice that if the experiment folder already exists, _{digit}
         will be appended to the folder name, to ensure that the folder is
         unique. The updated folder name will be stored in the _rootExportPath
-        property.
+        property. In incremental mode, the existing folder is reused.
         """
 
         # This should not happen
@@ -862,7 +1773,7 @@ class Mover():
         expPath = self._rootExportPath
 
         # Does the folder already exist?
-        if os.path.exists(expPath):
+        if os.path.exists(expPath) and not self._incremental:
             counter = 1
             ok = False
             while not ok:
@@ -892,8 +1803,11 @@ class Mover():
 def parsePropertiesFile():
     """Parse properties file for custom plug-in settings."""
 
-    filename = "../core-plugins/microscopy/4/dss/reporting-plugins/export_microscopy_datasets/plugin.properties"
+    filename = os.path.join(_getPluginPath(), "plugin.properties")
     var_names = ['base_dir', 'export_dir', 'hrm_base_dir', 'hrm_src_subdir']
+    optional_var_names = ['copy_workers', 'zero_copy', 'incremental_export',
+                          'incremental_checksum', 'export_workers',
+                          'export_jobs_per_user', 'user_quota', 'jobs_dir']
 
     properties = {}
     try:
@@ -906,7 +1820,8 @@ def parsePropertiesFile():
             line = re.sub('[ \'\"\n]', '', line)
             parts = line.split("=")
             if len(parts) == 2:
-                if parts[0] in var_names:
+                if parts[0] in var_names or \
+                        (parts[0] in optional_var_names and parts[1] != ""):
                     properties[parts[0]] = parts[1]
     finally:
         fp.close()
@@ -922,7 +1837,7 @@ def parsePropertiesFile():
             return None
 
     # Make sure that there are no Windows line endings
-    for var_name in var_names:
+    for var_name in properties.keys():
         properties[var_name] = properties[var_name].replace('\r', '')
 
     # Everything found
@@ -937,6 +1852,12 @@ def parsePropertiesFile():
 # expPermId: experiment identifier
 # sampleId : sample identifier
 # mode     : requested mode of operation: one of 'normal', 'hrm', zip'.
+# cancel   : (optional, with uid) if 'true', the job is cancelled: removed
+#            from the queue if it did not start yet, or stopped at the next
+#            file.
+#
+# The exports are queued and run by an ExportScheduler, with a bounded number
+# of exports at the same time (in total and per user).
 #
 # This plug-in returns a table to the client with a different set of columns
 # depending on whether the plug-in is called for the first time and the process
@@ -963,11 +1884,35 @@ def parsePropertiesFile():
 #            export folder.
 # zipArchiveFileName: file name of the zip in case compression was requested.
 # mode     : requested mode of operation.
+# nCopiedBytes: total number of copied bytes.
+# copyStrategies: number of files exported per strategy (reflink, hardlink,
+#            copy).
+# nSkippedFiles: number of files skipped because they were already exported
+#            (incremental export).
+# nSkippedBytes: total size of the skipped files.
+# queuePosition: position of the job in the queue (0 if it started).
+# nFilesDone, nFilesTotal: number of files exported (or skipped) so far, and
+#            total number of files found so far.
+# nBytesDone, nBytesTotal: same, in bytes.
+# throughput: average throughput in bytes per second.
+# eta      : estimated remaining time in seconds (-1 if unknown).
+# nBytesEstimated: size of the export estimated before it started. Exports
+#            that do not fit in the free space of the target folder (or in
+#            the user_quota) are refused with an error message.
+#
+# The jobs are kept in an ExportJobStore (on disk) for _JOB_TTL_SECONDS after
+# their last update. Unknown (or removed) jobs and jobs interrupted by a
+# restart of the DSS are reported as completed with success False.
+#
+# The clients read the columns by position: new columns must be appended.
 def aggregate(parameters, tableBuilder):
 
     # Get the ID of the call if it already exists
     uid = parameters.get("uid");
 
+    # Get the scheduler that runs the exports
+    scheduler = getScheduler(parsePropertiesFile())
+
     if uid is None or uid == "":
 
         # Create a unique id
@@ -982,20 +1927,42 @@ def aggregate(parameters, tableBuilder):
         row.setCell("uid", uid)
         row.setCell("completed", False)
 
-        # Launch the actual process in a separate thread
-        thread = Thread(target=aggregateProcess,
-                        args=(parameters, tableBuilder, uid))
-        thread.start()
+        # Store the initial results: the client may query them while the
+        # job is still in the queue
+        store = getJobStore()
+        store.evict()
+        store.set(uid, initResults(uid))
+
+        # Queue the actual process (it runs in a separate thread) - userId
+        # is a global variable made available to the aggregation plug-in
+        scheduler.submit(uid, userId, aggregateProcess,
+                         (parameters, tableBuilder, uid, scheduler))
 
         # Return immediately
         return
 
-    # The process is already running in a separate thread. We get current
-    # results and return them
-    resultToSend = LRCache.get(uid);
+    store = getJobStore()
+
+    # Cancel the job if requested
+    if str(parameters.get("cancel")).lower() == "true":
+        if scheduler.cancel(uid):
+            # The job had not started yet
+            resultToStore = store.get(uid)
+            if resultToStore is not None:
+                resultToStore["completed"] = True
+                resultToStore["success"] = False
+                resultToStore["message"] = "The export was cancelled."
+                store.set(uid, resultToStore)
+
+    # The process is queued or already running in a separate thread. We get
+    # current results and return them
+    resultToSend = store.get(uid)
     if resultToSend is None:
-        # This should not happen
-        raise Exception("Could not retrieve results from result cache!")
+        # Unknown or removed job: make sure that the client stops polling
+        resultToSend = initResults(uid)
+        resultToSend["completed"] = True
+        resultToSend["success"] = False
+        resultToSend["message"] = "Unknown export job " + uid + "."
 
     # Add the table headers
     tableBuilder.addHeader("uid")
@@ -1006,6 +1973,18 @@ def aggregate(parameters, tableBuilder):
     tableBuilder.addHeader("relativeExpFolder")
     tableBuilder.addHeader("zipArchiveFileName")
     tableBuilder.addHeader("mode")
+    tableBuilder.addHeader("nCopiedBytes")
+    tableBuilder.addHeader("copyStrategies")
+    tableBuilder.addHeader("nSkippedFiles")
+    tableBuilder.addHeader("nSkippedBytes")
+    tableBuilder.addHeader("queuePosition")
+    tableBuilder.addHeader("nFilesDone")
+    tableBuilder.addHeader("nFilesTotal")
+    tableBuilder.addHeader("nBytesDone")
+    tableBuilder.addHeader("nBytesTotal")
+    tableBuilder.addHeader("throughput")
+    tableBuilder.addHeader("eta")
+    tableBuilder.addHeader("nBytesEstimated")
 
     # Store current results in the table
     row = tableBuilder.addRow()
@@ -1017,28 +1996,74 @@ def aggregate(parameters, tableBuilder):
     row.setCell("relativeExpFolder", resultToSend["relativeExpFolder"])
     row.setCell("zipArchiveFileName", resultToSend["zipArchiveFileName"])
     row.setCell("mode", resultToSend["mode"])
+    row.setCell("nCopiedBytes", resultToSend["nCopiedBytes"])
+    row.setCell("copyStrategies", resultToSend["copyStrategies"])
+    row.setCell("nSkippedFiles", resultToSend["nSkippedFiles"])
+    row.setCell("nSkippedBytes", resultToSend["nSkippedBytes"])
+    row.setCell("queuePosition", scheduler.getQueuePosition(uid))
+    row.setCell("nFilesDone", resultToSend["nFilesDone"])
+    row.setCell("nFilesTotal", resultToSend["nFilesTotal"])
+    row.setCell("nBytesDone", resultToSend["nBytesDone"])
+    row.setCell("nBytesTotal", resultToSend["nBytesTotal"])
+    row.setCell("throughput", resultToSend["throughput"])
+    row.setCell("eta", resultToSend["eta"])
+    row.setCell("nBytesEstimated", resultToSend["nBytesEstimated"])
+
+
+# Initial results of a job
+def initResults(uid):
 
-
-# Actual work process
-def aggregateProcess(parameters, tableBuilder, uid):
-
-    # Make sure to initialize and store the results. We need to have them since
-    # most likely the client will try to retrieve them again before the process
-    # is finished.
     resultToStore = {}
     resultToStore["uid"] = uid
     resultToStore["success"] = True
     resultToStore["completed"] = False
     resultToStore["message"] = ""
     resultToStore["nCopiedFiles"] = ""
+    resultToStore["nCopiedBytes"] = ""
+    resultToStore["copyStrategies"] = ""
+    resultToStore["nSkippedFiles"] = ""
+    resultToStore["nSkippedBytes"] = ""
     resultToStore["relativeExpFolder"] = ""
     resultToStore["zipArchiveFileName"] = ""
     resultToStore["mode"] = ""
-    LRCache.set(uid, resultToStore)
+    resultToStore["nFilesDone"] = 0
+    resultToStore["nFilesTotal"] = 0
+    resultToStore["nBytesDone"] = 0
+    resultToStore["nBytesTotal"] = 0
+    resultToStore["throughput"] = 0
+    resultToStore["eta"] = -1
+    resultToStore["nBytesEstimated"] = 0
+    return resultToStore
+
+
+# Actual work process
+def aggregateProcess(parameters, tableBuilder, uid, scheduler=None):
+
+    # Make sure to initialize and store the results. We need to have them since
+    # most likely the client will try to retrieve them again before the process
+    # is finished.
+    store = getJobStore()
+    resultToStore = initResults(uid)
+    store.set(uid, resultToStore)
+
+    # Whatever goes wrong, the job must be completed: the client polls until
+    # it is
+    try:
+        _aggregateProcess(parameters, uid, scheduler, store, resultToStore)
+    except:
+        message = str(sys.exc_info()[1])
+        logging.getLogger().error("Export " + uid + " failed: " + message)
+        resultToStore["completed"] = True
+        resultToStore["success"] = False
+        resultToStore["message"] = message
+        store.set(uid, resultToStore)
+
+
+def _aggregateProcess(parameters, uid, scheduler, store, resultToStore):
+    """Runs the export and stores its results (see aggregateProcess())."""
 
     # Get path to containing folder
-    # __file__ does not work (reliably) in Jython
-    dbPath = "../core-plugins/microscopy/4/dss/reporting-plugins/export_microscopy_datasets"
+    dbPath = _getPluginPath()
 
     # Path to the logs subfolder
     logPath = os.path.join(dbPath, "logs")
@@ -1084,23 +2109,57 @@ def aggregateProcess(parameters, tableBuilder, uid):
     logger.info(" * export_dir     = " + properties['export_dir'])
     logger.info(" * hrm_base_dir   = " + properties['hrm_base_dir'])
     logger.info(" * hrm_src_subdir = " + properties['hrm_src_subdir'])
+    logger.info(" * user_quota     = " + properties.get('user_quota', ''))
 
     # Instantiate the Mover object - userId is a global variable
     # made available to the aggregation plug-in
-    mover = Mover(experimentId, expSamplePermId, samplePermId, mode, userId, properties, logger)
+    isCancelled = None
+    if scheduler is not None:
+        isCancelled = lambda: scheduler.isCancelled(uid)
+
+    # Store the progress (at most every _JOB_PROGRESS_INTERVAL seconds)
+    start = time.time()
+    lastUpdate = [0]
+
+    def progress(nFilesDone, nFilesTotal, nBytesDone, nBytesTotal, nBytesEstimated):
+        now = time.time()
+        if now - lastUpdate[0] < _JOB_PROGRESS_INTERVAL:
+            return
+        lastUpdate[0] = now
+        throughput = nBytesDone / max(now - start, 0.001)
+        resultToStore["nFilesDone"] = nFilesDone
+        resultToStore["nFilesTotal"] = nFilesTotal
+        resultToStore["nBytesDone"] = nBytesDone
+        resultToStore["nBytesTotal"] = nBytesTotal
+        resultToStore["nBytesEstimated"] = nBytesEstimated
+        resultToStore["throughput"] = int(throughput)
+        resultToStore["eta"] = -1
+        if throughput > 0:
+            # The files are found as they are exported: the estimate is the
+            # better total until all files are found
+            resultToStore["eta"] = int((max(nBytesTotal, nBytesEstimated) - nBytesDone) /
+                                       throughput)
+        store.set(uid, resultToStore)
+
+    mover = Mover(experimentId, expSamplePermId, samplePermId, mode, userId, properties, logger,
+                  isCancelled, progress)
 
     # Process
     success = mover.process()
 
-    # Compress
-    if mode == "zip":
-        mover.compressIfNeeded()
-
     # Get some results info
     nCopiedFiles = mover.getNumberOfCopiedFiles()
+    nCopiedBytes = mover.getNumberOfCopiedBytes()
+    copyStrategies = mover.getCopyStrategies()
+    nSkippedFiles = mover.getNumberOfSkippedFiles()
+    nSkippedBytes = mover.getNumberOfSkippedBytes()
+    nFilesDone, nFilesTotal, nBytesDone, nBytesTotal = mover.getProgress()
     errorMessage = mover.getErrorMessage()
     relativeExpFolder = mover.getRelativeRootExperimentPath()
     zipFileName = mover.getZipArchiveFileName()
+    logger.info("Copied " + str(nCopiedFiles) + " files (" + str(nCopiedBytes) +
+                " bytes; " + copyStrategies + "); skipped " + str(nSkippedFiles) +
+                " unchanged files (" + str(nSkippedBytes) + " bytes).")
 
     # Update results and store them
     resultToStore["uid"] = uid
@@ -1108,10 +2167,21 @@ def aggregateProcess(parameters, tableBuilder, uid):
     resultToStore["success"] = success
     resultToStore["message"] = errorMessage
     resultToStore["nCopiedFiles"] = nCopiedFiles
+    resultToStore["nCopiedBytes"] = nCopiedBytes
+    resultToStore["copyStrategies"] = copyStrategies
+    resultToStore["nSkippedFiles"] = nSkippedFiles
+    resultToStore["nSkippedBytes"] = nSkippedBytes
+    resultToStore["nFilesDone"] = nFilesDone
+    resultToStore["nFilesTotal"] = nFilesTotal
+    resultToStore["nBytesDone"] = nBytesDone
+    resultToStore["nBytesTotal"] = nBytesTotal
+    resultToStore["throughput"] = int(nCopiedBytes / max(time.time() - start, 0.001))
+    resultToStore["eta"] = 0
+    resultToStore["nBytesEstimated"] = mover.getEstimatedSize()
     resultToStore["relativeExpFolder"] = relativeExpFolder
     resultToStore["zipArchiveFileName"] = zipFileName
     resultToStore["mode"] = mode
-    LRCache.set(uid, resultToStore)
+    store.set(uid, resultToStore)
 
     # Email result to the user
     if success == True:
@@ -1130,6 +2200,10 @@ def aggregateProcess(parameters, tableBuilder, uid):
         else:
             body = snip + "successfully packaged for download: " + zipFileName
 
+        if nSkippedFiles > 0:
+            body += " " + str(nSkippedFiles) + " unchanged file(s) were already " + \
+                "exported and were skipped."
+
     else:
         subject = "Microscopy: error processing request!"
         body = "Sorry, there was an error processing your request. " + \
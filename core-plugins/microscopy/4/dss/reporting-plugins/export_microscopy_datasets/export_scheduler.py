@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+'''
+Scheduler of the export jobs of the export_microscopy_datasets aggregation
+plug-in.
+
+The plug-in script is evaluated anew at every call, but this module is
+imported once and lives as long as the datastore server: the scheduler and
+its running jobs are shared by all calls.
+'''
+
+from threading import Lock
+from threading import Thread
+
+
+class ExportScheduler():
+    """
+    Runs the export jobs with a bounded number of concurrent exports, and a
+    bounded number of concurrent exports per user. Queued jobs are started
+    fair-share: the next job is the oldest one of the users with the fewest
+    running exports.
+
+    The scheduler must outlive the call to the plug-in that created it: it
+    is a module-level singleton (see getScheduler()); the status of the jobs
+    is kept in the ExportJobStore of the plug-in.
+    """
+
+    def __init__(self, numWorkers, numJobsPerUser):
+        """Constructor
+
+        numWorkers    : maximum number of exports running at the same time.
+        numJobsPerUser: maximum number of exports of one user running at
+                        the same time.
+        """
+
+        self._numWorkers = numWorkers
+        self._numJobsPerUser = numJobsPerUser
+
+        # Queued jobs (oldest first): (uid, userId, function, args)
+        self._queue = []
+
+        # Running jobs: uid -> userId
+        self._running = {}
+
+        # Running jobs that were asked to stop
+        self._cancelled = set()
+
+        self._lock = Lock()
+
+    def submit(self, uid, userId, function, args):
+        """Queues a job: function(*args) is called in a new thread as soon as
+        the limits allow it."""
+
+        self._lock.acquire()
+        try:
+            self._queue.append((uid, userId, function, args))
+            self._dispatch()
+        finally:
+            self._lock.release()
+
+    def cancel(self, uid):
+        """Cancels a job. A queued job is removed from the queue (and True is
+        returned); a running job is flagged (see isCancelled()) and stops at
+        the next file."""
+
+        self._lock.acquire()
+        try:
+            for job in self._queue:
+                if job[0] == uid:
+                    self._queue.remove(job)
+                    return True
+            if uid in self._running:
+                self._cancelled.add(uid)
+            return False
+        finally:
+            self._lock.release()
+
+    def isCancelled(self, uid):
+        """Returns True if the running job was cancelled."""
+
+        return uid in self._cancelled
+
+    def getQueuePosition(self, uid):
+        """Returns the position of the job in the queue (1 for the next one),
+        or 0 if it is not queued (any more)."""
+
+        self._lock.acquire()
+        try:
+            for i in range(len(self._queue)):
+                if self._queue[i][0] == uid:
+                    return i + 1
+            return 0
+        finally:
+            self._lock.release()
+
+    def _dispatch(self):
+        """Starts queued jobs while the limits allow it (the lock must be
+        held)."""
+
+        while len(self._running) < self._numWorkers:
+
+            # Number of running jobs per user
+            numRunning = {}
+            for userId in self._running.values():
+                numRunning[userId] = numRunning.get(userId, 0) + 1
+
+            # Oldest job of the users with the fewest running jobs
+            nextJob = None
+            for job in self._queue:
+                n = numRunning.get(job[1], 0)
+                if n >= self._numJobsPerUser:
+                    continue
+                if nextJob is None or n < numRunning.get(nextJob[1], 0):
+                    nextJob = job
+            if nextJob is None:
+                return
+
+            self._queue.remove(nextJob)
+            self._running[nextJob[0]] = nextJob[1]
+            Thread(target=self._run, args=(nextJob,)).start()
+
+    def _run(self, job):
+        """Runs a job and starts the next ones when it is done."""
+
+        uid, userId, function, args = job
+        try:
+            function(*args)
+        finally:
+            self._lock.acquire()
+            try:
+                del self._running[uid]
+                self._cancelled.discard(uid)
+                self._dispatch()
+            finally:
+                self._lock.release()
+
+
+# The scheduler shared by all calls to the plug-in
+_scheduler = None
+_schedulerLock = Lock()
+
+
+def getScheduler(numWorkers, numJobsPerUser):
+    """Returns the ExportScheduler shared by all calls to the plug-in (it is
+    created on first use, with the given limits)."""
+
+    global _scheduler
+
+    _schedulerLock.acquire()
+    try:
+        if _scheduler is None:
+            _scheduler = ExportScheduler(numWorkers, numJobsPerUser)
+        return _scheduler
+    finally:
+        _schedulerLock.release()